@@ -0,0 +1,146 @@
+"""
+Run sub-commands through the ``helga_jenkins`` command entry point, against
+the stub Jenkins in ``server.py``, and report commands per second, latency
+(from the command to its first reply) and Jenkins requests per command. Run
+with::
+
+    python benchmarks/commands.py --builds 5000 --latency 0.02 --count 200
+
+Each sub-command is run ``--count`` times, ``--concurrency`` at a time, like
+a busy channel would. Caches are kept between runs, so the numbers include
+whatever the plugin saves by reusing connections, job metadata and logs.
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [here, os.path.dirname(here)]
+
+from server import serve  # noqa
+
+COMMANDS = [
+    'status ceph-1',
+    'status ceph-1 4990',
+    'health ceph-1',
+    'builds ceph-1',
+    'jobs ceph-1',
+    'find ceph-12',
+    'log ceph-1',
+    'stages ceph-1',
+    'stats ceph-1',
+    'queue',
+    'status ceph-1 ceph-2 ceph-3',
+    'build ceph-1',
+]
+
+
+class Client(object):
+    """
+    Stands in for the IRC client, firing a deferred with the first line
+    replied to each channel
+    """
+
+    def __init__(self):
+        self.waiting = {}
+
+    def msg(self, channel, line):
+        d = self.waiting.pop(channel, None)
+        if d is not None:
+            d.callback(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--jobs', type=int, default=50)
+    parser.add_argument('--builds', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every Jenkins response')
+    parser.add_argument('--count', type=int, default=100, help='times each command is run')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument(
+        '--rate-limit', type=float, default=1000,
+        help='JENKINS_RATE_LIMIT, high by default so that it is the plugin being measured')
+    parser.add_argument('commands', nargs='*', default=COMMANDS, help='sub-commands, quoted (default: a mix)')
+    options = parser.parse_args()
+
+    ready = multiprocessing.Queue()
+    stub = multiprocessing.Process(
+        target=serve, kwargs=dict(jobs=options.jobs, builds=options.builds, latency=options.latency, ready=ready))
+    stub.daemon = True
+    stub.start()
+    port = ready.get(timeout=120)
+
+    # settings have to be in place before the plugin is imported
+    from helga import settings
+    settings.JENKINS_URL = 'http://127.0.0.1:%d/' % port
+    settings.JENKINS_USERNAME = 'bench'
+    settings.JENKINS_PASSWORD = 'secret'
+    settings.MULTI_JENKINS = None
+    settings.JENKINS_RATE_LIMIT = options.rate_limit
+    settings.JENKINS_RATE_BURST = max(options.rate_limit, 1)
+    # replies are paced for IRC, which is not what is being measured here
+    settings.JENKINS_SEND_RATE = settings.JENKINS_SEND_BURST = 10 ** 6
+    settings.JENKINS_DIGEST_WINDOW = 0
+    build_cache = settings.JENKINS_BUILD_CACHE = tempfile.mkdtemp(prefix='helga-jenkins-builds-')
+
+    from twisted.internet import defer, reactor
+    import helga_jenkins
+    helga_jenkins.watcher.store = None
+
+    client = Client()
+    sequence = itertools.count()
+
+    def requests():
+        return sum(timing['count'] for _, timing in helga_jenkins.metrics.select('jenkins'))
+
+    def run(command, latencies):
+        channel = '#bench-%d' % next(sequence)
+        d = client.waiting[channel] = defer.Deferred()
+        start = time.time()
+        try:
+            response = helga_jenkins.helga_jenkins(client, channel, 'bench', '!ci ' + command, 'ci', command.split())
+        except helga_jenkins.ResponseNotReady:
+            pass
+        else:
+            client.msg(channel, response)
+        d.addCallback(lambda line: latencies.append(time.time() - start))
+        return d
+
+    @defer.inlineCallbacks
+    def bench():
+        print('%d jobs with %d builds, %.0fms latency, %d runs of each command, %d at a time' % (
+            options.jobs, options.builds, options.latency * 1000, options.count, options.concurrency))
+        print('%-30s %10s %10s %10s %10s' % ('command', 'cmds/s', 'p50 (ms)', 'p99 (ms)', 'requests'))
+        try:
+            for command in options.commands:
+                latencies = []
+                semaphore = defer.DeferredSemaphore(options.concurrency)
+                before = requests()
+                start = time.time()
+                yield defer.gatherResults([
+                    semaphore.run(run, command, latencies) for _ in range(options.count)])
+                elapsed = time.time() - start
+                latencies.sort()
+                print('%-30s %10.1f %10.1f %10.1f %10.2f' % (
+                    command,
+                    options.count / elapsed,
+                    helga_jenkins.percentile(latencies, 50) * 1000,
+                    helga_jenkins.percentile(latencies, 99) * 1000,
+                    float(requests() - before) / options.count,
+                ))
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(bench)
+    reactor.run()
+    stub.terminate()
+    shutil.rmtree(build_cache)
+
+
+if __name__ == '__main__':
+    main()
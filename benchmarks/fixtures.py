@@ -0,0 +1,135 @@
+"""
+Payloads shaped like the ones a long-lived Jenkins job produces, so that the
+plugin can be measured without a real Jenkins. ``project`` applies a Jenkins
+``tree`` query to them the same way Jenkins would.
+"""
+import re
+
+
+def build(job, number, building=False):
+    result = None if building else ('FAILURE' if number % 7 == 0 else 'SUCCESS')
+    return {
+        '_class': 'hudson.model.FreeStyleBuild',
+        'actions': [
+            {'causes': [{'shortDescription': 'Started by GitHub push by ktdreyer'}]},
+            {},
+            {'parameters': [
+                {'name': 'BRANCH', 'value': 'master'},
+                {'name': 'FORCE', 'value': False},
+            ]},
+            {'buildsByBranchName': {'origin/master': {
+                'buildNumber': number,
+                'buildResult': None,
+                'revision': {
+                    'SHA1': 'dc331670463992addddb6f03aff364e61693c5f5',
+                    'branch': [{'SHA1': 'dc331670463992addddb6f03aff364e61693c5f5',
+                                'name': 'origin/master'}]}}},
+             'remoteUrls': ['https://github.com/ceph/ceph-build'],
+             'scmName': ''},
+        ],
+        'building': building,
+        'builtOn': 'slave-%02d' % (number % 20),
+        'description': None,
+        'displayName': '#%d' % number,
+        'duration': 0 if building else 600000 + (number % 13) * 15000,
+        'estimatedDuration': 650000,
+        'fullDisplayName': '%s #%d' % (job, number),
+        'id': str(number),
+        'number': number,
+        'queueId': 100000 + number,
+        'result': result,
+        'timestamp': 1460000000000 + number * 3600000,
+        'url': 'http://jenkins.example.com/job/%s/%d/' % (job, number),
+    }
+
+
+def job(name='ceph', builds=5000):
+    """
+    The full job info for ``name``, with ``builds`` builds, like
+    ``get_job_info`` gets without a ``tree`` (``depth=1`` so that builds carry
+    their details, which is what plenty of plugins and views end up doing)
+    """
+    history = [build(name, n, building=(n == builds)) for n in range(builds, 0, -1)]
+    last_failed = next(b for b in history if b['result'] == 'FAILURE')
+    last_ok = next(b for b in history if b['result'] == 'SUCCESS')
+    return {
+        '_class': 'hudson.model.FreeStyleProject',
+        'actions': [{}, {'parameterDefinitions': [
+            {'defaultParameterValue': {'value': 'master'},
+             'description': 'The git branch (or tag) to build',
+             'name': 'BRANCH',
+             'type': 'StringParameterDefinition'},
+        ]}, {}],
+        'buildable': True,
+        'builds': history,
+        'color': 'blue_anime',
+        'description': '',
+        'displayName': name,
+        'firstBuild': history[-1],
+        'healthReport': [{
+            'description': 'Build stability: 1 out of the last 5 builds failed.',
+            'iconUrl': 'health-60to79.png',
+            'score': 80,
+        }],
+        'inQueue': False,
+        'lastBuild': history[0],
+        'lastCompletedBuild': history[1],
+        'lastFailedBuild': last_failed,
+        'lastSuccessfulBuild': last_ok,
+        'name': name,
+        'nextBuildNumber': builds + 1,
+        'url': 'http://jenkins.example.com/job/%s/' % name,
+    }
+
+
+def parse_tree(tree):
+    """
+    Parse a ``tree`` query into ``{field: (subtree, range)}``
+    """
+    fields = {}
+    position = 0
+    token = re.compile(r'([^,\[\]{}]+)')
+    while position < len(tree):
+        name = token.match(tree, position).group(1)
+        position += len(name)
+        subtree, limits = None, None
+        if position < len(tree) and tree[position] == '[':
+            depth, start = 1, position + 1
+            while depth:
+                position += 1
+                depth += {'[': 1, ']': -1}.get(tree[position], 0)
+            subtree = parse_tree(tree[start:position])
+            position += 1
+        if position < len(tree) and tree[position] == '{':
+            end = tree.index('}', position)
+            bounds = tree[position + 1:end].split(',')
+            limits = (int(bounds[0] or 0), int(bounds[1]) if len(bounds) > 1 and bounds[1] else None)
+            position = end + 1
+        fields[name] = (subtree, limits)
+        if position < len(tree) and tree[position] == ',':
+            position += 1
+    return fields
+
+
+def project(data, tree):
+    """
+    Apply a Jenkins ``tree`` query (a string, or an already parsed one) to
+    ``data``
+    """
+    if isinstance(tree, str):
+        tree = parse_tree(tree)
+    if isinstance(data, list):
+        return [project(item, tree) for item in data]
+    if not isinstance(data, dict):
+        return data
+    projected = {}
+    for name, (subtree, limits) in tree.items():
+        if name not in data:
+            continue
+        value = data[name]
+        if limits and isinstance(value, list):
+            value = value[limits[0]:limits[1]]
+        if subtree and value is not None:
+            value = project(value, subtree)
+        projected[name] = value
+    return projected
@@ -0,0 +1,38 @@
+"""
+Compare the payload size and parse time of the full job info against the
+``tree`` projections each sub-command uses. Run with::
+
+    python benchmarks/projections.py [builds]
+"""
+import json
+import os
+import sys
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [here, os.path.dirname(here)]
+
+from fixtures import job, project  # noqa
+from helga_jenkins import JOB_TREES  # noqa
+
+
+def measure(payload, repeat=5):
+    body = json.dumps(payload)
+    seconds = min(timeit.repeat(lambda: json.loads(body), number=1, repeat=repeat))
+    return len(body), seconds
+
+
+def main():
+    builds = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    data = job('ceph', builds=builds)
+    size, seconds = measure(data)
+    print('job with %d builds' % builds)
+    print('%-10s %12s %12s' % ('view', 'bytes', 'parse (ms)'))
+    print('%-10s %12d %12.3f' % ('full', size, seconds * 1000))
+    for name in sorted(JOB_TREES):
+        size, seconds = measure(project(data, JOB_TREES[name]))
+        print('%-10s %12d %12.3f' % (name, size, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
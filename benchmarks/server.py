@@ -0,0 +1,200 @@
+"""
+A stub Jenkins HTTP server with the fixture payloads, so that the plugin can
+talk HTTP to something without a real Jenkins. Every response is delayed by
+``latency`` seconds, like a busy Jenkins would. Run on its own with::
+
+    python benchmarks/server.py [port] [jobs] [builds] [latency]
+"""
+import json
+import os
+import re
+import sys
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fixtures import job, parse_tree, project  # noqa
+
+
+class FakeJenkins(object):
+    """
+    Answers Jenkins API paths for ``jobs`` jobs (``ceph-0``, ``ceph-1``, ...)
+    with ``builds`` builds each. Every fifth job is failing.
+    """
+
+    def __init__(self, jobs=50, builds=5000, log_lines=2000):
+        self.names = ['ceph-%d' % i for i in range(jobs)]
+        self.template = job('ceph', builds=builds)
+        self.builds = dict((b['number'], b) for b in self.template['builds'])
+        self.log = ''.join(
+            'ERROR: could not fetch ceph-build\n' if i == log_lines // 2 else '+ make -j8 step %d\n' % i
+            for i in range(log_lines))
+        self.queue_id = 0
+        self.trees = {}
+
+    def project(self, data, tree):
+        if not tree:
+            return data
+        if tree not in self.trees:
+            self.trees[tree] = parse_tree(tree)
+        return project(data, self.trees[tree])
+
+    def root(self):
+        return {
+            'mode': 'NORMAL',
+            'nodeName': '',
+            'jobs': [
+                {'name': name,
+                 'color': 'red' if i % 5 == 0 else 'blue',
+                 'url': 'http://jenkins.example.com/job/%s/' % name}
+                for i, name in enumerate(self.names)
+            ],
+        }
+
+    def job(self, name):
+        if name not in self.names:
+            return None
+        return dict(self.template, name=name, displayName=name)
+
+    def build(self, number):
+        if number in ('lastBuild', 'lastCompletedBuild'):
+            return self.template[number]
+        return self.builds.get(int(number))
+
+    def describe(self, build, stages=8):
+        """
+        The stage view of a build, as if every job was a pipeline with
+        ``stages`` stages of equal length
+        """
+        duration = build['duration'] or build['estimatedDuration'] // 2
+        done = stages if not build['building'] else stages // 2
+        status = 'IN_PROGRESS' if build['building'] else ('FAILED' if build['result'] == 'FAILURE' else 'SUCCESS')
+        statuses = ['SUCCESS'] * (done - 1) + [status]
+        return {
+            'id': str(build['number']),
+            'status': status,
+            'durationMillis': duration,
+            'stages': [
+                {'id': str(i + 6), 'name': 'stage-%d' % i, 'durationMillis': duration // stages, 'status': stage}
+                for i, stage in enumerate(statuses)
+            ],
+        }
+
+    def get(self, path, query):
+        """
+        ``(status, headers, body)`` for a GET of ``path``
+        """
+        tree = query.get('tree', [None])[0]
+        match = re.match(r'job/([^/]+)/(\d+|lastBuild|lastCompletedBuild)/(.*)$', path)
+        if match:
+            name, number, rest = match.groups()
+            build = self.build(number) if name in self.names else None
+            if build is None:
+                return 404, {}, ''
+            if rest == 'api/json':
+                return 200, {}, json.dumps(self.project(build, tree))
+            if rest == 'wfapi/describe':
+                return 200, {}, json.dumps(self.describe(build))
+            if re.match(r'execution/node/\d+/wfapi/describe$', rest):
+                steps = [{'name': 'Shell Script', 'parameterDescription': 'make check', 'status': 'FAILED',
+                          'error': {'message': 'script returned exit code 2'}}]
+                return 200, {}, json.dumps({'stageFlowNodes': steps})
+            if rest in ('logText/progressiveText', 'consoleText'):
+                start = int(query.get('start', ['0'])[0])
+                headers = {'X-Text-Size': str(len(self.log)), 'X-More-Data': 'false'}
+                return 200, headers, self.log[start:]
+            return 404, {}, ''
+        match = re.match(r'job/([^/]+)/api/json$', path)
+        if match:
+            data = self.job(match.group(1))
+            if data is None:
+                return 404, {}, ''
+            return 200, {}, json.dumps(self.project(data, tree))
+        match = re.match(r'queue/item/(\d+)/api/json$', path)
+        if match:
+            number = self.template['lastBuild']['number']
+            item = {
+                'id': int(match.group(1)),
+                'cancelled': False,
+                'why': None,
+                'inQueueSince': int(time.time() * 1000),
+                'executable': {'number': number, 'url': self.template['lastBuild']['url']},
+            }
+            return 200, {}, json.dumps(self.project(item, tree))
+        if path == 'api/json':
+            return 200, {'X-Jenkins': '2.46'}, json.dumps(self.project(self.root(), tree))
+        if path == 'queue/api/json':
+            now = int(time.time() * 1000)
+            items = [{'id': i, 'inQueueSince': now - i * 60000, 'stuck': False, 'task': {'name': name}}
+                     for i, name in enumerate(self.names[:3])]
+            return 200, {}, json.dumps(self.project({'items': items}, tree))
+        if path == 'computer/api/json':
+            return 200, {}, json.dumps(self.project({'busyExecutors': 3, 'totalExecutors': 8}, tree))
+        if path == 'me/api/json':
+            return 200, {}, json.dumps({'id': 'bench', 'fullName': 'Bench'})
+        return 404, {}, ''
+
+    def post(self, path):
+        match = re.match(r'job/([^/]+)/(build|buildWithParameters|enable|disable)$', path)
+        if not match or match.group(1) not in self.names:
+            return 404, {}, ''
+        if match.group(2) in ('build', 'buildWithParameters'):
+            self.queue_id += 1
+            return 201, {'Location': 'http://jenkins.example.com/queue/item/%d/' % self.queue_id}, ''
+        return 200, {}, ''
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def respond(self, status, headers, body):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.respond(*self.server.jenkins.get(url.path.strip('/'), parse_qs(url.query)))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.respond(*self.server.jenkins.post(urlparse(self.path).path.strip('/')))
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(port=0, jobs=50, builds=5000, latency=0.0, ready=None):
+    """
+    Serve forever. If ``ready`` is given (e.g. a ``multiprocessing`` queue)
+    the port is put in it once the server is listening.
+    """
+    httpd = Server(('127.0.0.1', port), Handler)
+    httpd.jenkins = FakeJenkins(jobs=jobs, builds=builds)
+    httpd.latency = latency
+    if ready is not None:
+        ready.put(httpd.server_address[1])
+    httpd.serve_forever()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    serve(
+        port=int(args[0]) if len(args) > 0 else 8080,
+        jobs=int(args[1]) if len(args) > 1 else 50,
+        builds=int(args[2]) if len(args) > 2 else 5000,
+        latency=float(args[3]) if len(args) > 3 else 0.0,
+    )
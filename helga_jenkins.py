@@ -1,8 +1,27 @@
-from twisted.internet import reactor
+import bisect
+import difflib
+import fnmatch
+import hashlib
+import json
+import math
+import os
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import smokesignal
+import urllib3
+from twisted.internet import defer, reactor, task, threads
+from twisted.web import resource, server
+from helga.db import db
 from helga.plugins import command, ResponseNotReady
 from helga import log, settings
-from jenkins import Jenkins, JenkinsException, NotFoundException
-from urllib2 import HTTPError
+from httplib import HTTPException
+from jenkins import Jenkins, JenkinsException, NotFoundException, TimeoutException
+from urllib import addinfourl, quote, urlencode
+from urllib2 import BaseHandler, HTTPError, Request, URLError, build_opener
 
 logger = log.getLogger(__name__)
 
@@ -14,23 +33,29 @@ def get_jenkins_url(settings):
     return url
 
 
-def job_is_parametrized(job_info):
+def job_url(conn, name):
     """
-    If a job is parametrized but no arguments are passed in, then
-    python-jenkins will use a different URL to trigger the job (vs. using the
-    url that indicates the job is parametrized) causing builds to error and not
-    get started.
+    The URL for a job, taking care of jobs that live in folders (named like
+    ``folder/job``)
+    """
+    return conn.server + ''.join('job/%s/' % quote(part) for part in name.split('/'))
+
 
-    This check helps by looking into the job_config to determine if the job is
-    in fact parametrized so that we can add a bogus param and trick
-    python-jenkins in using the correct URL
+def jenkins_json(conn, url, tree=None, depth=None):
     """
-    actions = job_info.get('actions', [])
-    if not actions:
-        return False
-    for action in actions:
-        if action.get('parameterDefinitions'):
-            return True
+    Fetch the JSON API for ``url`` (a Jenkins URL ending in ``/``). Using
+    ``tree`` limits the response to just the fields that are needed, which
+    makes a huge difference for jobs with a long build history.
+    """
+    query = {}
+    if tree:
+        query['tree'] = tree
+    if depth is not None:
+        query['depth'] = depth
+    url = url + 'api/json'
+    if query:
+        url = '%s?%s' % (url, urlencode(query))
+    return json.loads(conn.jenkins_open(Request(url)))
 
 
 def get_job_params(build_info):
@@ -74,83 +99,231 @@ def get_job_params(build_info):
     return param_string
 
 
+class JobIndex(object):
+    """
+    All the job names of an instance (including the ones in folders, named
+    like ``folder/job``) kept sorted in memory, so that listing and searching
+    jobs, or suggesting a name for a typo, doesn't need to ask Jenkins.
+    """
+
+    def __init__(self, names=(), created=None):
+        self.names = sorted(set(names), key=lambda n: n.lower())
+        self.lowered = [n.lower() for n in self.names]
+        self.created = time.time() if created is None else created
+
+    def __contains__(self, name):
+        lowered = name.lower()
+        i = bisect.bisect_left(self.lowered, lowered)
+        while i < len(self.names) and self.lowered[i] == lowered:
+            if self.names[i] == name:
+                return True
+            i += 1
+        return False
+
+    def __len__(self):
+        return len(self.names)
+
+    def prefix(self, prefix):
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.lowered, prefix)
+        end = start
+        while end < len(self.lowered) and self.lowered[end].startswith(prefix):
+            end += 1
+        return self.names[start:end]
+
+    def search(self, substring):
+        substring = substring.lower()
+        return [n for n, lowered in zip(self.names, self.lowered) if substring in lowered]
+
+    def match(self, pattern):
+        """
+        Job names matching a glob like ``ceph-*``
+        """
+        return [n for n in self.names if fnmatch.fnmatchcase(n, pattern)]
+
+    def suggest(self, name, limit=3):
+        return difflib.get_close_matches(name, self.names, limit, 0.75)
+
+    @classmethod
+    def from_jobs(cls, jobs, folder=''):
+        """
+        Flatten the nested ``jobs`` from the Jenkins API into full job names
+        """
+        names = []
+        for job in jobs:
+            name = folder + job['name']
+            if 'jobs' in job:
+                names.extend(cls.from_jobs(job['jobs'] or [], folder=name + '/'))
+            else:
+                names.append(name)
+        return names
+
+
+job_indexes = {}
+
+
+def job_index(conn):
+    """
+    The job index for the instance ``conn`` is connected to, which is
+    fetched again (with a single request) once it is older than
+    ``JENKINS_INDEX_TTL`` seconds
+    """
+    index = job_indexes.get(conn.instance)
+    ttl = getattr(settings, 'JENKINS_INDEX_TTL', 300)
+    if index is None or time.time() - index.created > ttl:
+        # every folder level needs its own nesting in the tree
+        tree = 'name'
+        for _ in range(getattr(settings, 'JENKINS_FOLDER_DEPTH', 2)):
+            tree = 'name,jobs[%s]' % tree
+        data = jenkins_json(conn, conn.server, tree='jobs[%s]' % tree)
+        index = job_indexes[conn.instance] = JobIndex(JobIndex.from_jobs(data.get('jobs', [])))
+    return index
+
+
+def summarize(names, limit=20):
+    if len(names) <= limit:
+        return ', '.join(names)
+    return '%s and %d more' % (', '.join(names[:limit]), len(names) - limit)
+
+
 def jobs(conn, *args, **kw):
-    return conn.get_jobs()
+    """
+    List the jobs in Jenkins, optionally only the ones starting with a prefix
+    or matching a glob. Example usage::
+        !ci jobs
+        !ci jobs ceph
+        !ci jobs ceph-*-release
+    """
+    args = list(args)
+    args.pop(0)  # get rid of the command
+    index = job_index(conn)
+    if not args:
+        names = index.names
+    elif any(ch in args[0] for ch in '*?['):
+        names = index.match(args[0])
+    else:
+        names = index.prefix(args[0])
+    if not names:
+        return 'no jobs found'
+    return '%d jobs: %s' % (len(names), summarize(names))
 
 
-def status(conn, *args, **kw):
+def find(conn, *args, **kw):
+    """
+    Find jobs with names that contain some text. Example usage::
+        !ci find release
+    """
     args = list(args)
     args.pop(0)  # get rid of the command
-    name = get_name(conn, args.pop(0))
-    # get build number of last build
-    build_number = conn.get_job_info(name)['nextBuildNumber']
+    index = job_index(conn)
+    names = index.search(args[0])
+    if names:
+        return '%d jobs: %s' % (len(names), summarize(names))
+    suggestions = index.suggest(args[0])
+    if suggestions:
+        return 'no jobs found, did you mean: %s' % ', '.join(suggestions)
+    return 'no jobs found'
+
+
+def not_found(conn, name):
+    """
+    The error for a job that doesn't exist, with suggestions from the job
+    index if it has already been fetched
+    """
+    msg = '%s does not exist (or could not be found) in Jenkins' % name
+    index = job_indexes.get(conn.instance)
+    suggestions = index.suggest(name) if index is not None else []
+    if suggestions:
+        msg += ', did you mean: %s' % ', '.join(suggestions)
+    return RuntimeError(msg)
+
+
+# The fields used to describe a build, for status, watched builds and stats.
+# It is also what the build cache keeps of completed builds.
+BUILD_FIELDS = (
+    'number,building,result,duration,url,builtOn,timestamp,estimatedDuration,'
+    'actions[parameters[name,value],queuingDurationMillis]'
+)
+
+
+def resolve_status(conn, name):
+    """
+    Find the most recent build of a job with a single request, using the
+    ``lastBuild`` pointer instead of guessing from ``nextBuildNumber``. If the
+    last build is still running, ``lastCompletedBuild`` is included so that
+    the previous result can be reported as well.
+    """
     try:
-        info = conn.get_build_info(name, build_number)
+        info = jenkins_json(conn, job_url(conn, name), tree=JOB_TREES['status'], depth=0)
     except NotFoundException:
-        # use the previous one
-        info = conn.get_build_info(name, build_number-1)
+        raise not_found(conn, name)
+    if not info.get('lastBuild'):
+        raise RuntimeError('%s has no builds yet' % name)
+    build_info = info['lastBuild']
+    build_cache.put(conn.instance, name, build_info)
+    build_info['lastCompletedBuild'] = info.get('lastCompletedBuild')
+    return build_info
+
+
+def status_message(name, info):
     params = get_job_params(info)
     param_string = 'params: {0}'.format(params) if params else ''
+    # builds pushed by Jenkins don't say which server they were built on
+    server = 'on server: %s ' % info['builtOn'] if 'builtOn' in info else ''
     if info['building']:
         # it is currently building so return a corresponding message
-        msg = 'BUILDING %s on server: %s url: %s %s' % (
+        msg = 'BUILDING %s %surl: %s %s' % (
             name,
-            info['builtOn'],
+            server,
             info['url'],
             param_string,
         )
+        previous = info.get('lastCompletedBuild')
+        if previous:
+            msg += '(previous: %s)' % str(previous['result']).upper()
     else:
-        msg = '%s for %s on server: %s url: %s %s' % (
+        msg = '%s for %s %surl: %s %s' % (
             str(info['result']).upper(),
             name,
-            info['builtOn'],
+            server,
             info['url'],
             param_string,
         )
 
-    return msg
+    return msg.strip()
 
 
-def async_status(conn, name, build_number, client=None, channel=None, nick=None):
+def status(conn, *args, **kw):
     """
-    an async status is meant to poll the jenkins server and just report back
-    if the build is no longer running.
+    Get the status of the last build of a job (or several). Example usage::
+        !ci status {job}
+        !ci status {job} {job}
+        !ci status ceph-*
+        !ci status {job} {build number}
     """
-    info = conn.get_build_info(name, build_number)
+    args = list(args)
+    args.pop(0)  # get rid of the command
+    name = args.pop(0)
+    if args:
+        return status_message(name, build_record(conn, name, args.pop(0)))
+    return status_message(name, resolve_status(conn, name))
 
-    if info['building']:
-        # it is currently building so return a corresponding message
-        reactor.callLater(
-            60,
-            async_status,
-            conn,
-            name,
-            build_number,
-            client=client,
-            channel=channel,
-            nick=nick
-        )
 
-    else:
-        msg = '%s %s for %s on server: %s url: %s' % (
-            nick,
-            str(info['result']).upper(),
-            name,
-            info['builtOn'],
-            info['url']
-        )
-        client.msg(channel, msg)
+def completion_message(name, info, nick):
+    return '%s %s' % (nick, status_message(name, info))
 
 
 def health(conn, *args, **kw):
     """
     Get a report of the health of a given build. Example usage::
         !ci health {job}
+        !ci health {job} {job}
+        !ci health ceph-*
     """
     args = list(args)
     args.pop(0)  # get rid of the command
     name = get_name(conn, args.pop(0))
-    info = conn.get_job_info(name)
+    info = job_info(conn, name, JOB_TREES['health'])
     return info['healthReport'][0]['description']
 
 
@@ -163,7 +336,7 @@ def builds(conn, *args, **kw):
     args = list(args)
     args.pop(0)  # get rid of the command
     name = get_name(conn, args.pop(0))
-    info = conn.get_job_info(name)
+    info = job_info(conn, name, JOB_TREES['builds'])
 
     sub_commands = {
         'last': 'lastBuild',
@@ -222,7 +395,7 @@ def args_to_dict(args, add_bogus=False):
 
     for item in args:
         if '=' in item:
-            key, value = item.split('=')
+            key, value = item.split('=', 1)
         else:
             key, value = item, None
         params[key] = value
@@ -230,16 +403,859 @@ def args_to_dict(args, add_bogus=False):
     return params
 
 
-def async_build_info(jenkins_conn, name, next_build_number, client=None, channel=None, nick=None):
-    build_info = jenkins_conn.get_build_info(name, next_build_number)
-    msg = '%s: %s build started at: %s' % (nick, name, build_info['url'])
-    client.msg(channel, msg)
+def parameter_definitions(info):
+    """
+    The parameters a job takes, from its info, in order::
+
+        {'BRANCH': {'type': 'String', 'default': 'master', 'choices': None}}
+
+    Jenkins lists them in the job ``actions``, or in its ``property`` for
+    pipeline jobs.
+    """
+    definitions = OrderedDict()
+    for section in (info.get('actions') or []) + (info.get('property') or []):
+        for definition in (section or {}).get('parameterDefinitions') or []:
+            default = definition.get('defaultParameterValue') or {}
+            definitions[definition['name']] = {
+                'type': (definition.get('type') or '').replace('ParameterDefinition', ''),
+                'default': default.get('value'),
+                'choices': definition.get('choices'),
+            }
+    return definitions
+
+
+def job_parameters(conn, name, fresh=False):
+    """
+    The (cached) parameter definitions of job ``name``. They only change when
+    the job is reconfigured, so they are kept for ``JENKINS_PARAMETERS_TTL``
+    seconds, even after a build is triggered.
+    """
+    cache = parameter_caches.get(conn.instance)
+    if cache is None:
+        cache = parameter_caches.setdefault(conn.instance, TTLCache(
+            ttl=getattr(settings, 'JENKINS_PARAMETERS_TTL', 3600),
+            size=getattr(settings, 'JENKINS_CACHE_SIZE', 512),
+        ))
+    definitions = TTLCache.missing if fresh else cache.get(name, TTLCache.missing)
+    if definitions is TTLCache.missing:
+        definitions = parameter_definitions(jenkins_json(conn, job_url(conn, name), tree=JOB_TREES['build']))
+        cache.set(name, definitions)
+    return definitions
+
+
+def requested_parameters(conn, args):
+    """
+    The build parameters asked for, from ``KEY=VALUE`` arguments and
+    ``@preset`` ones, which expand to the parameters configured for the
+    preset. Explicit parameters win over presets.
+    """
+    presets = jenkins_settings().presets_for(conn.instance)
+    params = OrderedDict()
+    explicit = args_to_dict([a for a in args if not a.startswith('@')])
+    for arg in args:
+        if arg.startswith('@'):
+            preset = presets.get(arg[1:])
+            if preset is None:
+                raise RuntimeError('%s is not a preset, valid ones are: %s' % (
+                    arg[1:], ', '.join(sorted(presets)) or 'none are configured'))
+            for key, value in preset.items():
+                params[key] = value if value is None else str(value)
+    params.update(explicit)
+    return params
+
+
+BOOLEANS = {
+    'true': 'true', 'yes': 'true', 'on': 'true', '1': 'true',
+    'false': 'false', 'no': 'false', 'off': 'false', '0': 'false',
+}
+
+
+def coerce_parameter(key, definition, value):
+    """
+    Check ``value`` against the parameter definition, and turn it into what
+    Jenkins expects for it
+    """
+    if definition['type'] == 'Boolean':
+        if value is None:
+            return 'true'  # a bare FORCE turns it on
+        if value.lower() not in BOOLEANS:
+            raise RuntimeError('%s must be true or false, not %s' % (key, value))
+        return BOOLEANS[value.lower()]
+    if value is None:
+        raise RuntimeError('%s needs a value, like %s=%s' % (key, key, definition['default'] or '...'))
+    if definition['type'] == 'Choice' and definition['choices']:
+        for choice in definition['choices']:
+            if choice.lower() == value.lower():
+                return choice
+        raise RuntimeError('%s must be one of: %s' % (key, ', '.join(definition['choices'])))
+    return value
+
+
+def validate_parameters(name, definitions, requested):
+    """
+    Check the requested parameters against the ones job ``name`` takes, so
+    that a typo is reported right away instead of by a failed build
+    """
+    if requested and not definitions:
+        raise RuntimeError('%s does not take parameters' % name)
+    folded = dict((key.lower(), key) for key in definitions)
+    params = {}
+    for key, value in requested.items():
+        if key.lower() not in folded:
+            close = difflib.get_close_matches(key.lower(), folded, n=1, cutoff=0.6)
+            raise RuntimeError('%s is not a parameter of %s%s (it takes: %s)' % (
+                key, name, ', did you mean %s?' % folded[close[0]] if close else '', ', '.join(definitions)))
+        key = folded[key.lower()]
+        params[key] = coerce_parameter(key, definitions[key], value)
+    return params
+
+
+def build_parameters(conn, name, args):
+    """
+    The validated parameters to trigger job ``name`` with
+    """
+    requested = requested_parameters(conn, args)
+    definitions = job_parameters(conn, name)
+    try:
+        params = validate_parameters(name, definitions, requested)
+    except RuntimeError:
+        # the job might have been reconfigured since its parameters were cached
+        definitions = job_parameters(conn, name, fresh=True)
+        params = validate_parameters(name, definitions, requested)
+    if definitions:
+        # without parameters python-jenkins triggers the non-parametrized url,
+        # which parametrized jobs reject, so give it a bogus one
+        params['__bogus_param__'] = '1'
+    return params
+
+
+def jenkins_urlopen(conn, request):
+    """
+    Open a request with the same auth and crumb handling python-jenkins uses,
+    but return the response itself, for when the headers are needed or the
+    body is too big to read all at once. This relies on python-jenkins 0.4
+    internals (``auth`` as a header value, ``maybe_add_crumb`` taking a
+    urllib2 request), which is why ``setup.py`` pins it below 1.0.
+    """
+    if conn.auth:
+        request.add_header('Authorization', conn.auth)
+    conn.maybe_add_crumb(request)
+    with metrics.timed('jenkins', conn.instance, endpoint_name(conn, request.get_full_url())):
+        with circuit(conn.instance).guard():
+            try:
+                return opener.open(request, timeout=conn.timeout)
+            except HTTPError as error:
+                # give the connection back to the pool
+                error.close()
+                raise
+
+
+def trigger_build(conn, name, params):
+    """
+    Trigger a build and return the id of the queue item Jenkins created for
+    it, which is the only reliable way to find out which build it becomes.
+    python-jenkins doesn't expose the ``Location`` header with the queue item,
+    so the request is done here.
+    """
+    request = Request(conn.build_job_url(name, params, conn.password), b'')
+    response = jenkins_urlopen(conn, request)
+    location = response.info().get('Location', '')
+    response.close()
+    match = re.search(r'/queue/item/(\d+)', location)
+    if not match:
+        raise RuntimeError('triggered %s but Jenkins did not report a queue item for it' % name)
+    return int(match.group(1))
+
+
+def track_queue_item(conn, name, queue_id, client=None, channel=None, nick=None, delay=1, queued=None):
+    """
+    Follow a triggered build through the queue, polling with a short backoff,
+    and report the build number and url as soon as Jenkins assigns them.
+    Then the build is handed to the watcher so that the user is told when it
+    completes.
+    """
+    queued = queued or time.time()
+    item = jenkins_json(
+        conn,
+        '%squeue/item/%d/' % (conn.server, queue_id),
+        tree='cancelled,why,inQueueSince,executable[number,url]',
+    )
+    executable = item.get('executable')
+    if executable:
+        since = item.get('inQueueSince')
+        waited = time.time() - (since / 1000.0 if since else queued)
+        msg = '%s: %s build #%d started at: %s (queued for %ds)' % (
+            nick, name, executable['number'], executable['url'], max(waited, 0))
+        reply_from_thread(client, channel, msg)
+        watcher.watch(conn, name, executable['number'], client, channel, nick)
+    elif item.get('cancelled'):
+        reply_from_thread(client, channel, '%s: %s build was cancelled while in the queue' % (nick, name))
+    else:
+        call_later_from_thread(
+            delay,
+            conn,
+            track_queue_item,
+            name,
+            queue_id,
+            client=client,
+            channel=channel,
+            nick=nick,
+            delay=min(delay * 2, getattr(settings, 'JENKINS_QUEUE_MAX_DELAY', 30)),
+            queued=queued,
+        )
+
+
+class LogTail(object):
+    """
+    Keeps the last ``lines`` lines of a console log, and the first line that
+    looks like an error, while the log is fed in chunks. Memory stays bounded
+    no matter how big the log is, and ``offset`` remembers how much of it has
+    been read so that a running build can be followed incrementally.
+    """
+
+    def __init__(self, lines=10, pattern=None, max_line=400):
+        self.lines = deque(maxlen=lines)
+        self.pattern = re.compile(pattern) if pattern else None
+        self.max_line = max_line
+        self.error = None
+        self.offset = 0
+        self.complete = False
+        self.partial = ''
+        self.lock = threading.Lock()
+
+    def feed(self, chunk):
+        parts = (self.partial + chunk).split('\n')
+        # only the end of a huge line is kept while waiting for its newline
+        self.partial = parts.pop()[-self.max_line:]
+        for line in parts:
+            self.add(line)
+
+    def add(self, line):
+        line = line.rstrip('\r')[:self.max_line]
+        self.lines.append(line)
+        if self.error is None and self.pattern and self.pattern.search(line):
+            self.error = line
+
+    def finish(self):
+        if self.partial:
+            self.add(self.partial)
+            self.partial = ''
+        self.complete = True
+
+
+def read_log(conn, name, number, tail):
+    """
+    Stream the console log of a build into ``tail`` using Jenkins'
+    progressive text API, starting at the byte offset the tail got to before.
+    """
+    url = '%s%s/logText/progressiveText?start=%d' % (job_url(conn, name), number, tail.offset)
+    response = jenkins_urlopen(conn, Request(url))
+    chunk_size = getattr(settings, 'JENKINS_LOG_CHUNK', 64 * 1024)
+    read = 0
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        read += len(chunk)
+        tail.feed(chunk)
+    response.close()
+    headers = response.info()
+    tail.offset = int(headers.get('X-Text-Size') or tail.offset + read)
+    if headers.get('X-More-Data') != 'true':
+        tail.finish()
+    return tail
+
+
+def log_tail(conn, name, number):
+    """
+    The tail of a build log, reusing what was already read for the same build
+    so that only the new part of the log is requested. Tails are kept per
+    Jenkins user, since not everyone may be allowed to read every log.
+    """
+    number = str(number)
+    key = (conn.instance, conn.username, name, number)
+    tail = log_tails.get(key) if number != 'lastBuild' else None
+    if tail is None:
+        tail = LogTail(
+            lines=getattr(settings, 'JENKINS_LOG_LINES', 10),
+            pattern=getattr(settings, 'JENKINS_LOG_ERROR_PATTERN', r'(?i)(error|exception|fatal|traceback)'),
+        )
+    if number != 'lastBuild':
+        log_tails.set(key, tail)
+    # one reader at a time, otherwise both would read from the same offset
+    with tail.lock:
+        if not tail.complete:
+            try:
+                read_log(conn, name, number, tail)
+            except Exception:
+                # what was fed so far would be fed again from the old offset
+                log_tails.invalidate(lambda k: k == key)
+                raise
+    return tail
+
+
+def console_log(conn, *args, **kw):
+    """
+    Show the end of the console log of a build (the last one by default) and
+    the first line that looks like an error. Example usage::
+        !ci log {job}
+        !ci log {job} {build number}
+    """
+    args = list(args)
+    args.pop(0)  # get rid of the command
+    name = get_name(conn, args.pop(0))
+    number = args.pop(0) if args else 'lastBuild'
+    if number != 'lastBuild' and not number.isdigit():
+        raise RuntimeError('%s is not a build number' % number)
+    try:
+        tail = log_tail(conn, name, number)
+    except NotFoundException:
+        raise RuntimeError('build %s of %s could not be found' % (number, name))
+    lines = ['last %d lines of %s #%s:' % (len(tail.lines), name, number)] + list(tail.lines)
+    if tail.error is not None:
+        lines.append('first error: %s' % tail.error)
+    return lines
+
+
+def failure_excerpt(conn, name, number):
+    """
+    A few lines from the log of a failed build, to go with its notification.
+    Disabled unless ``JENKINS_FAILURE_EXCERPT`` is set to how many lines to
+    show.
+    """
+    lines = getattr(settings, 'JENKINS_FAILURE_EXCERPT', 0)
+    if not lines:
+        return []
+    tail = log_tail(conn, name, number)
+    excerpt = list(tail.lines)[-lines:]
+    if tail.error is not None and tail.error not in excerpt:
+        excerpt.insert(0, 'first error: %s' % tail.error)
+    return excerpt
+
+
+# stage statuses of a pipeline build (and of the build itself) that can still
+# change, everything else is final
+RUNNING_STAGES = ('IN_PROGRESS', 'PAUSED_PENDING_INPUT', 'QUEUED')
+FAILED_STAGES = ('FAILED', 'UNSTABLE', 'ABORTED')
+
+
+class StageView(object):
+    """
+    What is known of the stages of a pipeline build, from the stage view API
+    (``wfapi``). Stages that are done never change again, so once the build
+    is complete nothing needs to be requested anymore.
+    """
+
+    def __init__(self):
+        self.number = None
+        self.status = None
+        self.duration = 0
+        self.stages = OrderedDict()
+        self.complete = False
+        self.pipeline = True
+        self.lock = threading.Lock()
+
+    def update(self, describe):
+        """
+        Merge the description of the run, returning the stages that are new
+        or changed status since the last update
+        """
+        self.number = int(describe.get('id') or 0) or self.number
+        self.status = describe.get('status')
+        self.duration = describe.get('durationMillis') or 0
+        changed = []
+        for info in describe.get('stages') or []:
+            known = self.stages.get(info['id'])
+            stage = {
+                'id': info['id'],
+                'name': info.get('name'),
+                'status': info.get('status'),
+                'duration': info.get('durationMillis') or 0,
+                'error': (info.get('error') or {}).get('message'),
+            }
+            if known is None or known['status'] != stage['status']:
+                changed.append(stage)
+            else:
+                stage['error'] = stage['error'] or known['error']
+            self.stages[info['id']] = stage
+        self.complete = self.status not in RUNNING_STAGES
+        return changed
+
+    def running(self):
+        return [stage for stage in self.stages.values() if stage['status'] in RUNNING_STAGES]
+
+
+def stage_error(conn, name, number, stage_id):
+    """
+    The first failed step of a stage, with its error message when Jenkins
+    has one
+    """
+    url = '%s%s/execution/node/%s/wfapi/describe' % (job_url(conn, name), number, stage_id)
+    node = json.loads(conn.jenkins_open(Request(url)))
+    for step in node.get('stageFlowNodes') or []:
+        if step.get('status') in FAILED_STAGES:
+            step_name = step.get('parameterDescription') or step.get('name')
+            error = (step.get('error') or {}).get('message')
+            return '%s: %s' % (step_name, error) if error else step_name
+    return None
+
+
+def read_stages(conn, name, number, view):
+    """
+    Bring ``view`` up to date with a single request for the run description,
+    which is small no matter how long the build log is. Only the stages that
+    just failed are asked for their steps, to find out what went wrong.
+    """
+    url = '%s%s/wfapi/describe' % (job_url(conn, name), number)
+    changed = view.update(json.loads(conn.jenkins_open(Request(url))))
+    for stage in changed:
+        if stage['status'] in FAILED_STAGES and not stage['error']:
+            try:
+                stage['error'] = stage_error(conn, name, view.number or number, stage['id'])
+            except JenkinsException:
+                logger.exception('unable to get the steps of stage %s of %s #%s', stage['name'], name, number)
+    return changed
+
+
+def stage_key(conn, name, number):
+    return (conn.instance, conn.username, name, str(number))
+
+
+def pipeline_stages(conn, name, number):
+    """
+    The stages of a pipeline build along with the ones that changed since the
+    last time, reusing what was already fetched for the same build so that a
+    complete build costs no request at all. Like log tails, views are kept per
+    Jenkins user.
+    """
+    number = str(number)
+    view = stage_views.get(stage_key(conn, name, number)) if number != 'lastBuild' else None
+    if view is None:
+        view = StageView()
+    changed = []
+    with view.lock:
+        if not view.complete:
+            try:
+                changed = read_stages(conn, name, number, view)
+            except NotFoundException:
+                # running builds of other kinds of jobs have no stages either
+                view.pipeline = False
+                view.complete = True
+    stage_views.set(stage_key(conn, name, view.number or number), view)
+    if not view.pipeline:
+        raise RuntimeError('build %s of %s has no stages, is it a pipeline job?' % (number, name))
+    return view, changed
+
+
+def stage_label(stage):
+    label = '%s %s %s' % (stage['name'], stage['status'], human_duration(stage['duration'] / 1000.0))
+    if stage['error'] and stage['status'] in FAILED_STAGES:
+        label += ' (%s)' % stage['error']
+    return label
+
+
+def stages_message(name, view):
+    """
+    One line with every stage of a build and how long each took. Past
+    ``JENKINS_STAGES_SHOWN`` stages the successful ones are only counted.
+    """
+    stages = list(view.stages.values())
+    shown = getattr(settings, 'JENKINS_STAGES_SHOWN', 10)
+    header = '%s #%s %s %s' % (name, view.number, view.status, human_duration(view.duration / 1000.0))
+    if not stages:
+        return '%s, no stages yet' % header
+    if len(stages) > shown:
+        done = [stage for stage in stages if stage['status'] == 'SUCCESS']
+        others = [stage_label(stage) for stage in stages if stage['status'] != 'SUCCESS']
+        summary = '%d stages SUCCESS in %s' % (
+            len(done), human_duration(sum(stage['duration'] for stage in done) / 1000.0))
+        return '%s: %s' % (header, ', '.join([summary] + others))
+    return '%s: %s' % (header, ', '.join(stage_label(stage) for stage in stages))
+
+
+def stages(conn, *args, **kw):
+    """
+    Show the stages of a pipeline build (the last one by default), with
+    their status and how long each took. Example usage::
+        !ci stages {job}
+        !ci stages {job} {build number}
+    """
+    args = list(args)
+    args.pop(0)  # get rid of the command
+    name = get_name(conn, args.pop(0))
+    number = args.pop(0) if args else 'lastBuild'
+    if number != 'lastBuild' and not number.isdigit():
+        raise RuntimeError('%s is not a build number' % number)
+    view, _ = pipeline_stages(conn, name, number)
+    return stages_message(name, view)
+
+
+class BuildHistory(object):
+    """
+    The completed builds of a job, kept locally so that repeated stats only
+    need to fetch the builds that happened since the last time. Builds that
+    were still running when fetched are remembered, so that the next fetch
+    goes far enough back to pick them up once they are done.
+    """
+
+    fields = BUILD_FIELDS
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.builds = {}
+        self.running = set()
+        # set once Jenkins returned fewer builds than asked, there is nothing
+        # further back to fetch
+        self.complete = False
+
+    def latest(self):
+        return max(self.builds) if self.builds else 0
+
+    def fetch_depth(self, wanted):
+        """
+        How many of the most recent builds need to be requested from Jenkins
+        """
+        if not self.builds:
+            return wanted
+        if len(self.builds) < min(wanted, self.size) and min(self.builds) > 1 and not self.complete:
+            # asking for more builds than were fetched before
+            return wanted
+        oldest_needed = min([self.latest()] + list(self.running))
+        # a few extra to find out about builds since the last fetch
+        return min(wanted, self.latest() - oldest_needed + 10)
+
+    def update(self, builds):
+        """
+        Merge builds from Jenkins, returning ``True`` if they reach back to what
+        was already known (otherwise some builds in between are missing)
+        """
+        known = self.latest()
+        oldest_needed = min([known + 1] + list(self.running))
+        for info in builds:
+            number = info['number']
+            if info['building']:
+                self.running.add(number)
+                continue
+            self.running.discard(number)
+            queued = [a['queuingDurationMillis'] for a in info.get('actions') or []
+                      if a and 'queuingDurationMillis' in a]
+            self.builds[number] = (
+                info['result'],
+                (info.get('duration') or 0) / 1000.0,
+                queued[0] / 1000.0 if queued else -1,
+            )
+        for number in sorted(self.builds)[:-self.size]:
+            del self.builds[number]
+        return not known or not builds or builds[-1]['number'] <= oldest_needed
+
+    def recent(self, count):
+        numbers = sorted(self.builds, reverse=True)[:count]
+        return [self.builds[n] for n in reversed(numbers)]
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of an already sorted sequence
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def human_duration(seconds):
+    if seconds is None:
+        return 'n/a'
+    seconds = int(seconds)
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+
+
+def build_stats(builds):
+    """
+    Durations, failure rate, flakiness (how often the result flips between
+    passing and failing) and queue times of ``builds`` (oldest first), as
+    returned by :meth:`BuildHistory.recent`
+    """
+    durations = sorted(b[1] for b in builds)
+    queued = sorted(b[2] for b in builds if b[2] >= 0)
+    # aborted and not built results say nothing about the job being healthy
+    outcomes = [b[0] == 'SUCCESS' for b in builds if b[0] not in ('ABORTED', 'NOT_BUILT')]
+    failures = outcomes.count(False)
+    flips = sum(1 for a, b in zip(outcomes, outcomes[1:]) if a != b)
+    return {
+        'builds': len(builds),
+        'p50': percentile(durations, 50),
+        'p95': percentile(durations, 95),
+        'failures': failures,
+        'failure_rate': float(failures) / len(outcomes) if outcomes else 0.0,
+        'flips': flips,
+        'flakiness': float(flips) / (len(outcomes) - 1) if len(outcomes) > 1 else 0.0,
+        'queue_p50': percentile(queued, 50),
+        'queue_p95': percentile(queued, 95),
+    }
+
+
+class BuildCache(object):
+    """
+    Completed builds never change, so they are kept on disk for good (well,
+    until there are more than ``size`` of them, least recently used first).
+    Each build is a small JSON file named after its number, in a directory
+    named after the sha1 of its ``(instance, job)``, so that the cache can be
+    indexed without reading any of them. Only the ``BUILD_FIELDS`` of a build
+    are kept, and nothing is kept if ``path`` is ``None``.
+    """
+
+    def __init__(self, path, size=20000):
+        self.path = os.path.expanduser(path) if path else None
+        self.size = size
+        self.index = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def address(self, instance, name, number):
+        job = hashlib.sha1(json.dumps([instance, name]).encode('utf-8')).hexdigest()
+        number = int(number)
+        return (job, number), os.path.join(self.path, job[:2], job[2:], '%d.json' % number)
+
+    def load(self):
+        """
+        Index what is on disk, oldest used first, from the file names and
+        modification times alone. Needs the lock.
+        """
+        entries = []
+        for directory, _, files in os.walk(self.path):
+            parent, rest = os.path.split(directory)
+            job = os.path.basename(parent) + rest
+            for filename in files:
+                path = os.path.join(directory, filename)
+                number, extension = os.path.splitext(filename)
+                if extension != '.json' or not number.isdigit() or len(job) != 40:
+                    logger.warning('removing stray build cache entry %s', path)
+                    self.remove(path)
+                    continue
+                try:
+                    entries.append((os.path.getmtime(path), (job, int(number)), path))
+                except OSError:
+                    continue
+        self.index = OrderedDict((key, path) for _, key, path in sorted(entries))
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get(self, instance, name, number):
+        if self.path is None:
+            return None
+        key, path = self.address(instance, name, number)
+        with self.lock:
+            if self.index is None:
+                self.load()
+            if key not in self.index:
+                self.misses += 1
+                return None
+            try:
+                with open(path) as f:
+                    record = json.load(f)
+                os.utime(path, None)
+            except (IOError, OSError, ValueError):
+                logger.warning('removing unreadable build cache entry %s', path)
+                del self.index[key]
+                self.remove(path)
+                self.misses += 1
+                return None
+            self.index[key] = self.index.pop(key)
+            self.hits += 1
+        return record['build']
+
+    def put(self, instance, name, info):
+        """
+        Keep ``info`` if it is a completed build, returning whether it was kept
+        """
+        if self.path is None or not info or info.get('building') or info.get('result') is None:
+            return False
+        key, path = self.address(instance, name, info['number'])
+        record = {'key': [instance, name, info['number']], 'build': compact_build(info)}
+        with self.lock:
+            if self.index is None:
+                self.load()
+            if key in self.index:
+                return True
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                # written in full before it is visible, in case the bot dies halfway
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(record, f, separators=(',', ':'))
+                os.rename(path + '.tmp', path)
+            except (IOError, OSError):
+                logger.exception('unable to save %s #%s to the build cache', name, info['number'])
+                return False
+            self.index[key] = path
+            while len(self.index) > self.size:
+                _, oldest = self.index.popitem(last=False)
+                self.remove(oldest)
+        return True
+
+    def recent(self, instance, name, count):
+        """
+        The most recent ``count`` cached builds of a job, newest first
+        """
+        if self.path is None:
+            return []
+        job = self.address(instance, name, 0)[0][0]
+        with self.lock:
+            if self.index is None:
+                self.load()
+            numbers = [number for key, number in self.index if key == job]
+        builds = (self.get(instance, name, number) for number in sorted(numbers, reverse=True)[:count])
+        return [build for build in builds if build is not None]
+
+    def stats(self):
+        return {'entries': len(self.index or ()), 'hits': self.hits, 'misses': self.misses}
+
+
+def compact_build(info):
+    """
+    Just the ``BUILD_FIELDS`` of a build, without the empty actions Jenkins
+    pads the list with
+    """
+    build = dict((k, info[k]) for k in (
+        'number', 'building', 'result', 'duration', 'url', 'builtOn', 'timestamp', 'estimatedDuration',
+    ) if k in info)
+    actions = [dict((k, v) for k, v in action.items() if k in ('parameters', 'queuingDurationMillis'))
+               for action in info.get('actions') or [] if action]
+    build['actions'] = [action for action in actions if action]
+    return build
+
+
+build_cache = BuildCache(
+    getattr(settings, 'JENKINS_BUILD_CACHE', '~/.helga_jenkins/builds'),
+    size=getattr(settings, 'JENKINS_BUILD_CACHE_SIZE', 20000),
+)
+
+
+def build_record(conn, name, number):
+    """
+    A build of a job, from the build cache if it is complete and has been
+    seen before, otherwise from Jenkins
+    """
+    if not str(number).isdigit():
+        raise RuntimeError('%s is not a build number' % number)
+    info = build_cache.get(conn.instance, name, number)
+    if info is not None:
+        return info
+    try:
+        info = jenkins_json(conn, '%s%s/' % (job_url(conn, name), number), tree=BUILD_FIELDS)
+    except NotFoundException:
+        raise RuntimeError('build %s of %s could not be found' % (number, name))
+    build_cache.put(conn.instance, name, info)
+    return info
+
+
+histories = {}
+
+
+def job_history(conn, name, count):
+    """
+    Bring the local history of a job up to date, fetching only the builds
+    that aren't known yet, with a single request most of the time. A new
+    history (after a restart) starts from the builds in the build cache.
+    """
+    key = (conn.instance, name)
+    history = histories.get(key)
+    if history is None:
+        history = histories[key] = BuildHistory(size=getattr(settings, 'JENKINS_HISTORY_SIZE', 1000))
+        history.update(build_cache.recent(conn.instance, name, history.size))
+    depth = history.fetch_depth(count)
+    while True:
+        tree = 'builds[%s]{0,%d}' % (BuildHistory.fields, depth)
+        data = jenkins_json(conn, job_url(conn, name), tree=tree)
+        builds = data.get('builds') or []
+        for info in builds:
+            build_cache.put(conn.instance, name, info)
+        history.complete = history.complete or len(builds) < depth
+        if history.update(builds) or depth >= count or len(builds) < depth:
+            return history
+        # too many builds since the last time, go further back
+        depth = min(depth * 4, count)
+
+
+def stats(conn, *args, **kw):
+    """
+    Report build durations (median and 95th percentile), failure rate,
+    flakiness and queue times for the last builds of a job (100 by default). Example usage::
+        !ci stats {job}
+        !ci stats {job} 500
+    """
+    args = list(args)
+    args.pop(0)  # get rid of the command
+    name = args.pop(0)
+    count = args.pop(0) if args else '100'
+    if not count.isdigit() or not int(count):
+        raise RuntimeError('%s is not a number of builds' % count)
+    count = min(int(count), getattr(settings, 'JENKINS_HISTORY_SIZE', 1000))
+    try:
+        history = job_history(conn, name, count)
+    except NotFoundException:
+        raise not_found(conn, name)
+    builds = history.recent(count)
+    if not builds:
+        return '%s has no completed builds' % name
+    result = build_stats(builds)
+    msg = '%s, last %d builds: duration p50 %s p95 %s, failure rate %.0f%% (%d), flakiness %.0f%% (%d flips)' % (
+        name,
+        result['builds'],
+        human_duration(result['p50']),
+        human_duration(result['p95']),
+        result['failure_rate'] * 100,
+        result['failures'],
+        result['flakiness'] * 100,
+        result['flips'],
+    )
+    if result['queue_p50'] is not None:
+        msg += ', queued p50 %s p95 %s' % (human_duration(result['queue_p50']), human_duration(result['queue_p95']))
+    return msg
+
+
+def queue(conn, *args, **kw):
+    """
+    Show how long the queue is and how busy the executors are, from the last
+    sample taken by the monitor (or right now if the monitor isn't running). Example usage::
+        !ci queue
+    """
+    now = time.time()
+    sample = monitor.latest(conn.instance)
+    interval = getattr(settings, 'JENKINS_MONITOR_INTERVAL', 60)
+    if sample is None or now - sample['time'] > interval * 2:
+        sample = sample_load(conn)
+    msg = 'queue: %d (longest wait %s), executors: %d/%d busy, sampled %s ago' % (
+        sample['queue'],
+        human_duration(sample['longest_wait']),
+        sample['busy'],
+        sample['total'],
+        human_duration(now - sample['time']),
+    )
+    samples = monitor.samples.get(conn.instance) or []
+    if len(samples) > 1:
+        msg += ', peak queue of %d in the last %s' % (
+            max(s['queue'] for s in samples), human_duration(now - samples[0]['time']))
+    return msg
 
 
 def build(jenkins_conn, *args, **kw):
     """
     Trigger a build in Jenkins. Authentication is probably required. Example usage::
         !ci build {job} BRANCH=master RELEASE=True
+        !ci build {job} {job} BRANCH=master
+        !ci build ceph-*-release BRANCH=master
+        !ci build {job} @release FORCE=true
     """
     # blow up if we don't have these
     client = kw['client']
@@ -249,45 +1265,24 @@ def build(jenkins_conn, *args, **kw):
     args = list(args)
     args.pop(0)  # get rid of the command
     name = get_name(jenkins_conn, args.pop(0))
-    info = jenkins_conn.get_job_info(name)
-
-    next_build_number = info['nextBuildNumber']
-
-    params = args_to_dict(args, add_bogus=job_is_parametrized(info))
-    jenkins_conn.build_job(name, parameters=params, token=jenkins_conn.password)
+    params = build_parameters(jenkins_conn, name, args)
+    queue_id = trigger_build(jenkins_conn, name, params)
+    invalidate_job(jenkins_conn, name)
 
-    # we need to wait for a little while before jenkins gets out of the silent
-    # period so that we can ask for information about the build.
-    reactor.callLater(
-        10,
-        async_build_info,
-        jenkins_conn,
-        name,
-        next_build_number,
-        client=client,
-        channel=channel,
-        nick=nick
-    )
-    # now we also need to set a recurring check for the build so that when it
-    # completes the user will get pinged about it.
-    reactor.callLater(
-        60,
-        async_status,
-        jenkins_conn,
-        name,
-        next_build_number,
-        client=client,
-        channel=channel,
-        nick=nick
-    )
+    # report the build as soon as it leaves the queue, then watch it so that
+    # when it completes the user will get pinged about it.
+    track_queue_item(jenkins_conn, name, queue_id, client=client, channel=channel, nick=nick)
 
     raise ResponseNotReady
 
 
 def get_name(conn, name):
-    if conn.job_exists(name):
-        return name
-    raise RuntimeError('%s does not exist (or could not be found) in Jenkins' % name)
+    # the index answers for every job without a request, but it might not
+    # know about a job created since it was fetched
+    with metrics.timed('plugin', conn.instance, 'get_name'):
+        if name in job_index(conn) or cached(conn, name, 'exists', conn.job_exists):
+            return name
+    raise not_found(conn, name)
 
 
 def enable(conn, *args, **kw):
@@ -299,6 +1294,7 @@ def enable(conn, *args, **kw):
     args.pop(0)  # get rid of the command
     name = get_name(conn, args.pop(0))
     conn.enable_job(name)
+    invalidate_job(conn, name)
     return 'enabled job: %s' % name
 
 
@@ -311,10 +1307,191 @@ def disable(conn, *args, **kw):
     args.pop(0)  # get rid of the command
     name = get_name(conn, args.pop(0))
     conn.disable_job(name)
+    invalidate_job(conn, name)
     return 'disabled job: %s' % name
 
 
-def connect(credentials):
+class ConnectionPool(object):
+    """
+    Keeps validated Jenkins connections around so that commands can reuse them
+    instead of building a new ``Jenkins`` object (and doing a ``get_info()``
+    round trip) for every single message.
+
+    Connections are keyed by ``(instance, url, username)``. A connection is
+    re-validated once it is older than ``ttl`` seconds, and it is evicted
+    altogether if it hasn't been used for ``idle`` seconds. ``hits`` and
+    ``misses`` are kept around for inspection.
+    """
+
+    def __init__(self, ttl=300, idle=900, clock=time.time):
+        self.ttl = ttl
+        self.idle = idle
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return a connection for ``key`` if there is one that doesn't need to be
+        re-validated, otherwise ``None``
+        """
+        now = self.clock()
+        self.evict(now)
+        with self.lock:
+            entry = self.connections.get(key)
+            if entry is None or now - entry['validated'] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry['used'] = now
+            return entry['connection']
+
+    def add(self, key, connection):
+        now = self.clock()
+        connection.pool_key = key
+        with self.lock:
+            self.connections[key] = {
+                'connection': connection,
+                'validated': now,
+                'used': now,
+            }
+
+    def discard(self, key):
+        """
+        Drop a connection, usually because Jenkins rejected its credentials,
+        so that the next request builds (and validates) a new one.
+        """
+        with self.lock:
+            self.connections.pop(key, None)
+
+    def evict(self, now=None):
+        now = now or self.clock()
+        with self.lock:
+            for key, entry in list(self.connections.items()):
+                if now - entry['used'] > self.idle:
+                    del self.connections[key]
+
+    def stats(self):
+        return {
+            'connections': len(self.connections),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+pool = ConnectionPool(
+    ttl=getattr(settings, 'JENKINS_CONNECTION_TTL', 300),
+    idle=getattr(settings, 'JENKINS_CONNECTION_IDLE', 900),
+)
+
+
+class PooledBody(object):
+    """
+    The body of a response from the connection pool, raising the socket
+    errors that urllib2 callers expect instead of urllib3's own
+    """
+
+    def __init__(self, response):
+        self.response = response
+
+    def call(self, func, *args):
+        try:
+            return func(*args)
+        except urllib3.exceptions.ReadTimeoutError:
+            raise socket.timeout('timed out')
+        except urllib3.exceptions.HTTPError as error:
+            raise socket.error(str(error))
+
+    def read(self, amt=None):
+        return self.call(self.response.read, amt)
+
+    def readline(self):
+        return self.call(self.response.readline)
+
+    def close(self):
+        # whatever is left of the body has to be read before the connection
+        # can be used for another request
+        self.response.drain_conn()
+        self.response.release_conn()
+
+
+class KeepAliveHandler(BaseHandler):
+    """
+    Sends requests through a ``urllib3`` connection pool, so that the same
+    (keep-alive) connections to Jenkins are used over and over instead of a
+    new TCP and TLS handshake for every request. Everything else (headers,
+    redirects, HTTP errors) is still handled by urllib2, and requests that go
+    through a proxy are left to the default handlers.
+    """
+
+    # before the default HTTP handlers
+    handler_order = 400
+
+    def __init__(self, manager):
+        self.manager = manager
+
+    def http_open(self, request):
+        if request.has_proxy():
+            return None
+        try:
+            response = self.manager.urlopen(
+                request.get_method(),
+                request.get_full_url(),
+                body=request.get_data(),
+                headers=dict(request.header_items()),
+                redirect=False,
+                retries=False,
+                preload_content=False,
+                timeout=request.timeout,
+            )
+        except urllib3.exceptions.TimeoutError:
+            raise URLError('timed out')
+        except urllib3.exceptions.HTTPError as error:
+            raise URLError(str(error))
+        result = addinfourl(PooledBody(response), response.headers, request.get_full_url(), response.status)
+        result.msg = response.reason
+        return result
+
+    https_open = http_open
+
+
+opener = build_opener(KeepAliveHandler(urllib3.PoolManager(
+    num_pools=getattr(settings, 'JENKINS_CONNECTION_HOSTS', 10),
+    maxsize=getattr(settings, 'JENKINS_MAX_CONCURRENCY', 4),
+)))
+
+
+def pooled_open(conn, request, add_crumb=True):
+    """
+    What python-jenkins' ``jenkins_open`` does, raising the same errors, but
+    through :data:`opener` so that the connection is kept alive
+    """
+    if conn.auth:
+        request.add_header('Authorization', conn.auth)
+    if add_crumb:
+        conn.maybe_add_crumb(request)
+    try:
+        response = opener.open(request, timeout=conn.timeout).read()
+    except HTTPError as error:
+        error.close()
+        if error.code in (401, 403, 500):
+            raise JenkinsException(
+                'Error in request. Possibly authentication failed [%s]: %s' % (error.code, error.msg))
+        if error.code == 404:
+            raise NotFoundException('Requested item could not be found')
+        raise
+    except socket.timeout as error:
+        raise TimeoutException('Error in request: %s' % error)
+    except URLError as error:
+        if str(error.reason) == 'timed out':
+            raise TimeoutException('Error in request: %s' % error.reason)
+        raise JenkinsException('Error in request: %s' % error.reason)
+    return response.decode('utf-8')
+
+
+def connect(credentials, instance=None):
     """
     Since a user can have simple authentication with a single user/password or
     define a set of IRC nick to Jenkin's users with API tokens, this helper
@@ -322,40 +1499,1589 @@ def connect(credentials):
 
     If no authentication is configured, just a connection is returned with no
     authentication (probably read-only, depending on Jenkins settings)
+
+    Connections are reused from the pool when possible, so that only new (or
+    expired) ones need the extra request to validate them.
     """
+    key = (instance, credentials['url'], credentials['username'])
+    connection = pool.get(key)
+    if connection is not None:
+        return connection
+
     connection = Jenkins(
         credentials['url'],
         username=credentials['username'],
         password=credentials['password'],
+        timeout=getattr(settings, 'JENKINS_TIMEOUT', 10),
     )
+    connection.username = credentials['username']
     connection.password = credentials['password']
+    connection.instance = instance or credentials['url']
+    # every request python-jenkins makes goes through the keep-alive pool
+    connection.jenkins_open = lambda request, add_crumb=True: pooled_open(connection, request, add_crumb)
+    instrument(connection)
 
     # try an actual request so we can bail if something is off
     connection.get_info()
+    pool.add(key, connection)
 
     return connection
 
 
-sub_commands = {
-    'status': status,
-    'health': health,
-    'builds': builds,
-    'build': build,
-    'enable': enable,
-    'disable': disable,
-}
-
+class TTLCache(object):
+    """
+    A small LRU cache where entries also expire after ``ttl`` seconds. Used to
+    avoid asking Jenkins over and over for job metadata that rarely changes
+    between two commands.
+    """
 
-def parse_instance(arguments):
-    multi = getattr(settings, 'MULTI_JENKINS', None)
-    if multi:
-        instance = arguments[0]
-        if instance in multi.keys():
-            return instance
-    return None
+    missing = object()
 
+    def __init__(self, ttl=30, size=512, clock=time.time):
+        self.ttl = ttl
+        self.size = size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
 
-def parse_credentials(nick, arguments, instance=None):
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires < self.clock():
+                self.misses += 1
+                return default
+            # re-insert to mark it as the most recently used
+            self.entries[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (self.clock() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, predicate):
+        with self.lock:
+            for key in [k for k in self.entries if predicate(k)]:
+                del self.entries[key]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
+
+
+class Metrics(object):
+    """
+    Request counts, error counts and latency histograms, for sub-commands
+    (``command``), Jenkins endpoints (``jenkins``) and the plugin's own hot
+    spots (``plugin``). Recording is a lock and a few additions, so it is
+    cheap enough to wrap every call.
+    """
+
+    buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def observe(self, kind, instance, name, seconds, error=False):
+        key = (kind, instance or '', name)
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = {
+                    'count': 0,
+                    'errors': 0,
+                    'sum': 0.0,
+                    'buckets': [0] * (len(self.buckets) + 1),
+                }
+            timing['count'] += 1
+            timing['sum'] += seconds
+            if error:
+                timing['errors'] += 1
+            i = 0
+            while i < len(self.buckets) and seconds > self.buckets[i]:
+                i += 1
+            timing['buckets'][i] += 1
+
+    @contextmanager
+    def timed(self, kind, instance, name):
+        start = self.clock()
+        try:
+            yield
+        except ResponseNotReady:
+            # the sub-command will reply on its own, it didn't fail
+            self.observe(kind, instance, name, self.clock() - start)
+            raise
+        except Exception:
+            self.observe(kind, instance, name, self.clock() - start, error=True)
+            raise
+        self.observe(kind, instance, name, self.clock() - start)
+
+    def percentile(self, timing, percent):
+        """
+        The upper bound of the histogram bucket the percentile falls in
+        (``None`` if it is in the overflow bucket)
+        """
+        wanted = timing['count'] * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, timing['buckets']):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return None
+
+    def select(self, kind):
+        with self.lock:
+            return [(key, dict(timing, buckets=list(timing['buckets'])))
+                    for key, timing in self.timings.items() if key[0] == kind]
+
+
+metrics = Metrics()
+
+
+def instrument(conn):
+    """
+    Time every request python-jenkins makes on ``conn``, by endpoint
+    """
+    jenkins_open = conn.jenkins_open
+
+    def timed_open(request, *args, **kw):
+        with metrics.timed('jenkins', conn.instance, endpoint_name(conn, request.get_full_url())):
+            with circuit(conn.instance).guard():
+                return jenkins_open(request, *args, **kw)
+
+    conn.jenkins_open = timed_open
+    return conn
+
+
+def endpoint_name(conn, url):
+    """
+    Turn a url into an endpoint name that doesn't depend on the job or build,
+    like ``job/*/N/api/json``
+    """
+    if url.startswith(conn.server):
+        url = url[len(conn.server):]
+    parts = url.split('?')[0].strip('/').split('/')
+    for i, part in enumerate(parts):
+        if i and parts[i - 1] == 'job':
+            parts[i] = '*'
+        elif part.isdigit():
+            parts[i] = 'N'
+    return '/'.join(parts) or '/'
+
+
+def seconds_label(seconds):
+    if seconds is None:
+        return 'slow'
+    if seconds < 1:
+        return '%dms' % (seconds * 1000)
+    return '%.1fs' % seconds
+
+
+def cache_stats():
+    """
+    Hit rates of every cache, as ``(cache, instance, stats)`` tuples
+    """
+    stats = [
+        ('connections', '', pool.stats()),
+        ('logs', '', log_tails.stats()),
+        ('stages', '', stage_views.stats()),
+    ]
+    stats.extend(('metadata', instance, cache.stats()) for instance, cache in sorted(metadata_caches.items()))
+    stats.extend(('parameters', instance, cache.stats()) for instance, cache in sorted(parameter_caches.items()))
+    stats.append(('builds', '', build_cache.stats()))
+    return stats
+
+
+def metrics_summary(kind, limit=5, key=lambda timing: timing['count']):
+    parts = []
+    for (_, instance, name), timing in sorted(metrics.select(kind), key=lambda i: key(i[1]), reverse=True)[:limit]:
+        parts.append('%s%s %d calls avg %s p95 %s%s' % (
+            '%s ' % instance if kind == 'jenkins' else '',
+            name,
+            timing['count'],
+            seconds_label(timing['sum'] / timing['count']),
+            seconds_label(metrics.percentile(timing, 95)),
+            ' %d errors' % timing['errors'] if timing['errors'] else '',
+        ))
+    return ', '.join(parts) or 'nothing yet'
+
+
+def metrics_report(conn, *args, **kw):
+    """
+    Show the busiest sub-commands, the slowest Jenkins endpoints and cache hit rates. Example usage::
+        !ci metrics
+    """
+    caches = []
+    for name, instance, stats in cache_stats():
+        if stats['hits'] + stats['misses']:
+            hit_rate = float(stats['hits']) / (stats['hits'] + stats['misses'])
+            caches.append('%s%s %.0f%%' % (name, ' (%s)' % instance if instance else '', hit_rate * 100))
+    return [
+        'commands: %s' % metrics_summary('command'),
+        'slowest endpoints: %s' % metrics_summary(
+            'jenkins', key=lambda timing: timing['sum'] / timing['count']),
+        'cache hit rates: %s' % (', '.join(caches) or 'nothing yet'),
+    ]
+
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text():
+    """
+    All the metrics in the Prometheus text exposition format
+    """
+    lines = [
+        '# HELP helga_jenkins_seconds Time spent in sub-commands, Jenkins endpoints and the plugin',
+        '# TYPE helga_jenkins_seconds histogram',
+    ]
+    errors = []
+    for kind in ('command', 'jenkins', 'plugin'):
+        for (_, instance, name), timing in sorted(metrics.select(kind)):
+            labels = 'kind="%s",instance="%s",name="%s"' % (
+                kind, prometheus_label(instance), prometheus_label(name))
+            cumulative = 0
+            for bound, count in zip(metrics.buckets + ('+Inf',), timing['buckets']):
+                cumulative += count
+                lines.append('helga_jenkins_seconds_bucket{%s,le="%s"} %d' % (labels, bound, cumulative))
+            lines.append('helga_jenkins_seconds_sum{%s} %f' % (labels, timing['sum']))
+            lines.append('helga_jenkins_seconds_count{%s} %d' % (labels, timing['count']))
+            errors.append('helga_jenkins_errors_total{%s} %d' % (labels, timing['errors']))
+    lines.append('# TYPE helga_jenkins_errors_total counter')
+    lines.extend(errors)
+    lines.append('# TYPE helga_jenkins_cache_hits_total counter')
+    lines.append('# TYPE helga_jenkins_cache_misses_total counter')
+    for name, instance, stats in cache_stats():
+        labels = 'cache="%s",instance="%s"' % (name, prometheus_label(instance))
+        lines.append('helga_jenkins_cache_hits_total{%s} %d' % (labels, stats['hits']))
+        lines.append('helga_jenkins_cache_misses_total{%s} %d' % (labels, stats['misses']))
+    lines.append('# HELP helga_jenkins_circuit_open Whether requests to an instance fail fast because it is unreachable')
+    lines.append('# TYPE helga_jenkins_circuit_open gauge')
+    for instance, breaker in sorted(circuits.items()):
+        lines.append('helga_jenkins_circuit_open{instance="%s"} %d' % (
+            prometheus_label(instance), breaker.state != 'closed'))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(resource.Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return prometheus_text()
+
+
+@smokesignal.once('signon')
+def start_metrics(client):
+    """
+    Serve metrics for Prometheus if ``JENKINS_METRICS_PORT`` is configured
+    """
+    port = getattr(settings, 'JENKINS_METRICS_PORT', None)
+    if not port:
+        return
+    root = resource.Resource()
+    root.putChild('metrics', MetricsResource())
+    reactor.listenTCP(
+        port,
+        server.Site(root),
+        interface=getattr(settings, 'JENKINS_METRICS_INTERFACE', '127.0.0.1'),
+    )
+
+
+metadata_caches = {}
+parameter_caches = {}
+log_tails = TTLCache(ttl=600, size=64)
+stage_views = TTLCache(ttl=3600, size=256)
+
+
+def metadata_cache(conn):
+    """
+    The job metadata cache for the instance ``conn`` is connected to
+    """
+    cache = metadata_caches.get(conn.instance)
+    if cache is None:
+        cache = metadata_caches.setdefault(conn.instance, TTLCache(
+            ttl=getattr(settings, 'JENKINS_CACHE_TTL', 30),
+            size=getattr(settings, 'JENKINS_CACHE_SIZE', 512),
+        ))
+    return cache
+
+
+def cached(conn, name, kind, fetch):
+    """
+    Return the cached ``kind`` of metadata for job ``name``, calling
+    ``fetch(name)`` to get it from Jenkins if it isn't cached (or expired)
+    """
+    cache = metadata_cache(conn)
+    value = cache.get((name, kind), TTLCache.missing)
+    if value is TTLCache.missing:
+        value = fetch(name)
+        cache.set((name, kind), value)
+    return value
+
+
+# The only fields each sub-command needs from the job info. Jenkins can
+# return thousands of builds for a job otherwise, which is slow to produce,
+# transfer and parse.
+JOB_TREES = {
+    'status': 'lastBuild[%s],lastCompletedBuild[number,result]' % BUILD_FIELDS,
+    'health': 'healthReport[description]',
+    'builds': 'lastBuild[url],lastSuccessfulBuild[url],lastFailedBuild[url]',
+    'build': ','.join(
+        '%s[parameterDefinitions[name,type,choices,defaultParameterValue[value]]]' % section
+        for section in ('actions', 'property')),
+}
+
+
+def job_info(conn, name, tree=None):
+    """
+    The (cached) job info for ``name``, limited to the ``tree`` fields
+    """
+    def fetch(name):
+        return jenkins_json(conn, job_url(conn, name), tree=tree, depth=0)
+    return cached(conn, name, ('info', tree), fetch)
+
+
+def invalidate_job(conn, name):
+    """
+    Forget everything cached about a job, for when it is known to have
+    changed (e.g. a build was triggered or it was disabled)
+    """
+    metadata_cache(conn).invalidate(lambda key: key[0] == name)
+
+
+def cache(conn, *args, **kw):
+    """
+    Report how well the job metadata cache is doing for this instance. Example usage::
+        !ci cache
+    """
+    cache_stats = metadata_cache(conn).stats()
+    pool_stats = pool.stats()
+    return [
+        'metadata cache: %(entries)s entries, %(hits)s hits, %(misses)s misses' % cache_stats +
+        ' (%.0f%% hit rate)' % (cache_stats['hit_rate'] * 100),
+        'connections: %(connections)s pooled, %(hits)s hits, %(misses)s misses' % pool_stats,
+        'requests: %d coalesced, %d throttled' % (
+            coalescer.coalesced, sum(b.throttled for b in buckets.values())),
+        'messages: %(sent)s sent, %(queued)s queued, %(digested)s notifications digested' % outbox.stats(),
+    ]
+
+
+class TokenBucket(object):
+    """
+    Rate limiter that allows ``rate`` calls per second on average, with
+    bursts of up to ``burst`` calls. Calls over the limit are not rejected,
+    they are told how long to wait for their turn.
+    """
+
+    def __init__(self, rate=10, burst=20, clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.throttled = 0
+
+    def take(self):
+        """
+        Take a token, returning how many seconds to wait before using it
+        """
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        self.throttled += 1
+        return -self.tokens / self.rate
+
+
+class Coalescer(object):
+    """
+    Shares the result of a call with every identical call made while it is
+    still in flight, so that ten people asking for the same status at once
+    cost a single trip to Jenkins. Only used from the reactor thread.
+    """
+
+    def __init__(self):
+        self.pending = {}
+        self.coalesced = 0
+
+    def run(self, key, func, *args, **kw):
+        if key in self.pending:
+            self.coalesced += 1
+            d = defer.Deferred()
+            self.pending[key].append(d)
+            return d
+
+        self.pending[key] = []
+
+        def done(result):
+            for waiting in self.pending.pop(key):
+                waiting.callback(result)
+            return result
+
+        return func(*args, **kw).addBoth(done)
+
+
+class CircuitOpen(RuntimeError):
+    """
+    Raised instead of trying an instance that is known to be unreachable
+    """
+
+
+def is_outage(error):
+    """
+    Whether an error means that Jenkins can't be reached (or is falling
+    over), as opposed to something wrong with the request itself
+    """
+    if isinstance(error, HTTPError):
+        return error.code >= 500
+    if isinstance(error, (URLError, socket.error, HTTPException, TimeoutException)):
+        return True
+    if isinstance(error, JenkinsException) and not isinstance(error, NotFoundException):
+        # python-jenkins turns connection errors and 500s into these
+        message = str(error)
+        return message.startswith(('Error in request: ', 'Error communicating')) or '[500]' in message
+    return False
+
+
+class Circuit(object):
+    """
+    The health of a Jenkins instance. Once ``failures`` requests in a row
+    fail because the instance can't be reached, the circuit opens: calls fail
+    right away for ``backoff`` seconds, which doubles (up to ``max_backoff``)
+    every time it opens again. After that, a single call is let through to
+    probe the instance (half-open), which closes the circuit if it works and
+    opens it again if it doesn't.
+    """
+
+    def __init__(self, name, failures=3, backoff=30, max_backoff=600, probe_timeout=60, clock=time.time):
+        self.name = name
+        self.failures = failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.probe_timeout = probe_timeout
+        self.clock = clock
+        self.state = 'closed'
+        self.consecutive = 0
+        self.trips = 0
+        self.retry_at = 0
+        self.probing_since = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def paused(self):
+        """
+        Whether the circuit is open and it isn't time to probe yet
+        """
+        with self.lock:
+            return self.state == 'open' and self.clock() < self.retry_at
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            now = self.clock()
+            if self.state == 'open' and now < self.retry_at:
+                return False
+            # one probe at a time, unless it got lost
+            if self.probing_since is not None and now - self.probing_since < self.probe_timeout:
+                return False
+            self.state = 'half-open'
+            self.probing_since = now
+            return True
+
+    def release(self, result, since):
+        """
+        Let another call probe the instance if the probe that started at
+        ``since`` finished without ever reaching Jenkins (answered from a
+        cache, say), since it had nothing to report. Passes ``result``
+        through, to be used as a callback.
+        """
+        with self.lock:
+            if self.state == 'half-open' and self.probing_since == since:
+                self.probing_since = None
+        return result
+
+    def message(self):
+        wait = self.retry_at - self.clock()
+        return '%s is unreachable (%s), %s' % (
+            self.name, self.error,
+            'not trying again for %s' % human_duration(wait) if wait > 0 else 'checking if it is back')
+
+    def record_success(self):
+        with self.lock:
+            if self.state != 'closed':
+                logger.info('%s is reachable again', self.name)
+            self.state = 'closed'
+            self.consecutive = 0
+            self.trips = 0
+            self.probing_since = None
+
+    def record_failure(self, error):
+        with self.lock:
+            self.error = error
+            if self.state == 'open':
+                # a request that was already in flight when the circuit
+                # opened, it is the same outage
+                return
+            self.consecutive += 1
+            if self.state == 'half-open' or self.consecutive >= self.failures:
+                self.trips += 1
+                wait = min(self.max_backoff, self.backoff * 2 ** (self.trips - 1))
+                self.state = 'open'
+                self.retry_at = self.clock() + wait
+                self.probing_since = None
+                logger.warning('%s is unreachable (%s), failing fast for %ss', self.name, error, wait)
+
+    @contextmanager
+    def guard(self):
+        """
+        Record how a request to the instance went
+        """
+        try:
+            yield
+        except Exception as error:
+            if is_outage(error):
+                self.record_failure(str(error) or error.__class__.__name__)
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+
+
+def circuit(instance):
+    """
+    The circuit for an instance (by name, or url for the single instance
+    configuration)
+    """
+    breaker = circuits.get(instance)
+    if breaker is None:
+        breaker = circuits.setdefault(instance, Circuit(
+            instance,
+            failures=getattr(settings, 'JENKINS_CIRCUIT_FAILURES', 3),
+            backoff=getattr(settings, 'JENKINS_CIRCUIT_BACKOFF', 30),
+            max_backoff=getattr(settings, 'JENKINS_CIRCUIT_MAX_BACKOFF', 600),
+            probe_timeout=3 * getattr(settings, 'JENKINS_TIMEOUT', 10),
+        ))
+    return breaker
+
+
+def circuit_open(failure):
+    """
+    Errback turning a call that failed fast into the reply for it
+    """
+    failure.trap(CircuitOpen)
+    return failure.getErrorMessage()
+
+
+coalescer = Coalescer()
+semaphores = {}
+buckets = {}
+circuits = {}
+
+
+def defer_to_jenkins(instance, func, *args, **kw):
+    """
+    Run ``func`` in the reactor thread pool, since python-jenkins does
+    blocking HTTP requests that would otherwise freeze the whole bot. At most
+    ``JENKINS_MAX_CONCURRENCY`` calls run at the same time for a given
+    instance, so that a slow Jenkins can't take every thread from the rest,
+    and calls are rate limited per instance with a token bucket
+    (``JENKINS_RATE_LIMIT`` calls per second, in bursts of up to
+    ``JENKINS_RATE_BURST``).
+
+    Returns a ``Deferred`` that fires with the return value of ``func``, or
+    fails right away with ``CircuitOpen`` when the instance is unreachable.
+    """
+    breaker = circuit(instance)
+    if not breaker.allow():
+        return defer.fail(CircuitOpen(breaker.message()))
+    # set when this call is the one probing an unreachable instance
+    probe = breaker.probing_since
+    semaphore = semaphores.get(instance)
+    if semaphore is None:
+        limit = getattr(settings, 'JENKINS_MAX_CONCURRENCY', 4)
+        semaphore = semaphores[instance] = defer.DeferredSemaphore(limit)
+    bucket = buckets.get(instance)
+    if bucket is None:
+        bucket = buckets[instance] = TokenBucket(
+            rate=getattr(settings, 'JENKINS_RATE_LIMIT', 10),
+            burst=getattr(settings, 'JENKINS_RATE_BURST', 20),
+        )
+    wait = bucket.take()
+    if wait:
+        d = task.deferLater(reactor, wait, semaphore.run, threads.deferToThread, func, *args, **kw)
+    else:
+        d = semaphore.run(threads.deferToThread, func, *args, **kw)
+    if probe is not None:
+        d.addBoth(breaker.release, probe)
+    return d
+
+
+def log_failure(failure):
+    if failure.check(CircuitOpen):
+        logger.debug('skipped: %s', failure.getErrorMessage())
+        return
+    logger.error('Jenkins request failed: %s', failure.getTraceback())
+
+
+class Outbox(object):
+    """
+    Everything the plugin says goes through here, so that a wave of
+    notifications can't get the bot kicked for flooding. Lines are sent at
+    ``rate`` per second on average (in bursts of up to ``burst``) from a
+    queue per channel, taking turns so that a busy channel doesn't hold up
+    the others.
+
+    Build notifications for a channel are held for ``window`` seconds, and
+    if ``digest`` or more of them arrive in that time they are merged into a
+    single line like::
+
+        alfredo: 5 builds finished: 4 SUCCESS, 1 FAILURE (ceph/323)
+
+    Only used from the reactor thread.
+    """
+
+    def __init__(self, rate=1, burst=5, window=5, digest=3, clock=time.time, call_later=None):
+        self.rate = float(rate)
+        self.burst = burst
+        self.window = window
+        self.digest = digest
+        self.clock = clock
+        self.call_later = call_later or reactor.callLater
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.queues = OrderedDict()
+        self.pending = {}
+        self.scheduled = None
+        self.sent = 0
+        self.digested = 0
+
+    def send(self, client, channel, lines):
+        self.queues.setdefault(channel, deque()).extend((client, line) for line in lines)
+        if self.scheduled is None:
+            self.drain()
+
+    def drain(self):
+        self.scheduled = None
+        while self.queues:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.scheduled = self.call_later((1 - self.tokens) / self.rate, self.drain)
+                return
+            self.tokens -= 1
+            channel, queue = self.queues.popitem(last=False)
+            client, line = queue.popleft()
+            if queue:
+                # to the back of the line, after the other channels
+                self.queues[channel] = queue
+            self.sent += 1
+            client.msg(channel, line)
+
+    def notify(self, client, channel, lines, label, result, nick=None):
+        """
+        Send a build notification, held for the digest window. ``label``
+        names the build (like ``ceph/323``) so that follow ups can be sent
+        along with it.
+        """
+        if not self.window:
+            return self.send(client, channel, lines)
+        pending = self.pending.get(channel)
+        if pending is None:
+            pending = self.pending[channel] = []
+            self.call_later(self.window, self.flush, client, channel)
+        pending.append({'lines': list(lines), 'label': label, 'result': result, 'nick': nick})
+
+    def follow_up(self, client, channel, label, lines):
+        """
+        More lines about a build (like a log excerpt), which stay with its
+        notification if that is still held, and are left out of a digest
+        """
+        for notification in self.pending.get(channel) or []:
+            if notification['label'] == label:
+                notification['lines'].extend(lines)
+                return
+        self.send(client, channel, lines)
+
+    def flush(self, client, channel):
+        notifications = self.pending.pop(channel, [])
+        if len(notifications) < max(self.digest, 2):
+            for notification in notifications:
+                self.send(client, channel, notification['lines'])
+            return
+        self.digested += len(notifications)
+        self.send(client, channel, [self.summarize(notifications)])
+
+    def summarize(self, notifications):
+        results = OrderedDict()
+        for notification in notifications:
+            results[notification['result']] = results.get(notification['result'], 0) + 1
+        counts = sorted(results.items(), key=lambda item: -item[1])
+        line = '%d builds finished: %s' % (
+            len(notifications), ', '.join('%d %s' % (count, result) for result, count in counts))
+        problems = [n['label'] for n in notifications if n['result'] != 'SUCCESS']
+        if problems:
+            line += ' (%s)' % summarize(problems, limit=5)
+        nicks = []
+        for notification in notifications:
+            if notification['nick'] and notification['nick'] not in nicks:
+                nicks.append(notification['nick'])
+        if nicks:
+            line = '%s: %s' % (', '.join(nicks), line)
+        return line
+
+    def stats(self):
+        return {
+            'queued': sum(len(queue) for queue in self.queues.values()),
+            'sent': self.sent,
+            'digested': self.digested,
+        }
+
+
+outbox = Outbox(
+    rate=getattr(settings, 'JENKINS_SEND_RATE', 1),
+    burst=getattr(settings, 'JENKINS_SEND_BURST', 5),
+    window=getattr(settings, 'JENKINS_DIGEST_WINDOW', 5),
+    digest=getattr(settings, 'JENKINS_DIGEST_MIN', 3),
+)
+
+
+def reply(client, channel, response):
+    """
+    Send a response (a single message or a list of them) to a channel. Must
+    be called from the reactor thread.
+    """
+    if not response:
+        return
+    if not isinstance(response, (list, tuple)):
+        response = [response]
+    outbox.send(client, channel, response)
+
+
+def reply_from_thread(client, channel, response):
+    reactor.callFromThread(reply, client, channel, response)
+
+
+def notify(client, channel, response, label, result, nick=None):
+    """
+    Send a build notification, which may be merged with others arriving at
+    the same time. Must be called from the reactor thread.
+    """
+    if not isinstance(response, (list, tuple)):
+        response = [response]
+    outbox.notify(client, channel, response, label, result, nick=nick)
+
+
+def notify_from_thread(client, channel, response, label, result, nick=None):
+    reactor.callFromThread(notify, client, channel, response, label, result, nick=nick)
+
+
+def call_later_from_thread(delay, conn, func, *args, **kw):
+    """
+    Schedule ``func(conn, *args, **kw)`` to run in a thread after ``delay``
+    seconds. Meant to be called from a thread, since ``callLater`` is not
+    thread safe.
+    """
+    def run():
+        d = defer_to_jenkins(conn.instance, func, conn, *args, **kw)
+        d.addErrback(log_failure)
+
+    reactor.callFromThread(reactor.callLater, delay, run)
+
+
+class BuildWatcher(object):
+    """
+    Keeps track of every build that someone is waiting on, and polls Jenkins
+    for all of them from a single loop instead of one ``callLater`` chain per
+    build.
+
+    All the watched builds of a job are fetched together with a single
+    ``tree`` projected request. How often a job is polled depends on how long
+    its builds usually take (Jenkins' ``estimatedDuration``), so a build that
+    is expected to finish soon is polled often and a long one is left alone
+    until it gets close to finishing.
+    """
+
+    tree = 'builds[%s]{0,%%d}' % BUILD_FIELDS
+
+    def __init__(self, tick=5, min_interval=10, max_interval=300, clock=time.time, store=None,
+                 stage_progress=False):
+        self.tick_interval = tick
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.clock = clock
+        self.store = store
+        # tell watchers about each stage of a pipeline build as it finishes
+        self.stage_progress = stage_progress
+        # when Jenkins pushes build events, polling is only a fallback for
+        # builds that haven't had an event after this many seconds
+        self.push_timeout = None
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.loop = None
+
+    def watch(self, conn, name, number, client, channel, nick, persist=True):
+        """
+        Start watching a build, ``nick`` will get notified in ``channel`` when
+        it completes. Safe to call from any thread.
+
+        Unless ``persist`` is ``False`` the build is also saved to the store
+        so that it is watched again if the bot restarts.
+        """
+        key = (conn.instance, name)
+        if persist and self.store is not None:
+            self.store.add(conn.instance, name, number, channel, nick)
+        with self.lock:
+            entry = self.jobs.setdefault(key, {
+                'conn': conn,
+                'builds': {},
+                'latest': number,
+                'next_poll': self.clock() + (self.push_timeout or self.min_interval),
+                'polling': False,
+            })
+            entry['conn'] = conn
+            entry['latest'] = max(entry['latest'], number)
+            entry['builds'].setdefault(number, []).append((client, channel, nick))
+        reactor.callFromThread(self.start)
+
+    def start(self):
+        if self.loop is None:
+            self.loop = task.LoopingCall(self.tick)
+            self.loop.start(self.tick_interval, now=False)
+
+    def due(self):
+        """
+        The jobs that need to be polled now, which are flagged so that a slow
+        response doesn't cause the same job to be polled twice.
+        """
+        now = self.clock()
+        keys = []
+        with self.lock:
+            for key, entry in self.jobs.items():
+                # builds on an unreachable instance wait for it to come back
+                if not entry['polling'] and entry['next_poll'] <= now and not circuit(key[0]).paused():
+                    entry['polling'] = True
+                    keys.append(key)
+        return keys
+
+    def tick(self):
+        for key in self.due():
+            d = defer_to_jenkins(key[0], self.poll, key)
+            d.addErrback(self.skipped, key)
+            d.addErrback(log_failure)
+
+    def skipped(self, failure, key):
+        """
+        The instance is being probed by some other call, try again later
+        """
+        failure.trap(CircuitOpen)
+        with self.lock:
+            entry = self.jobs.get(key)
+            if entry is not None:
+                entry['polling'] = False
+
+    def poll(self, key):
+        entry = self.jobs.get(key)
+        if entry is None or not entry['builds']:
+            # an event from Jenkins got here first
+            return
+        try:
+            oldest = min(entry['builds'])
+            data = jenkins_json(
+                entry['conn'],
+                job_url(entry['conn'], key[1]),
+                tree=self.tree % (entry['latest'] - oldest + 10),
+            )
+            finished = self.process(key, data.get('builds', []))
+        except Exception:
+            with self.lock:
+                entry['next_poll'] = self.clock() + self.max_interval
+                entry['polling'] = False
+            raise
+        for info, watchers in finished:
+            build_cache.put(key[0], key[1], info)
+            if self.store is not None:
+                self.store.remove(key[0], key[1], info['number'])
+            excerpt = []
+            if info['result'] == 'FAILURE':
+                try:
+                    excerpt = failure_excerpt(entry['conn'], key[1], info['number'])
+                except Exception:
+                    logger.exception('unable to get the log of %s #%s', key[1], info['number'])
+            label = '%s/%s' % (key[1], info['number'])
+            for client, channel, nick in watchers:
+                notify_from_thread(
+                    client, channel, [completion_message(key[1], info, nick)] + excerpt, label, info['result'], nick)
+        if self.stage_progress:
+            self.progress(key, entry, [info['number'] for info in data.get('builds', []) if info['building']])
+
+    def progress(self, key, entry, numbers):
+        """
+        Tell whoever is waiting on a running pipeline build about the stages
+        that finished since the last poll. The first poll of a build only
+        sets the baseline, so watching a build halfway through doesn't list
+        all the stages that are already done.
+        """
+        for number in numbers:
+            with self.lock:
+                watchers = list(entry['builds'].get(number) or [])
+            if not watchers:
+                continue
+            baseline = stage_views.get(stage_key(entry['conn'], key[1], number)) is None
+            try:
+                view, changed = pipeline_stages(entry['conn'], key[1], number)
+            except RuntimeError:
+                # not a pipeline job
+                continue
+            except Exception:
+                logger.exception('unable to get the stages of %s #%s', key[1], number)
+                continue
+            done = [stage_label(stage) for stage in changed if stage['status'] not in RUNNING_STAGES]
+            if baseline or not done:
+                continue
+            message = '%s #%s: %s' % (key[1], number, ', '.join(done))
+            running = view.running()
+            if running:
+                message += ', now at %s' % ', '.join(stage['name'] for stage in running)
+            for client, channel, nick in watchers:
+                reply_from_thread(client, channel, '%s: %s' % (nick, message))
+
+    def process(self, key, builds):
+        """
+        Go through the builds returned by Jenkins, and return the ones that
+        finished along with who was waiting on them. Also works out when the
+        job needs to be polled next.
+        """
+        now = self.clock()
+        finished = []
+        with self.lock:
+            entry = self.jobs.get(key)
+            if entry is None:
+                return finished
+            intervals = []
+            for info in builds:
+                entry['latest'] = max(entry['latest'], info['number'])
+                if info['number'] not in entry['builds']:
+                    continue
+                if info['building']:
+                    intervals.append(self.interval(info, now))
+                else:
+                    finished.append((info, entry['builds'].pop(info['number'])))
+            entry['polling'] = False
+            if not entry['builds']:
+                del self.jobs[key]
+            else:
+                # builds that haven't started yet use the shortest interval
+                entry['next_poll'] = now + min(intervals or [self.min_interval])
+        return finished
+
+    def interval(self, info, now):
+        """
+        Seconds to wait before polling a running build again, based on how
+        much of the estimated duration is left.
+        """
+        estimated = info.get('estimatedDuration') or 0
+        remaining = (info.get('timestamp', 0) + estimated) / 1000.0 - now
+        return min(max(remaining, self.min_interval), self.max_interval)
+
+    def event(self, name, number, phase, url=None):
+        """
+        Handle a build event pushed by Jenkins. A completed build is no longer
+        watched, and is returned along with who was waiting on it. Any other
+        event just tells us the build is alive, so there is no need to poll it
+        for a while.
+        """
+        finished = []
+        with self.lock:
+            for key, entry in list(self.jobs.items()):
+                if key[1] != name or number not in entry['builds']:
+                    continue
+                if not url or not url.startswith(entry['conn'].server):
+                    continue
+                if phase in ('COMPLETED', 'FINALIZED'):
+                    finished.append((key, entry['conn'], entry['builds'].pop(number)))
+                    if not entry['builds']:
+                        del self.jobs[key]
+                elif self.push_timeout:
+                    entry['next_poll'] = max(entry['next_poll'], self.clock() + self.push_timeout)
+        return finished
+
+
+class WatchStore(object):
+    """
+    Saves watched builds in MongoDB so that pending notifications survive a
+    restart of the bot. Documents are tiny: the instance, job, build number
+    and who to tell about it.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def add(self, instance, name, number, channel, nick):
+        self.collection.insert_one({
+            'instance': instance,
+            'job': name,
+            'number': number,
+            'channel': channel,
+            'nick': nick,
+        })
+
+    def remove(self, instance, name, number):
+        self.collection.delete_many({'instance': instance, 'job': name, 'number': number})
+
+    def by_instance(self):
+        """
+        All the saved builds, grouped by the instance they belong to
+        """
+        grouped = {}
+        for doc in self.collection.find():
+            grouped.setdefault(doc['instance'], []).append(doc)
+        return grouped
+
+
+watcher = BuildWatcher(
+    tick=getattr(settings, 'JENKINS_WATCH_TICK', 5),
+    min_interval=getattr(settings, 'JENKINS_WATCH_MIN_INTERVAL', 10),
+    max_interval=getattr(settings, 'JENKINS_WATCH_MAX_INTERVAL', 300),
+    store=WatchStore(db.jenkins_watches) if db is not None else None,
+    stage_progress=getattr(settings, 'JENKINS_STAGE_PROGRESS', False),
+)
+
+
+def catch_up(client, instance, docs):
+    """
+    Resume watching the builds saved for ``instance`` before a restart. The
+    watched builds of each job are checked with a single request for just
+    that job (jobs in folders included), so builds that finished while the
+    bot was down are reported right away and the rest go back to the watcher.
+    """
+    multi_instance = parse_instance([instance])
+    nick = docs[0]['nick']
+    arguments = [multi_instance] if multi_instance else ['status']
+    conn = connect(parse_credentials(nick, arguments, multi_instance), multi_instance)
+
+    numbers = {}
+    for doc in docs:
+        numbers.setdefault(doc['job'], []).append(doc['number'])
+    builds = {}
+    for name, watched in numbers.items():
+        try:
+            data = jenkins_json(conn, job_url(conn, name), tree=BuildWatcher.tree % (max(watched) - min(watched) + 10))
+        except NotFoundException:
+            logger.warning('%s no longer exists, leaving its builds to the watcher', name)
+            continue
+        for info in data.get('builds') or []:
+            builds[(name, info['number'])] = info
+
+    for doc in docs:
+        info = builds.get((doc['job'], doc['number']))
+        if info is not None and not info['building']:
+            watcher.store.remove(instance, doc['job'], doc['number'])
+            message = completion_message(doc['job'], info, doc['nick'])
+            label = '%s/%s' % (doc['job'], doc['number'])
+            notify_from_thread(client, doc['channel'], message, label, info['result'], doc['nick'])
+        else:
+            watcher.watch(conn, doc['job'], doc['number'], client, doc['channel'], doc['nick'], persist=False)
+
+
+@smokesignal.once('signon')
+def resume_watches(client):
+    if watcher.store is None:
+        return
+    for instance, docs in watcher.store.by_instance().items():
+        d = defer_to_jenkins(instance, catch_up, client, instance, docs)
+        d.addErrback(log_failure)
+
+
+def parse_notification(body):
+    """
+    Make sense of the JSON sent by the Jenkins Notification plugin, which
+    looks like::
+
+        {"name": "ceph",
+         "url": "job/ceph/",
+         "build": {"full_url": "http://jenkins.example.com/job/ceph/323/",
+                   "number": 323,
+                   "phase": "COMPLETED",
+                   "status": "FAILURE",
+                   "url": "job/ceph/323/"}}
+
+    The job name is taken from the job url when possible since ``name`` does
+    not include the folders a job is in.
+    """
+    data = json.loads(body)
+    build_data = data['build']
+    parts = [p for p in data.get('url', '').strip('/').split('/') if p]
+    if parts and parts[0] == 'job':
+        name = '/'.join(parts[1::2])
+    else:
+        name = data['name']
+    return {
+        'name': name,
+        'number': int(build_data['number']),
+        'phase': build_data.get('phase'),
+        'result': build_data.get('status'),
+        # needed to tell which instance the build is on
+        'url': build_data['full_url'],
+    }
+
+
+def notify_event(event):
+    """
+    Tell whoever was waiting on a build that Jenkins says has completed
+    """
+    for key, conn, watchers in watcher.event(event['name'], event['number'], event['phase'], event['url']):
+        if watcher.store is not None:
+            d = threads.deferToThread(watcher.store.remove, key[0], key[1], event['number'])
+            d.addErrback(log_failure)
+        info = {'building': False, 'result': event['result'], 'url': event['url']}
+        label = '%s/%s' % (key[1], event['number'])
+        for client, channel, nick in watchers:
+            notify(client, channel, completion_message(key[1], info, nick), label, event['result'], nick)
+        if event['result'] == 'FAILURE':
+            d = defer_to_jenkins(key[0], failure_excerpt, conn, key[1], event['number'])
+            for client, channel, nick in watchers:
+                d.addCallback(
+                    lambda excerpt, client=client, channel=channel, label=label:
+                    excerpt and outbox.follow_up(client, channel, label, excerpt) or excerpt)
+            d.addErrback(log_failure)
+
+
+class NotificationResource(resource.Resource):
+    """
+    Receives the build events posted by the Jenkins Notification plugin
+    """
+
+    isLeaf = True
+
+    def render_POST(self, request):
+        token = getattr(settings, 'JENKINS_WEBHOOK_TOKEN', None)
+        if token and request.args.get('token', [None])[0] != token:
+            request.setResponseCode(403)
+            return 'invalid token'
+        try:
+            event = parse_notification(request.content.read())
+        except (ValueError, KeyError, TypeError):
+            request.setResponseCode(400)
+            return 'invalid notification'
+        notify_event(event)
+        return 'ok'
+
+
+@smokesignal.once('signon')
+def start_listener(client):
+    """
+    Listen for build events from Jenkins if ``JENKINS_WEBHOOK_PORT`` is
+    configured, in which case polling is just a fallback. Anyone who can
+    post events can make the bot report builds, so listening on anything but
+    the loopback interface needs ``JENKINS_WEBHOOK_TOKEN``.
+    """
+    port = getattr(settings, 'JENKINS_WEBHOOK_PORT', None)
+    if not port:
+        return
+    interface = getattr(settings, 'JENKINS_WEBHOOK_INTERFACE', '127.0.0.1')
+    loopback = interface == 'localhost' or interface == '::1' or interface.startswith('127.')
+    if not loopback and not getattr(settings, 'JENKINS_WEBHOOK_TOKEN', None):
+        logger.error('not listening for build events on %r without JENKINS_WEBHOOK_TOKEN', interface or '*')
+        return
+    root = resource.Resource()
+    root.putChild('jenkins', NotificationResource())
+    reactor.listenTCP(port, server.Site(root), interface=interface)
+    watcher.push_timeout = getattr(settings, 'JENKINS_WEBHOOK_FALLBACK', 600)
+
+
+class Subscriptions(object):
+    """
+    Tells channels when the jobs they subscribed to (by name or glob) break or
+    are fixed, whoever started the builds. Every instance with subscriptions
+    is polled with a single request for the last completed build of all its
+    jobs, which is diffed against the previous poll, so the cost is the same
+    no matter how many jobs or channels are subscribed.
+    """
+
+    # aborted builds say nothing about the state of a job
+    ignored = set(['ABORTED', 'NOT_BUILT'])
+
+    def __init__(self, interval=60, store=None):
+        self.interval = interval
+        self.store = store
+        self.patterns = {}
+        self.snapshots = {}
+        self.polling = set()
+        self.client = None
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def subscribe(self, instance, channel, pattern, persist=True):
+        with self.lock:
+            patterns = self.patterns.setdefault(instance, {}).setdefault(channel, set())
+            if pattern in patterns:
+                return False
+            patterns.add(pattern)
+        if persist and self.store is not None:
+            self.store.add(instance, channel, pattern)
+        return True
+
+    def unsubscribe(self, instance, channel, pattern):
+        with self.lock:
+            channels = self.patterns.get(instance, {})
+            if pattern not in channels.get(channel, ()):
+                return False
+            channels[channel].discard(pattern)
+            if not channels[channel]:
+                del channels[channel]
+            if not channels:
+                del self.patterns[instance]
+                self.snapshots.pop(instance, None)
+        if self.store is not None:
+            self.store.remove(instance, channel, pattern)
+        return True
+
+    def subscribed(self, instance, channel):
+        with self.lock:
+            return sorted(self.patterns.get(instance, {}).get(channel, ()))
+
+    def channels_for(self, instance, name):
+        with self.lock:
+            return sorted(
+                channel for channel, patterns in self.patterns.get(instance, {}).items()
+                if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns))
+
+    def tree(self):
+        tree = 'name,lastCompletedBuild[number,result,url]'
+        # every folder level needs its own nesting in the tree
+        for _ in range(getattr(settings, 'JENKINS_FOLDER_DEPTH', 2)):
+            tree = 'name,lastCompletedBuild[number,result,url],jobs[%s]' % tree
+        return 'jobs[%s]' % tree
+
+    def poll(self, instance):
+        """
+        The last completed build of every job of an instance, by job name,
+        with the instance-wide credentials. Runs in a thread.
+        """
+        multi_instance = parse_instance([instance])
+        arguments = [multi_instance] if multi_instance else ['subscriptions']
+        conn = connect(parse_credentials(None, arguments, multi_instance), multi_instance)
+        data = jenkins_json(conn, conn.server, tree=self.tree())
+        builds = {}
+
+        def walk(jobs, folder=''):
+            for job in jobs:
+                name = folder + job['name']
+                if 'jobs' in job:
+                    walk(job['jobs'] or [], folder=name + '/')
+                else:
+                    builds[name] = job.get('lastCompletedBuild')
+
+        walk(data.get('jobs', []))
+        return builds
+
+    def diff(self, instance, builds):
+        """
+        Compare the last completed builds with the previous poll, returning
+        ``(name, build, previous result)`` for the jobs whose result changed.
+        The first poll of an instance only takes the snapshot.
+        """
+        snapshot = self.snapshots.get(instance)
+        current = {}
+        changes = []
+        for name, build in builds.items():
+            previous = snapshot.get(name) if snapshot else None
+            if not build or build.get('result') in self.ignored:
+                if previous:
+                    current[name] = previous
+                continue
+            current[name] = (build['number'], build['result'])
+            if previous and build['number'] != previous[0] and build['result'] != previous[1]:
+                changes.append((name, build, previous[1]))
+        self.snapshots[instance] = current
+        return sorted(changes)
+
+    def message(self, name, build, previous):
+        state = {'FAILURE': 'broken', 'SUCCESS': 'fixed'}.get(build['result'], build['result'].lower())
+        return '%s is %s: build %d %s (was %s). Details at %sconsole' % (
+            name, state, build['number'], build['result'], previous, build['url'])
+
+    def report(self, instance, builds):
+        for name, build, previous in self.diff(instance, builds):
+            for channel in self.channels_for(instance, name):
+                notify(
+                    self.client, channel, self.message(name, build, previous),
+                    '%s/%s' % (name, build['number']), build['result'])
+
+    def tick(self):
+        with self.lock:
+            instances = [i for i in self.patterns if i not in self.polling and not circuit(i).paused()]
+        for instance in instances:
+            # a slow Jenkins shouldn't get a second poll while the first is running
+            self.polling.add(instance)
+            d = defer_to_jenkins(instance, self.poll, instance)
+            d.addCallback(lambda builds, instance=instance: self.report(instance, builds))
+            d.addErrback(log_failure)
+            d.addBoth(lambda _, instance=instance: self.polling.discard(instance))
+
+    def start(self, client):
+        self.client = client
+        if self.loop is None:
+            self.loop = task.LoopingCall(self.tick)
+            self.loop.start(self.interval)
+
+
+class SubscriptionStore(object):
+    """
+    Saves channel subscriptions in MongoDB so that they survive a restart
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def add(self, instance, channel, pattern):
+        self.collection.insert_one({'instance': instance, 'channel': channel, 'pattern': pattern})
+
+    def remove(self, instance, channel, pattern):
+        self.collection.delete_many({'instance': instance, 'channel': channel, 'pattern': pattern})
+
+    def all(self):
+        return list(self.collection.find())
+
+
+subscriptions = Subscriptions(
+    interval=getattr(settings, 'JENKINS_SUBSCRIPTION_INTERVAL', 60),
+    store=SubscriptionStore(db.jenkins_subscriptions) if db is not None else None,
+)
+
+
+@smokesignal.once('signon')
+def resume_subscriptions(client):
+    if subscriptions.store is None:
+        return
+    docs = subscriptions.store.all()
+    for doc in docs:
+        subscriptions.subscribe(doc['instance'], doc['channel'], doc['pattern'], persist=False)
+    if docs:
+        subscriptions.start(client)
+
+
+def subscribe(conn, *args, **kw):
+    """
+    Tell this channel when a job (or any job matching a glob) breaks or is
+    fixed, whoever started the build. Example usage::
+        !ci subscribe {job}
+        !ci subscribe ceph-*-release
+    """
+    channel = kw['channel']
+    patterns = []
+    for pattern in args[1:]:
+        if not is_glob(pattern):
+            pattern = get_name(conn, pattern)
+        elif not job_index(conn).match(pattern):
+            raise RuntimeError('no jobs match %s' % pattern)
+        subscriptions.subscribe(conn.instance, channel, pattern)
+        patterns.append(pattern)
+    reactor.callFromThread(subscriptions.start, kw['client'])
+    return '%s will be told when %s break or get fixed' % (channel, ', '.join(patterns))
+
+
+def unsubscribe(conn, *args, **kw):
+    """
+    Stop telling this channel about a job (or glob) it subscribed to. Example usage::
+        !ci unsubscribe {job}
+    """
+    channel = kw['channel']
+    unknown = [p for p in args[1:] if not subscriptions.unsubscribe(conn.instance, channel, p)]
+    if unknown:
+        return '%s is not subscribed to: %s' % (channel, ', '.join(unknown))
+    return '%s is no longer subscribed to: %s' % (channel, ', '.join(args[1:]))
+
+
+def list_subscriptions(conn, *args, **kw):
+    """
+    List what this channel is subscribed to. Example usage::
+        !ci subscriptions
+    """
+    channel = kw['channel']
+    patterns = subscriptions.subscribed(conn.instance, channel)
+    if not patterns:
+        return '%s is not subscribed to any jobs' % channel
+    return '%s is subscribed to: %s' % (channel, ', '.join(patterns))
+
+
+sub_commands = {
+    'status': status,
+    'health': health,
+    'builds': builds,
+    'build': build,
+    'enable': enable,
+    'disable': disable,
+    'cache': cache,
+    'jobs': jobs,
+    'find': find,
+    'log': console_log,
+    'stages': stages,
+    'stats': stats,
+    'queue': queue,
+    'metrics': metrics_report,
+    'subscribe': subscribe,
+    'unsubscribe': unsubscribe,
+    'subscriptions': list_subscriptions,
+}
+
+# sub-commands that can be called without any arguments
+no_argument_commands = set(['cache', 'jobs', 'queue', 'metrics', 'subscriptions'])
+
+
+class JenkinsSettings(object):
+    """
+    The connection settings, validated and indexed once so that resolving the
+    credentials for a command is a couple of dictionary lookups. Instances
+    are keyed by name (``None`` for the single instance configuration) and
+    hold the url, the fallback ``(username, password)`` and the ones for each
+    IRC nick. Problems are kept, and raised when the broken part is used.
+    """
+
+    names = (
+        'MULTI_JENKINS', 'JENKINS_URL', 'JENKINS_USERNAME', 'JENKINS_PASSWORD', 'JENKINS_CREDENTIALS',
+        'JENKINS_PRESETS',
+    )
+
+    def __init__(self, settings):
+        self.key = self.key_for(settings)
+        self.error = None
+        self.errors = {}
+        self.instances = {}
+        self.presets = dict(getattr(settings, 'JENKINS_PRESETS', None) or {})
+        self.multi = bool(getattr(settings, 'MULTI_JENKINS', None))
+        if self.multi:
+            self.compile_multi(settings.MULTI_JENKINS)
+        else:
+            self.compile_single(settings)
+
+    @classmethod
+    def key_for(cls, settings):
+        return (settings,) + tuple(getattr(settings, name, None) for name in cls.names)
+
+    def is_for(self, settings):
+        # compare identities, since the settings could be changed in place
+        return all(a is b for a, b in zip(self.key, self.key_for(settings)))
+
+    def compile_multi(self, multi):
+        # make sure that configured instances will not collide with supported
+        # sub-commands
+        collisions = sorted(set(multi) & set(sub_commands))
+        if collisions:
+            self.error = (
+                "A configured Jenkins instance ('%s') has the same name as \
+                a sub-command. This is not allowed, that instance needs to \
+                be renamed." % collisions[0]
+            )
+        for name, conf in multi.items():
+            if 'url' not in conf:
+                self.errors[name] = '"url" is a required key for Jenkins instance "%s"' % name
+            nicks = {}
+            for nick, auth in (conf.get('credentials') or {}).items():
+                # per-nick credentials first
+                if auth.get('username'):
+                    nicks[nick] = (auth['username'], auth.get('token'))
+            self.instances[name] = {
+                'url': conf.get('url'),
+                'default': (conf.get('username'), conf.get('password')),
+                'nicks': nicks,
+                'presets': dict(self.presets, **(conf.get('presets') or {})),
+            }
+
+    def compile_single(self, settings):
+        try:
+            url = get_jenkins_url(settings)
+        except RuntimeError as error:
+            self.errors[None] = str(error)
+            url = None
+        nicks = {}
+        for nick, auth in (getattr(settings, 'JENKINS_CREDENTIALS', None) or {}).items():
+            # favor user creds first, fallback to simple creds, and ultimately
+            # fallback to None which is allowed
+            if auth.get('username') and auth.get('token'):
+                nicks[nick] = (auth['username'], auth['token'])
+        self.instances[None] = {
+            'url': url,
+            'default': (getattr(settings, 'JENKINS_USERNAME', None), getattr(settings, 'JENKINS_PASSWORD', None)),
+            'nicks': nicks,
+            'presets': self.presets,
+        }
+
+    def presets_for(self, instance):
+        """
+        Build parameter presets for an instance (by name, or by url for the
+        single instance configuration)
+        """
+        conf = self.instances.get(instance) or self.instances.get(None) or {}
+        return conf.get('presets', self.presets)
+
+    def problems(self):
+        return ([self.error] if self.error else []) + [self.errors[name] for name in sorted(self.errors)]
+
+
+compiled_settings = {}
+
+
+def jenkins_settings():
+    """
+    The compiled settings, compiled again if the settings (or any of the
+    Jenkins ones) were replaced since
+    """
+    compiled = compiled_settings.get('current')
+    if compiled is None or not compiled.is_for(settings):
+        compiled = compiled_settings['current'] = JenkinsSettings(settings)
+    return compiled
+
+
+@smokesignal.on('jenkins_reload')
+def reload_settings(*args, **kw):
+    """
+    Compile the settings again and log anything that is wrong with them.
+    Needed when the settings are changed in place, e.g. a nick is added to
+    a ``credentials`` dictionary; emit the ``jenkins_reload`` signal to do it.
+    """
+    compiled = compiled_settings['current'] = JenkinsSettings(settings)
+    for problem in compiled.problems():
+        logger.error('Jenkins is misconfigured: %s', ' '.join(problem.split()))
+    return compiled
+
+
+@smokesignal.once('signon')
+def check_settings(client):
+    reload_settings()
+
+
+def parse_instance(arguments):
+    config = jenkins_settings()
+    if config.multi and arguments and arguments[0] in config.instances:
+        return arguments[0]
+    return None
+
+
+def parse_credentials(nick, arguments, instance=None):
     """
     A trivial helper to make sense of the arguments passed in, validate them,
     and error accordingly if information is missing or erroneous
@@ -369,89 +3095,66 @@ def parse_credentials(nick, arguments, instance=None):
 
     Would get this function: ``['build', 'job']``
     """
-    parsed = {}
-    # First, look if we have ``MULTI_JENKINS`` set so that we can prioritize that
-    multi = getattr(settings, 'MULTI_JENKINS', None)
-    if multi:
-        # make sure that configured instances will not collide with supported
-        # sub-commands
-        for k in multi.keys():
-            if k in sub_commands.keys():
-                raise RuntimeError(
-                    "A configured Jenkins instance ('%s') has the same name as \
-                    a sub-command. This is not allowed, that instance needs to \
-                    be renamed." % k
-                )
-        # If we didn't raise it means that we should check if the first argument
-        # is a configured Jenkins instance before continuing
-        if arguments[0] in multi.keys():
-            instance = arguments[0]
-            try:
-                parsed['url'] = multi[instance]['url']
-            except KeyError:
-                raise RuntimeError('"url" is a required key for Jenkins instance "%s"' % instance)
+    config = jenkins_settings()
+    if config.error:
+        raise RuntimeError(config.error)
+    # with ``MULTI_JENKINS`` the first argument must be a configured instance
+    name = parse_instance(arguments)
+    if name is not None:
+        instance = name
+    if name in config.errors:
+        raise RuntimeError(config.errors[name])
+
+    conf = config.instances.get(name, {})
+    username, password = conf.get('nicks', {}).get(nick) or conf.get('default', (None, None))
+    parsed = {'url': conf.get('url'), 'username': username, 'password': password}
+
+    for k in ['username', 'password', 'url']:
+        if parsed[k] is None:
+            if instance:
+                msg = "Unable to connect to %s, missing credential config key: '%s'" % (instance, k)
+            else:
+                msg = "Unable to connect, missing credential config key: '%s'" % k
+            raise RuntimeError(msg)
 
-            # per-nick credentials first
-            credentials = multi[instance].get('credentials', {})
-            user_auth = credentials.get(nick, {})
-            username = user_auth.get('username')
-            password = user_auth.get('token')
+    return parsed
 
-            if not username:
-                # fallback to regular user creds
-                username = multi[instance].get('username')
-                password = multi[instance].get('password')
 
-            parsed['username'] = username
-            parsed['password'] = password
+def all_commands():
+    commands = dict(sub_commands)
+    commands.update(global_commands)
+    return commands
 
-    else:
-        parsed['url'] = get_jenkins_url(settings)
-        username = getattr(settings, 'JENKINS_USERNAME', None)
-        password = getattr(settings, 'JENKINS_PASSWORD', None)
-        credentials = getattr(settings, 'JENKINS_CREDENTIALS', {})
-        user_auth = credentials.get(nick, {})
-
-        # favor user creds first, fallback to simple creds, and ultimately
-        # fallback to None which is allowed
-        user = user_auth.get('username')
-        token = user_auth.get('token')
-        if user and token:
-            username = user
-            password = token
-
-        parsed['username'] = username
-        parsed['password'] = password
 
+def help_for(args):
+    """
+    Build the help response, ``args`` is everything after the ``help``
+    sub-command itself.
+    """
+    commands = all_commands()
+    if not args:  # we just got 'help' so give a few examples of how to use it
+        return (
+            "help is available for subcommands: %s." % ' '.join(commands.keys()),
+            "subcommand help can be requested with: !ci help {subcommand}"
+        )
+    # we got asked for a specific command:
     try:
-        for k in ['username', 'password', 'url']:
-            if parsed[k] is None:
-                raise KeyError(k)
-    except KeyError as missing_key:
-        if instance:
-            msg = 'Unable to connect to %s, missing credential config key: %s' % (instance, missing_key)
-        else:
-            msg = 'Unable to connect, missing credential config key: %s' % (missing_key)
-        raise RuntimeError(msg)
-
-    return parsed
+        func = commands[args[0]]
+    except KeyError:
+        return '%s is not a command, valid ones are: %s' % (args[0], str(commands.keys()))
+    return [i.strip() for i in func.__doc__.strip().split('\n')]
 
 
-@command('jenkins', aliases=['ci'], help='Control Jenkins. See !jenkins help (or !ci help)', priority=0, shlex=True)
-def helga_jenkins(client, channel, nick, message, cmd, args):
-    instance = parse_instance(args)
-    try:
-        credentials = parse_credentials(nick, args, instance)
-    except RuntimeError as error:
-        msg = [
-            "%s is improperly configured to connect to Jenkins" % nick,
-            "An API token and matching IRC nick and Jenkins usernames are required",
-            "Error from plugin was: %s" % str(error)
-        ]
-        return msg
-
+def run_sub_command(credentials, instance, args, client=None, channel=None, nick=None):
+    """
+    Connect to Jenkins and run the sub-command. This does blocking network
+    I/O so it is meant to run in a thread (see :func:`defer_to_jenkins`), and
+    it always returns a response so that errors are reported back to the
+    user.
+    """
     try:
-        conn = connect(credentials)
+        with metrics.timed('plugin', instance, 'connect'):
+            conn = connect(credentials, instance)
     except RuntimeError as error:
         return str(error)
     except JenkinsException as error:
@@ -466,24 +3169,375 @@ def helga_jenkins(client, channel, nick, message, cmd, args):
         ]
         return msg
 
+    try:
+        with metrics.timed('command', conn.instance, args[0]):
+            return sub_commands[args[0]](conn, *args, client=client, channel=channel, nick=nick)
+    except ResponseNotReady:
+        # the sub-command will reply on its own
+        return None
+    except JenkinsException as error:
+        # credentials might have been revoked since the connection was
+        # validated, make sure the next request checks them again
+        if not isinstance(error, NotFoundException):
+            pool.discard(conn.pool_key)
+        return str(error)
+    except (HTTPError, RuntimeError) as error:
+        return str(error)
+
+
+# read-only sub-commands, identical ones that are in flight at the same time
+# can share a single response
+coalesced_commands = set(['status', 'health', 'builds', 'jobs', 'find'])
+
+
+def dispatch(credentials, instance, args, client=None, channel=None, nick=None):
+    """
+    Run the sub-command in a thread, sharing the call with any identical
+    read-only one that is already in flight. Those are answered with the
+    credentials of whoever asked first, which is fine since they don't change
+    anything in Jenkins.
+    """
+    key = instance or credentials['url']
+    if args[0] in coalesced_commands:
+        return coalescer.run(
+            (key, tuple(args)), defer_to_jenkins, key, run_sub_command, credentials, instance, args)
+    return defer_to_jenkins(
+        key, run_sub_command, credentials, instance, args, client=client, channel=channel, nick=nick)
+
+
+# sub-commands that can act on several jobs (or a glob) at once
+fan_out_commands = set(['status', 'health', 'build'])
+
+
+def is_glob(name):
+    return any(ch in name for ch in '*?[')
+
+
+def job_arguments(args):
+    """
+    Split the arguments after the sub-command into job names and the rest
+    (build parameters like ``KEY=VALUE``, presets like ``@release`` and
+    build numbers)
+    """
+    names = [a for a in args if '=' not in a and not a.startswith('@') and not a.isdigit()]
+    extra = [a for a in args if '=' in a or a.startswith('@') or a.isdigit()]
+    return names, extra
+
+
+def expand_jobs(credentials, instance, names):
+    """
+    Turn job names and globs into a list of unique job names, using the job
+    index for the globs. Runs in a thread.
+    """
+    conn = connect(credentials, instance)
+    index = job_index(conn)
+    expanded = []
+    for name in names:
+        for match in (index.match(name) if is_glob(name) else [name]):
+            if match not in expanded:
+                expanded.append(match)
+    limit = getattr(settings, 'JENKINS_MAX_FAN_OUT', 30)
+    if len(expanded) > limit:
+        raise RuntimeError('%d jobs matched, but at most %d can be used at once' % (len(expanded), limit))
+    if not expanded:
+        raise RuntimeError('no jobs matched: %s' % ' '.join(names))
+    return expanded
+
+
+def build_targets(credentials, instance, names):
+    """
+    Split the bare words given to ``build`` into job names and boolean
+    parameters (a bare ``FORCE`` means ``FORCE=true``). Past the first one,
+    only globs and jobs in the job index are job names. Runs in a thread.
+    """
+    index = job_index(connect(credentials, instance))
+    jobs = names[:1] + [name for name in names[1:] if is_glob(name) or name in index]
+    return jobs, [name for name in names[1:] if name not in jobs]
+
+
+@defer.inlineCallbacks
+def fan_out(credentials, instance, args, client=None, channel=None, nick=None):
+    """
+    Run a sub-command for several jobs concurrently (bounded by
+    ``JENKINS_MAX_CONCURRENCY``) and merge their responses, so that the
+    whole thing takes as long as the slowest job instead of the sum of them.
+    """
     sub_command = args[0]
-    if len(args) == 1 and 'help' not in args:
-        return 'need more arguments for sub command: %s' % sub_command
+    names, extra = job_arguments(args[1:])
+    key = instance or credentials['url']
     try:
-        return sub_commands[sub_command](conn, *args, client=client, channel=channel, nick=nick)
+        if sub_command == 'build':
+            names, flags = yield defer_to_jenkins(key, build_targets, credentials, instance, names)
+            extra = flags + extra
+            if len(names) == 1 and not is_glob(names[0]):
+                # just one job after all, with boolean parameters
+                response = yield dispatch(
+                    credentials, instance, [sub_command] + names + extra, client=client, channel=channel, nick=nick)
+                defer.returnValue(response)
+        names = yield defer_to_jenkins(key, expand_jobs, credentials, instance, names)
     except (JenkinsException, HTTPError, RuntimeError) as error:
-        return str(error)
-    except KeyError:
-        if sub_command == 'help':
-            if len(args) == 1:  # we just got 'help' so give a few examples of how to use it
-                return (
-                    "help is available for subcommands: %s." % ' '.join(sub_commands.keys()),
-                    "subcommand help can be requested with: !ci help {subcommand}"
-                )
-            if len(args) > 1:  # we got asked for a specific command:
-                try:
-                    func = sub_commands[args[1]]
-                except KeyError:
-                    return '%s is not a command, valid ones are: %s' % (sub_command, str(sub_commands.keys()))
-                return [i.strip() for i in func.__doc__.strip().split('\n')]
-        return '%s is not a command, valid ones are: %s' % (sub_command, str(sub_commands.keys()))
+        defer.returnValue(str(error))
+
+    def job_failed(failure):
+        log_failure(failure)
+        return 'failed: %s' % failure.getErrorMessage()
+
+    results = yield defer.gatherResults([
+        dispatch(
+            credentials, instance, [sub_command, name] + extra,
+            client=client, channel=channel, nick=nick).addErrback(job_failed)
+        for name in names
+    ])
+
+    lines = []
+    if sub_command == 'build':
+        # builds that were triggered reply on their own once they start, any
+        # other response is an error that needs to be reported
+        triggered = [name for name, result in zip(names, results) if result is None]
+        if triggered:
+            lines.append('triggered %d builds: %s' % (len(triggered), summarize(triggered)))
+        else:
+            lines.append('no builds were triggered')
+    for name, result in zip(names, results):
+        if result is None:
+            continue
+        if not isinstance(result, (list, tuple)):
+            result = [result]
+        for line in result:
+            # some responses already say which job they are about
+            lines.append(line if name in line else '%s: %s' % (name, line))
+    limit = getattr(settings, 'JENKINS_MAX_LINES', 10)
+    if len(lines) > limit:
+        lines = lines[:limit - 1] + ['... and %d more' % (len(lines) - limit + 1)]
+    defer.returnValue(lines)
+
+
+def sample_load(conn):
+    """
+    What the queue and executors of an instance look like right now, with one
+    small projected request for each
+    """
+    queue = jenkins_json(conn, conn.server + 'queue/', tree='items[id,inQueueSince,stuck,task[name]]')
+    computer = jenkins_json(conn, conn.server + 'computer/', tree='busyExecutors,totalExecutors')
+    now = time.time()
+    waits = [now - item['inQueueSince'] / 1000.0 for item in queue.get('items', []) if item.get('inQueueSince')]
+    return {
+        'time': now,
+        'queue': len(queue.get('items', [])),
+        'longest_wait': max(waits) if waits else 0,
+        'busy': computer.get('busyExecutors', 0),
+        'total': computer.get('totalExecutors', 0),
+    }
+
+
+def failing_jobs(conn):
+    """
+    Names of the jobs whose last build failed (Jenkins colors them red)
+    """
+    tree = 'name,color'
+    for _ in range(getattr(settings, 'JENKINS_FOLDER_DEPTH', 2)):
+        tree = 'name,color,jobs[%s]' % tree
+    data = jenkins_json(conn, conn.server, tree='jobs[%s]' % tree)
+
+    def walk(jobs, folder=''):
+        for job in jobs:
+            name = folder + job['name']
+            if 'jobs' in job:
+                for failing in walk(job['jobs'] or [], folder=name + '/'):
+                    yield failing
+            elif (job.get('color') or '').startswith('red'):
+                yield name
+
+    return sorted(walk(data.get('jobs', [])))
+
+
+def instance_overview(credentials, instance):
+    """
+    One line summary of what is broken and how busy an instance is. Runs in a
+    thread.
+    """
+    conn = connect(credentials, instance)
+    failing = failing_jobs(conn)
+    load = sample_load(conn)
+    return '%s: %d failing%s, queue: %d, executors: %d/%d busy' % (
+        instance or conn.server,
+        len(failing),
+        ' (%s)' % summarize(failing, limit=5) if failing else '',
+        load['queue'],
+        load['busy'],
+        load['total'],
+    )
+
+
+class Monitor(object):
+    """
+    Samples the queue and executors of every instance at a fixed interval,
+    keeping the last samples in a ring buffer, and posts to a channel when
+    the queue gets too long (or items wait too long) and again when it
+    recovers.
+    """
+
+    def __init__(self, size=60, queue_threshold=10, wait_threshold=600):
+        self.size = size
+        self.queue_threshold = queue_threshold
+        self.wait_threshold = wait_threshold
+        self.samples = {}
+        self.alerting = {}
+        self.loop = None
+
+    def add(self, instance, sample):
+        """
+        Record a sample, returning an alert message if the instance just
+        crossed (or came back under) the thresholds
+        """
+        self.samples.setdefault(instance, deque(maxlen=self.size)).append(sample)
+        over = sample['queue'] >= self.queue_threshold or sample['longest_wait'] >= self.wait_threshold
+        if over == self.alerting.get(instance, False):
+            return None
+        self.alerting[instance] = over
+        if over:
+            return '%s is backed up: %d queued (longest wait %s), executors: %d/%d busy' % (
+                instance, sample['queue'], human_duration(sample['longest_wait']), sample['busy'], sample['total'])
+        return '%s has recovered: %d queued, executors: %d/%d busy' % (
+            instance, sample['queue'], sample['busy'], sample['total'])
+
+    def latest(self, instance):
+        samples = self.samples.get(instance)
+        return samples[-1] if samples else None
+
+    def sample(self, instance):
+        """
+        Take a sample of an instance with the instance-wide credentials. Runs
+        in a thread.
+        """
+        credentials = parse_credentials(None, [instance] if instance else ['queue'], instance)
+        conn = connect(credentials, instance)
+        return conn.instance, sample_load(conn)
+
+    def tick(self, client, channel):
+        for instance in configured_instances():
+            key = instance or get_jenkins_url(settings)
+            if circuit(key).paused():
+                continue
+            d = defer_to_jenkins(key, self.sample, instance)
+            d.addCallback(lambda result: reply(client, channel, self.add(*result)))
+            d.addErrback(log_failure)
+
+    def start(self, client, channel, interval):
+        if self.loop is None:
+            self.loop = task.LoopingCall(self.tick, client, channel)
+            self.loop.start(interval)
+
+
+monitor = Monitor(
+    size=getattr(settings, 'JENKINS_MONITOR_SAMPLES', 60),
+    queue_threshold=getattr(settings, 'JENKINS_QUEUE_THRESHOLD', 10),
+    wait_threshold=getattr(settings, 'JENKINS_QUEUE_WAIT_THRESHOLD', 600),
+)
+
+
+@smokesignal.once('signon')
+def start_monitor(client):
+    """
+    Monitor queues and executors when ``JENKINS_MONITOR_CHANNEL`` is set
+    """
+    channel = getattr(settings, 'JENKINS_MONITOR_CHANNEL', None)
+    if channel:
+        monitor.start(client, channel, getattr(settings, 'JENKINS_MONITOR_INTERVAL', 60))
+
+
+overview_cache = TTLCache(ttl=getattr(settings, 'JENKINS_OVERVIEW_TTL', 30), size=64)
+
+
+def configured_instances():
+    """
+    Names of the ``MULTI_JENKINS`` instances, or ``[None]`` for the single
+    instance configuration
+    """
+    return sorted(jenkins_settings().instances)
+
+
+@defer.inlineCallbacks
+def overview(client=None, channel=None, nick=None):
+    """
+    What is broken right now on every configured Jenkins: failing jobs, queue
+    length and busy executors. Example usage::
+        !ci overview
+    """
+    calls = []
+    for instance in configured_instances():
+        try:
+            credentials = parse_credentials(nick, [instance] if instance else ['overview'], instance)
+        except RuntimeError as error:
+            calls.append(defer.succeed('%s: %s' % (instance, error)))
+            continue
+        # what is visible depends on who is asking
+        key = (instance, credentials['username'])
+        snapshot = overview_cache.get(key)
+        if snapshot is not None:
+            calls.append(defer.succeed(snapshot))
+            continue
+
+        def cache_snapshot(snapshot, key=key):
+            overview_cache.set(key, snapshot)
+            return snapshot
+
+        def failed(failure, instance=instance):
+            return '%s: unable to get an overview: %s' % (instance or 'jenkins', failure.getErrorMessage())
+
+        d = defer_to_jenkins(instance or credentials['url'], instance_overview, credentials, instance)
+        calls.append(d.addCallbacks(cache_snapshot, failed))
+    lines = yield defer.gatherResults(calls)
+    defer.returnValue(lines)
+
+
+# commands that are not about a single instance
+global_commands = {
+    'overview': overview,
+}
+
+
+@command('jenkins', aliases=['ci'], help='Control Jenkins. See !jenkins help (or !ci help)', priority=0, shlex=True)
+def helga_jenkins(client, channel, nick, message, cmd, args):
+    if args and args[0] in global_commands:
+        d = global_commands[args[0]](client=client, channel=channel, nick=nick)
+        d.addCallback(lambda response: reply(client, channel, response))
+        d.addErrback(log_failure)
+        raise ResponseNotReady
+
+    instance = parse_instance(args)
+    try:
+        with metrics.timed('plugin', instance, 'parse_credentials'):
+            credentials = parse_credentials(nick, args, instance)
+    except RuntimeError as error:
+        msg = [
+            "%s is improperly configured to connect to Jenkins" % nick,
+            "An API token and matching IRC nick and Jenkins usernames are required",
+            "Error from plugin was: %s" % str(error)
+        ]
+        return msg
+
+    if instance:
+        args = args[1:]  # get rid of the instance name
+    if not args:
+        return help_for(args)
+
+    sub_command = args[0]
+    if sub_command == 'help':
+        return help_for(args[1:])
+    if sub_command not in sub_commands:
+        return '%s is not a command, valid ones are: %s' % (sub_command, str(all_commands().keys()))
+    if len(args) == 1 and sub_command not in no_argument_commands:
+        return 'need more arguments for sub command: %s' % sub_command
+
+    # Everything from here on talks to Jenkins, which must never happen on
+    # the reactor thread, so reply when the response is ready
+    names, _ = job_arguments(args[1:])
+    if sub_command in fan_out_commands and (len(names) > 1 or any(is_glob(n) for n in names)):
+        d = fan_out(credentials, instance, args, client=client, channel=channel, nick=nick)
+    else:
+        d = dispatch(credentials, instance, args, client=client, channel=channel, nick=nick)
+    d.addErrback(circuit_open)
+    d.addCallback(lambda response: reply(client, channel, response))
+    d.addErrback(log_failure)
+    raise ResponseNotReady
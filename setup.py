@@ -18,7 +18,11 @@ setup(name="helga-jenkins",
       license='MIT',
       packages=find_packages(),
       install_requires=[
-          'python-jenkins',
+          # requests are built with urllib2 and sent through jenkins_open,
+          # which python-jenkins 1.0 changed to take requests.Request
+          'python-jenkins<1.0',
+          # keep-alive connections, 2.0 dropped Python 2
+          'urllib3<2',
       ],
       entry_points = dict(
           helga_plugins = [
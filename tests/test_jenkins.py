@@ -1,12 +1,37 @@
+import json
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from io import BytesIO
+from urllib import unquote
+from urllib2 import Request
 from helga_jenkins import get_jenkins_url
 import helga_jenkins
 import pytest
+from twisted.internet import defer
+from twisted.web.test.requesthelper import DummyRequest
 
 
 class FakeSettings(object):
     pass
 
 
+@pytest.fixture(autouse=True)
+def outbox(monkeypatch):
+    """
+    Send everything right away, without pacing or digests
+    """
+    monkeypatch.setattr(helga_jenkins, 'outbox', helga_jenkins.Outbox(rate=1000, burst=1000, window=0))
+
+
+@pytest.fixture(autouse=True)
+def build_cache(monkeypatch, tmpdir):
+    cache = helga_jenkins.BuildCache(str(tmpdir.join('builds')))
+    monkeypatch.setattr(helga_jenkins, 'build_cache', cache)
+    return cache
+
+
 class TestSettings(object):
     def test_missing_jenkins_url(self):
         settings = FakeSettings()
@@ -155,16 +180,1743 @@ class TestParseCredentials(object):
         assert result['password'] == 'secret'
 
 
-class TestJobIsParametrized(object):
+class TestJenkinsSettings(object):
+
+    def setup(self):
+        helga_jenkins.settings = FakeSettings()
+        helga_jenkins.settings.MULTI_JENKINS = {
+            'prod': {
+                'url': 'http://ci.example.com',
+                'username': 'admin',
+                'password': 'secret',
+                'credentials': {'ktdreyer': {'username': 'kdreyer', 'token': 'lkjh234hjasdf00'}},
+            },
+            'test': {'username': 'admin'},
+        }
+
+    def teardown(self):
+        helga_jenkins.settings = FakeSettings()
+
+    def test_compiled_once(self):
+        compiled = helga_jenkins.jenkins_settings()
+        helga_jenkins.parse_credentials('ktdreyer', ['prod', 'status', 'job'])
+        assert helga_jenkins.jenkins_settings() is compiled
+        assert compiled.instances['prod']['nicks'] == {'ktdreyer': ('kdreyer', 'lkjh234hjasdf00')}
+
+    def test_compiled_again_for_new_settings(self):
+        compiled = helga_jenkins.jenkins_settings()
+        helga_jenkins.settings.MULTI_JENKINS = {'stage': {'url': 'http://stage.example.com'}}
+        assert helga_jenkins.jenkins_settings() is not compiled
+        assert helga_jenkins.parse_instance(['stage', 'status']) == 'stage'
+        assert helga_jenkins.parse_instance(['prod', 'status']) is None
+
+    def test_reload_picks_up_changes_in_place(self):
+        helga_jenkins.jenkins_settings()
+        helga_jenkins.settings.MULTI_JENKINS['prod']['credentials']['alfredo'] = {
+            'username': 'adeza', 'token': 'asdf1234'}
+        helga_jenkins.reload_settings()
+        result = helga_jenkins.parse_credentials('alfredo', ['prod', 'status', 'job'])
+        assert (result['username'], result['password']) == ('adeza', 'asdf1234')
+
+    def test_problems_are_logged_on_reload(self, monkeypatch):
+        logged = []
+        monkeypatch.setattr(helga_jenkins.logger, 'error', lambda *args: logged.append(args[0] % args[1:]))
+        helga_jenkins.reload_settings()
+        assert logged == [
+            'Jenkins is misconfigured: "url" is a required key for Jenkins instance "test"']
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestConnectionPool(object):
+
+    def setup(self):
+        self.clock = FakeClock()
+        self.pool = helga_jenkins.ConnectionPool(ttl=60, idle=300, clock=self.clock)
+        self.key = ('prod', 'http://ci.example.com', 'alfredo')
+
+    def test_miss_on_empty_pool(self):
+        assert self.pool.get(self.key) is None
+        assert self.pool.misses == 1
+
+    def test_hit_reuses_connection(self):
+        conn = FakeSettings()
+        self.pool.add(self.key, conn)
+        assert self.pool.get(self.key) is conn
+        assert self.pool.hits == 1
+        assert conn.pool_key == self.key
+
+    def test_needs_validation_after_ttl(self):
+        self.pool.add(self.key, FakeSettings())
+        self.clock.now += 61
+        assert self.pool.get(self.key) is None
+
+    def test_idle_connections_are_evicted(self):
+        self.pool.add(self.key, FakeSettings())
+        self.clock.now += 301
+        self.pool.evict()
+        assert self.pool.stats()['connections'] == 0
+
+    def test_discard(self):
+        self.pool.add(self.key, FakeSettings())
+        self.pool.discard(self.key)
+        assert self.pool.get(self.key) is None
+
+
+class KeepAliveJenkins(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.append(self.client_address)
+        status, body = (200, '{"mode": "NORMAL"}') if self.path == '/api/json' else (404, 'nope')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class TestKeepAlive(object):
+
+    def setup(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveJenkins)
+        self.httpd.clients = []
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.conn = FakeSettings()
+        self.conn.server = 'http://127.0.0.1:%d/' % self.httpd.server_address[1]
+        self.conn.auth = None
+        self.conn.timeout = 5
+
+    def teardown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_connection_is_reused(self):
+        for _ in range(3):
+            response = helga_jenkins.pooled_open(self.conn, Request(self.conn.server + 'api/json'), add_crumb=False)
+            assert json.loads(response) == {'mode': 'NORMAL'}
+        assert len(set(self.httpd.clients)) == 1
+
+    def test_connection_is_reused_after_an_error(self):
+        with pytest.raises(helga_jenkins.NotFoundException):
+            helga_jenkins.pooled_open(self.conn, Request(self.conn.server + 'job/nope/api/json'), add_crumb=False)
+        response = helga_jenkins.pooled_open(self.conn, Request(self.conn.server + 'api/json'), add_crumb=False)
+        assert json.loads(response) == {'mode': 'NORMAL'}
+        assert len(set(self.httpd.clients)) == 1
+
+    def test_same_errors_as_python_jenkins(self):
+        with pytest.raises(helga_jenkins.NotFoundException):
+            helga_jenkins.pooled_open(self.conn, Request(self.conn.server + 'job/nope/api/json'), add_crumb=False)
+        self.conn.server = 'http://127.0.0.1:1/'
+        with pytest.raises(helga_jenkins.JenkinsException) as error:
+            helga_jenkins.pooled_open(self.conn, Request(self.conn.server + 'api/json'), add_crumb=False)
+        assert helga_jenkins.is_outage(error.value)
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def msg(self, channel, message):
+        self.messages.append((channel, message))
+
+
+class TestReply(object):
+
+    def test_single_message(self):
+        client = FakeClient()
+        helga_jenkins.reply(client, '#ci', 'SUCCESS for ceph')
+        assert client.messages == [('#ci', 'SUCCESS for ceph')]
+
+    def test_multiple_messages(self):
+        client = FakeClient()
+        helga_jenkins.reply(client, '#ci', ['one', 'two'])
+        assert client.messages == [('#ci', 'one'), ('#ci', 'two')]
+
+    def test_nothing_to_reply(self):
+        client = FakeClient()
+        helga_jenkins.reply(client, '#ci', None)
+        assert client.messages == []
+
+
+class TestHelp(object):
+
+    def test_general_help(self):
+        result = helga_jenkins.help_for([])
+        assert 'help is available for subcommands' in result[0]
+
+    def test_sub_command_help(self):
+        result = helga_jenkins.help_for(['health'])
+        assert '!ci health {job}' in result
+
+    def test_unknown_sub_command(self):
+        result = helga_jenkins.help_for(['foo'])
+        assert 'foo is not a command' in result
+
+
+class TestRunSubCommand(object):
+
+    def setup(self):
+        self.credentials = {
+            'url': 'http://ci.example.com',
+            'username': 'alfredo',
+            'password': 'secret',
+        }
+        self.conn = FakeSettings()
+        self.conn.instance = 'http://ci.example.com'
+        self.conn.job_exists = lambda name: name == 'ceph'
+        helga_jenkins.pool.add((None, 'http://ci.example.com', 'alfredo'), self.conn)
+        helga_jenkins.job_indexes[self.conn.instance] = helga_jenkins.JobIndex(['ceph-build'])
+
+    def teardown(self):
+        helga_jenkins.pool.connections.clear()
+        helga_jenkins.metadata_caches.clear()
+        helga_jenkins.job_indexes.clear()
+
+    def test_uses_pooled_connection(self):
+        self.conn.enable_job = lambda name: None
+        result = helga_jenkins.run_sub_command(self.credentials, None, ['enable', 'ceph'])
+        assert result == 'enabled job: ceph'
+
+    def test_errors_are_returned(self):
+        result = helga_jenkins.run_sub_command(self.credentials, None, ['enable', 'rook'])
+        assert 'rook does not exist' in result
+
+    def test_missing_job_suggestions(self):
+        result = helga_jenkins.run_sub_command(self.credentials, None, ['enable', 'ceph-buld'])
+        assert result.endswith('did you mean: ceph-build')
+
+    def test_indexed_jobs_need_no_request(self):
+        self.conn.job_exists = None
+        self.conn.enable_job = lambda name: None
+        result = helga_jenkins.run_sub_command(self.credentials, None, ['enable', 'ceph-build'])
+        assert result == 'enabled job: ceph-build'
+
+    def test_job_exists_is_cached(self):
+        calls = []
+        self.conn.job_exists = lambda name: calls.append(name) or True
+        self.conn.enable_job = lambda name: None
+        self.conn.disable_job = lambda name: None
+        helga_jenkins.run_sub_command(self.credentials, None, ['enable', 'ceph'])
+        helga_jenkins.run_sub_command(self.credentials, None, ['disable', 'ceph'])
+        # enabling invalidates what was known about the job
+        assert calls == ['ceph', 'ceph']
+
+    def test_cache_needs_no_arguments(self):
+        result = helga_jenkins.run_sub_command(self.credentials, None, ['cache'])
+        assert result[0].startswith('metadata cache: 0 entries')
+
+
+class TestBuildWatcher(object):
+
+    def setup(self):
+        self.clock = FakeClock()
+        self.watcher = helga_jenkins.BuildWatcher(min_interval=10, max_interval=300, clock=self.clock)
+        self.conn = FakeSettings()
+        self.conn.instance = 'prod'
+        self.watcher.watch(self.conn, 'ceph', 323, 'client', '#ci', 'alfredo')
+        self.key = ('prod', 'ceph')
+
+    def build(self, number, building=False, **kw):
+        info = {'number': number, 'building': building, 'result': 'SUCCESS'}
+        info.update(kw)
+        return info
+
+    def test_finished_build_is_reported_and_unwatched(self):
+        finished = self.watcher.process(self.key, [self.build(323)])
+        assert finished[0][0]['number'] == 323
+        assert finished[0][1] == [('client', '#ci', 'alfredo')]
+        assert self.watcher.jobs == {}
+
+    def test_running_build_keeps_being_watched(self):
+        running = self.build(323, building=True, timestamp=1000 * 1000, estimatedDuration=60 * 1000)
+        assert self.watcher.process(self.key, [running]) == []
+        assert self.watcher.jobs[self.key]['next_poll'] == 1060.0
+
+    def test_one_request_for_many_builds(self):
+        self.watcher.watch(self.conn, 'ceph', 324, 'client', '#ci', 'ktdreyer')
+        finished = self.watcher.process(
+            self.key, [self.build(325), self.build(324), self.build(323, building=True)])
+        assert [info['number'] for info, _ in finished] == [324]
+        assert list(self.watcher.jobs[self.key]['builds']) == [323]
+
+    def test_due_jobs_are_only_polled_once(self):
+        self.clock.now += 10
+        assert self.watcher.due() == [self.key]
+        assert self.watcher.due() == []
+
+    def test_interval_is_bounded(self):
+        long_build = self.build(323, timestamp=1000 * 1000, estimatedDuration=3600 * 1000)
+        overdue = self.build(323, timestamp=0, estimatedDuration=1000)
+        assert self.watcher.interval(long_build, self.clock.now) == 300
+        assert self.watcher.interval(overdue, self.clock.now) == 10
+
+
+class FakeCollection(object):
+
+    def __init__(self):
+        self.docs = []
+
+    def insert_one(self, doc):
+        self.docs.append(doc)
+
+    def delete_many(self, query):
+        self.docs = [
+            d for d in self.docs if any(d[k] != v for k, v in query.items())
+        ]
+
+    def find(self):
+        return list(self.docs)
+
+
+class TestWatchStore(object):
+
+    def setup(self):
+        self.store = helga_jenkins.WatchStore(FakeCollection())
+
+    def test_watched_builds_are_saved(self):
+        conn = FakeSettings()
+        conn.instance = 'prod'
+        watcher = helga_jenkins.BuildWatcher(store=self.store)
+        watcher.watch(conn, 'ceph', 323, 'client', '#ci', 'alfredo')
+        saved = self.store.by_instance()['prod'][0]
+        assert saved['job'] == 'ceph'
+        assert saved['number'] == 323
+        assert saved['nick'] == 'alfredo'
+
+    def test_grouped_by_instance(self):
+        self.store.add('prod', 'ceph', 1, '#ci', 'alfredo')
+        self.store.add('prod', 'ceph', 2, '#ci', 'alfredo')
+        self.store.add('test', 'ceph', 1, '#ci', 'alfredo')
+        grouped = self.store.by_instance()
+        assert len(grouped['prod']) == 2
+        assert len(grouped['test']) == 1
+
+    def test_remove(self):
+        self.store.add('prod', 'ceph', 1, '#ci', 'alfredo')
+        self.store.add('prod', 'ceph', 2, '#ci', 'alfredo')
+        self.store.remove('prod', 'ceph', 1)
+        assert [d['number'] for d in self.store.by_instance()['prod']] == [2]
+
+    def test_catch_up_only_asks_for_watched_jobs(self, monkeypatch):
+        conn = FakeJenkins({
+            'job/ceph/api/json': {'builds': [record(5000)]},
+            'job/team/job/rook/api/json': {'builds': [record(4), record(3, building=True)]},
+        })
+        notified = []
+        monkeypatch.setattr(helga_jenkins, 'parse_instance', lambda arguments: 'prod')
+        monkeypatch.setattr(helga_jenkins, 'parse_credentials', lambda *args: {})
+        monkeypatch.setattr(helga_jenkins, 'connect', lambda credentials, instance: conn)
+        monkeypatch.setattr(helga_jenkins, 'notify_from_thread', lambda *args: notified.append(args[2]))
+        monkeypatch.setattr(helga_jenkins.reactor, 'callFromThread', lambda *args, **kw: None)
+        monkeypatch.setattr(helga_jenkins, 'watcher', helga_jenkins.BuildWatcher(store=self.store))
+        self.store.add('prod', 'ceph', 5000, '#ci', 'alfredo')
+        self.store.add('prod', 'team/rook', 3, '#ci', 'alfredo')
+        helga_jenkins.catch_up('client', 'prod', self.store.by_instance()['prod'])
+        assert sorted(unquote(url).split('?')[0] for url in conn.requests) == [
+            'http://ci.example.com/job/ceph/api/json',
+            'http://ci.example.com/job/team/job/rook/api/json',
+        ]
+        assert all('{0,10}' in unquote(url) for url in conn.requests)
+        assert len(notified) == 1
+        # still running, left to the watcher
+        assert list(helga_jenkins.watcher.jobs) == [('http://ci.example.com/', 'team/rook')]
+
+
+class TestTTLCache(object):
+
+    def setup(self):
+        self.clock = FakeClock()
+        self.cache = helga_jenkins.TTLCache(ttl=30, size=2, clock=self.clock)
+
+    def test_hit(self):
+        self.cache.set(('ceph', 'info'), {'nextBuildNumber': 2})
+        assert self.cache.get(('ceph', 'info')) == {'nextBuildNumber': 2}
+        assert self.cache.stats()['hits'] == 1
+
+    def test_falsy_values_are_cached(self):
+        self.cache.set(('rook', 'exists'), False)
+        assert self.cache.get(('rook', 'exists'), 'missing') is False
+
+    def test_expired(self):
+        self.cache.set(('ceph', 'info'), {})
+        self.clock.now += 31
+        assert self.cache.get(('ceph', 'info')) is None
+        assert self.cache.stats()['misses'] == 1
+
+    def test_least_recently_used_is_dropped(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        assert self.cache.get('b') is None
+        assert self.cache.get('a') == 1
+
+    def test_invalidate(self):
+        self.cache.set(('ceph', 'info'), {})
+        self.cache.set(('rook', 'info'), {})
+        self.cache.invalidate(lambda key: key[0] == 'ceph')
+        assert self.cache.get(('ceph', 'info')) is None
+        assert self.cache.get(('rook', 'info')) == {}
+
+
+class FakeJenkins(object):
+    """
+    Answers ``jenkins_open`` with canned JSON responses, keyed by the URL
+    path, and remembers every request
+    """
+
+    server = 'http://ci.example.com/'
+    instance = 'http://ci.example.com/'
+    username = 'alfredo'
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def jenkins_open(self, request, add_crumb=True):
+        url = request.get_full_url()
+        self.requests.append(url)
+        path = url[len(self.server):].split('?')[0]
+        if path not in self.responses:
+            raise helga_jenkins.NotFoundException('Requested item could not be found')
+        return json.dumps(self.responses[path])
+
+    def job_exists(self, name):
+        return 'job/%s/api/json' % name in self.responses
+
+
+class TestStatus(object):
+
+    def build(self, **kw):
+        info = {
+            'number': 323,
+            'building': False,
+            'result': 'SUCCESS',
+            'builtOn': 'slave-01',
+            'url': 'http://ci.example.com/job/ceph/323/',
+            'actions': [{'parameters': [{'name': 'FORCE', 'value': True}]}],
+        }
+        info.update(kw)
+        return info
+
+    def test_single_request(self):
+        conn = FakeJenkins({'job/ceph/api/json': {'lastBuild': self.build()}})
+        result = helga_jenkins.status(conn, 'status', 'ceph')
+        assert result == (
+            'SUCCESS for ceph on server: slave-01 url: '
+            'http://ci.example.com/job/ceph/323/ params: FORCE=True')
+        assert len(conn.requests) == 1
+        assert 'tree=lastBuild' in conn.requests[0]
+
+    def test_building_reports_previous_result(self):
+        conn = FakeJenkins({'job/ceph/api/json': {
+            'lastBuild': self.build(building=True, result=None, actions=[]),
+            'lastCompletedBuild': {'number': 322, 'result': 'FAILURE'}}})
+        result = helga_jenkins.status(conn, 'status', 'ceph')
+        assert result.startswith('BUILDING ceph on server: slave-01')
+        assert result.endswith('(previous: FAILURE)')
+
+    def test_job_in_folder(self):
+        conn = FakeJenkins({'job/ceph/job/release/api/json': {'lastBuild': self.build()}})
+        assert helga_jenkins.status(conn, 'status', 'ceph/release').startswith('SUCCESS')
+
+    def test_missing_job(self):
+        conn = FakeJenkins({})
+        with pytest.raises(RuntimeError) as error:
+            helga_jenkins.status(conn, 'status', 'rook')
+        assert 'rook does not exist' in str(error.value)
+
+    def test_no_builds(self):
+        conn = FakeJenkins({'job/ceph/api/json': {'lastBuild': None}})
+        with pytest.raises(RuntimeError) as error:
+            helga_jenkins.status(conn, 'status', 'ceph')
+        assert 'ceph has no builds yet' in str(error.value)
+
+
+class TestJobIndex(object):
+
+    def setup(self):
+        self.index = helga_jenkins.JobIndex([
+            'ceph-build', 'ceph-release', 'ceph-docs', 'Ceph-Upper', 'rook', 'teuthology/nightly'])
+
+    def test_contains(self):
+        assert 'ceph-docs' in self.index
+        assert 'Ceph-Upper' in self.index
+        assert 'ceph-upper' not in self.index
+        assert 'ceph' not in self.index
+
+    def test_prefix_is_case_insensitive(self):
+        assert self.index.prefix('ceph') == ['ceph-build', 'ceph-docs', 'ceph-release', 'Ceph-Upper']
+
+    def test_search(self):
+        assert self.index.search('night') == ['teuthology/nightly']
+
+    def test_match_glob(self):
+        assert self.index.match('ceph-*e') == ['ceph-release']
+
+    def test_suggest(self):
+        assert self.index.suggest('ceph-relase') == ['ceph-release']
+
+    def test_from_jobs_flattens_folders(self):
+        jobs = [
+            {'name': 'rook'},
+            {'name': 'teuthology', 'jobs': [{'name': 'nightly'}, {'name': 'weekly', 'jobs': []}]},
+        ]
+        assert helga_jenkins.JobIndex.from_jobs(jobs) == ['rook', 'teuthology/nightly']
+
+
+class TestJobs(object):
+
+    def setup(self):
+        self.conn = FakeJenkins({'api/json': {'jobs': [
+            {'name': 'ceph-build'}, {'name': 'ceph-release'}, {'name': 'rook'}]}})
+
+    def teardown(self):
+        helga_jenkins.job_indexes.clear()
+
+    def test_list_all(self):
+        assert helga_jenkins.jobs(self.conn, 'jobs') == '3 jobs: ceph-build, ceph-release, rook'
+
+    def test_index_is_reused(self):
+        helga_jenkins.jobs(self.conn, 'jobs', 'ceph')
+        helga_jenkins.find(self.conn, 'find', 'oo')
+        assert len(self.conn.requests) == 1
+
+    def test_find_suggests(self):
+        result = helga_jenkins.find(self.conn, 'find', 'ceph-relaese')
+        assert result == 'no jobs found, did you mean: ceph-release'
+
+
+class TestFanOut(object):
+
+    def setup(self):
+        self.credentials = {
+            'url': 'http://ci.example.com/',
+            'username': 'alfredo',
+            'password': 'secret',
+        }
+        self.conn = FakeJenkins({
+            'api/json': {'jobs': [{'name': 'ceph-build'}, {'name': 'ceph-release'}, {'name': 'rook'}]},
+            'job/ceph-build/api/json': {'healthReport': [{'description': 'Build stability: ok'}]},
+            'job/ceph-release/api/json': {'healthReport': [{'description': 'Build stability: bad'}]},
+        })
+        helga_jenkins.pool.add((None, 'http://ci.example.com/', 'alfredo'), self.conn)
+        self.original = helga_jenkins.defer_to_jenkins
+        # run everything right away instead of in the thread pool
+        helga_jenkins.defer_to_jenkins = lambda instance, func, *a, **kw: defer.maybeDeferred(func, *a, **kw)
+
+    def teardown(self):
+        helga_jenkins.defer_to_jenkins = self.original
+        helga_jenkins.pool.connections.clear()
+        helga_jenkins.metadata_caches.clear()
+        helga_jenkins.job_indexes.clear()
+
+    def fan_out(self, *args):
+        results = []
+        helga_jenkins.fan_out(self.credentials, None, list(args)).addCallback(results.append)
+        return results[0]
+
+    def test_glob(self):
+        result = self.fan_out('health', 'ceph-*')
+        assert result == ['ceph-build: Build stability: ok', 'ceph-release: Build stability: bad']
+
+    def test_errors_are_per_job(self):
+        result = self.fan_out('health', 'ceph-build', 'ceph-docs')
+        assert result[0] == 'ceph-build: Build stability: ok'
+        assert result[1].startswith('ceph-docs does not exist')
+
+    def test_nothing_matched(self):
+        assert self.fan_out('health', 'teuthology-*') == 'no jobs matched: teuthology-*'
+
+    def test_too_many_jobs(self):
+        helga_jenkins.settings.JENKINS_MAX_FAN_OUT = 1
+        try:
+            assert self.fan_out('health', 'ceph-*').startswith('2 jobs matched, but at most 1')
+        finally:
+            del helga_jenkins.settings.JENKINS_MAX_FAN_OUT
+
+    def test_build_reports_jobs_that_were_not_triggered(self, monkeypatch):
+        def build(conn, *args, **kw):
+            if args[1] == 'ceph-release':
+                return 'BRNCH is not a parameter of ceph-release'
+            raise helga_jenkins.ResponseNotReady
+        monkeypatch.setitem(helga_jenkins.sub_commands, 'build', build)
+        result = self.fan_out('build', 'ceph-*', 'rook', 'BRNCH=master')
+        assert result == [
+            'triggered 2 builds: ceph-build, rook',
+            'BRNCH is not a parameter of ceph-release',
+        ]
+
+    def command(self, monkeypatch, *args):
+        calls = []
+
+        def build(conn, *args, **kw):
+            calls.append(args)
+            raise helga_jenkins.ResponseNotReady
+        monkeypatch.setitem(helga_jenkins.sub_commands, 'build', build)
+        monkeypatch.setattr(helga_jenkins, 'parse_instance', lambda args: None)
+        monkeypatch.setattr(helga_jenkins, 'parse_credentials', lambda nick, args, instance: self.credentials)
+        with pytest.raises(helga_jenkins.ResponseNotReady):
+            helga_jenkins.helga_jenkins(FakeClient(), '#ci', 'alfredo', '!ci', 'ci', list(args))
+        return calls
+
+    def test_bare_boolean_parameters_are_not_jobs(self, monkeypatch):
+        assert self.command(monkeypatch, 'build', 'ceph-build', 'FORCE') == [('build', 'ceph-build', 'FORCE')]
+
+    def test_several_jobs_with_a_bare_boolean(self, monkeypatch):
+        calls = self.command(monkeypatch, 'build', 'ceph-build', 'rook', 'FORCE', 'BRANCH=master')
+        assert sorted(calls) == [
+            ('build', 'ceph-build', 'FORCE', 'BRANCH=master'),
+            ('build', 'rook', 'FORCE', 'BRANCH=master'),
+        ]
+
+    def test_build_with_nothing_triggered(self, monkeypatch):
+        monkeypatch.setitem(helga_jenkins.sub_commands, 'build', lambda conn, *args, **kw: 'unauthorized')
+        result = self.fan_out('build', 'ceph-*')
+        assert result == ['no builds were triggered', 'ceph-build: unauthorized', 'ceph-release: unauthorized']
+
+    def test_long_responses_are_trimmed(self):
+        helga_jenkins.settings.JENKINS_MAX_LINES = 2
+        try:
+            result = self.fan_out('health', 'ceph-build', 'ceph-release', 'ceph-build2')
+        finally:
+            del helga_jenkins.settings.JENKINS_MAX_LINES
+        assert result == ['ceph-build: Build stability: ok', '... and 2 more']
+
+
+def notification(phase='COMPLETED', status='FAILURE', number=323, url='job/ceph/'):
+    return json.dumps({
+        'name': url.strip('/').split('/')[-1],
+        'url': url,
+        'build': {
+            'full_url': 'http://ci.example.com/%s%d/' % (url, number),
+            'number': number,
+            'phase': phase,
+            'status': status,
+            'url': '%s%d/' % (url, number),
+        },
+    })
+
+
+class TestParseNotification(object):
+
+    def test_completed(self):
+        event = helga_jenkins.parse_notification(notification())
+        assert event == {
+            'name': 'ceph',
+            'number': 323,
+            'phase': 'COMPLETED',
+            'result': 'FAILURE',
+            'url': 'http://ci.example.com/job/ceph/323/',
+        }
+
+    def test_job_in_folder(self):
+        event = helga_jenkins.parse_notification(notification(url='job/ceph/job/release/'))
+        assert event['name'] == 'ceph/release'
+
+    def test_invalid(self):
+        with pytest.raises(KeyError):
+            helga_jenkins.parse_notification('{"name": "ceph"}')
+
+    def test_build_url_is_required(self):
+        data = json.loads(notification())
+        del data['build']['full_url']
+        with pytest.raises(KeyError):
+            helga_jenkins.parse_notification(json.dumps(data))
+
+
+class TestNotificationResource(object):
+
+    def setup(self):
+        self.original = helga_jenkins.watcher
+        helga_jenkins.watcher = helga_jenkins.BuildWatcher()
+        helga_jenkins.watcher.push_timeout = 600
+        self.client = FakeClient()
+        conn = FakeJenkins({})
+        helga_jenkins.watcher.watch(conn, 'ceph', 323, self.client, '#ci', 'alfredo')
+
+    def teardown(self):
+        helga_jenkins.watcher = self.original
+
+    def post(self, body, **args):
+        request = DummyRequest([])
+        request.method = 'POST'
+        request.content = BytesIO(body)
+        request.args = dict((k, [v]) for k, v in args.items())
+        return helga_jenkins.NotificationResource().render(request), request
+
+    def test_completed_build_is_reported(self):
+        self.post(notification())
+        assert self.client.messages == [
+            ('#ci', 'alfredo FAILURE for ceph url: http://ci.example.com/job/ceph/323/')]
+        assert helga_jenkins.watcher.jobs == {}
+
+    def test_started_build_delays_polling(self):
+        entry = helga_jenkins.watcher.jobs[('http://ci.example.com/', 'ceph')]
+        entry['next_poll'] = 0
+        self.post(notification(phase='STARTED'))
+        assert entry['next_poll'] > time.time() + 500
+        assert self.client.messages == []
+
+    def test_other_builds_are_ignored(self):
+        self.post(notification(number=324))
+        assert self.client.messages == []
+
+    def test_bad_request(self):
+        body, request = self.post('not json')
+        assert request.responseCode == 400
+
+    def test_token(self):
+        helga_jenkins.settings.JENKINS_WEBHOOK_TOKEN = 'secret'
+        try:
+            body, request = self.post(notification(), token='wrong')
+            assert request.responseCode == 403
+            self.post(notification(), token='secret')
+        finally:
+            del helga_jenkins.settings.JENKINS_WEBHOOK_TOKEN
+        assert len(self.client.messages) == 1
+
+    def listen(self, monkeypatch, **options):
+        listening = []
+        monkeypatch.setattr(
+            helga_jenkins.reactor, 'listenTCP', lambda port, site, interface: listening.append(interface))
+        monkeypatch.setattr(helga_jenkins.settings, 'JENKINS_WEBHOOK_PORT', 8765, raising=False)
+        for name, value in options.items():
+            monkeypatch.setattr(helga_jenkins.settings, name, value, raising=False)
+        helga_jenkins.start_listener('client')
+        return listening
+
+    def test_listens_on_loopback_by_default(self, monkeypatch):
+        assert self.listen(monkeypatch) == ['127.0.0.1']
+
+    def test_all_interfaces_need_a_token(self, monkeypatch):
+        assert self.listen(monkeypatch, JENKINS_WEBHOOK_INTERFACE='') == []
+        assert self.listen(monkeypatch, JENKINS_WEBHOOK_INTERFACE='', JENKINS_WEBHOOK_TOKEN='secret') == ['']
+
+
+class TestTrackQueueItem(object):
+
+    def setup(self):
+        self.client = FakeClient()
+        self.scheduled = []
+        self.originals = (
+            helga_jenkins.reply_from_thread, helga_jenkins.call_later_from_thread, helga_jenkins.watcher)
+        helga_jenkins.reply_from_thread = helga_jenkins.reply
+        helga_jenkins.call_later_from_thread = lambda *a, **kw: self.scheduled.append((a, kw))
+        helga_jenkins.watcher = helga_jenkins.BuildWatcher()
+
+    def teardown(self):
+        (helga_jenkins.reply_from_thread, helga_jenkins.call_later_from_thread,
+            helga_jenkins.watcher) = self.originals
+
+    def track(self, item, **kw):
+        conn = FakeJenkins({'queue/item/7/api/json': item})
+        helga_jenkins.track_queue_item(conn, 'ceph', 7, client=self.client, channel='#ci', nick='alfredo', **kw)
+
+    def test_started(self):
+        self.track({
+            'inQueueSince': (time.time() - 42) * 1000,
+            'executable': {'number': 323, 'url': 'http://ci.example.com/job/ceph/323/'}})
+        assert self.client.messages == [('#ci', (
+            'alfredo: ceph build #323 started at: http://ci.example.com/job/ceph/323/ (queued for 42s)'))]
+        assert 323 in helga_jenkins.watcher.jobs[('http://ci.example.com/', 'ceph')]['builds']
+
+    def test_still_queued_backs_off(self):
+        self.track({'why': 'Waiting for next available executor', 'executable': None}, delay=4)
+        args, kw = self.scheduled[0]
+        assert args[0] == 4
+        assert kw['delay'] == 8
+        assert self.client.messages == []
+
+    def test_backoff_is_capped(self):
+        self.track({'executable': None}, delay=30)
+        assert self.scheduled[0][1]['delay'] == 30
+
+    def test_cancelled(self):
+        self.track({'cancelled': True, 'executable': None})
+        assert self.client.messages == [('#ci', 'alfredo: ceph build was cancelled while in the queue')]
+
+
+class TestTokenBucket(object):
+
+    def setup(self):
+        self.clock = FakeClock()
+        self.bucket = helga_jenkins.TokenBucket(rate=2, burst=2, clock=self.clock)
+
+    def test_burst_is_free(self):
+        assert [self.bucket.take(), self.bucket.take()] == [0, 0]
+        assert self.bucket.throttled == 0
+
+    def test_over_the_limit_waits(self):
+        self.bucket.take()
+        self.bucket.take()
+        assert self.bucket.take() == 0.5
+        assert self.bucket.take() == 1.0
+        assert self.bucket.throttled == 2
+
+    def test_tokens_come_back(self):
+        self.bucket.take()
+        self.bucket.take()
+        self.clock.now += 1
+        assert self.bucket.take() == 0
+
+
+class TestCoalescer(object):
+
+    def test_identical_calls_share_a_result(self):
+        coalescer = helga_jenkins.Coalescer()
+        calls = []
+        in_flight = defer.Deferred()
+
+        def call(name):
+            calls.append(name)
+            return in_flight
+
+        results = []
+        for _ in range(3):
+            coalescer.run(('prod', 'status', 'ceph'), call, 'ceph').addCallback(results.append)
+        in_flight.callback('SUCCESS for ceph')
+        assert calls == ['ceph']
+        assert results == ['SUCCESS for ceph'] * 3
+        assert coalescer.coalesced == 2
+        assert coalescer.pending == {}
+
+    def test_failures_are_shared(self):
+        coalescer = helga_jenkins.Coalescer()
+        in_flight = defer.Deferred()
+        errors = []
+        for _ in range(2):
+            coalescer.run('key', lambda: in_flight).addErrback(errors.append)
+        in_flight.errback(RuntimeError('boom'))
+        assert len(errors) == 2
+
+    def test_new_call_after_completion(self):
+        coalescer = helga_jenkins.Coalescer()
+        coalescer.run('key', defer.succeed, 1)
+        coalescer.run('key', defer.succeed, 2)
+        assert coalescer.coalesced == 0
+
+
+class FakeResponse(object):
+
+    def __init__(self, body, headers=None):
+        self.body = BytesIO(body)
+        self.headers = headers or {}
+
+    def read(self, size=-1):
+        return self.body.read(size)
+
+    def info(self):
+        return self.headers
+
+    def close(self):
+        self.body.close()
+
+
+class TestLogTail(object):
+
+    def test_keeps_last_lines(self):
+        tail = helga_jenkins.LogTail(lines=2)
+        tail.feed('one\ntwo\nthr')
+        tail.feed('ee\nfour')
+        tail.finish()
+        assert list(tail.lines) == ['three', 'four']
+
+    def test_first_error(self):
+        tail = helga_jenkins.LogTail(lines=1, pattern='ERROR')
+        tail.feed('ok\nERROR: first\nERROR: second\ndone\n')
+        assert tail.error == 'ERROR: first'
+
+    def test_long_lines_are_bounded(self):
+        tail = helga_jenkins.LogTail(lines=1, max_line=5)
+        for _ in range(100):
+            tail.feed('x' * 1000)
+        assert len(tail.partial) == 5
+        tail.finish()
+        assert list(tail.lines) == ['xxxxx']
+
+
+class TestConsoleLog(object):
+
+    def setup(self):
+        self.conn = FakeJenkins({})
+        helga_jenkins.job_indexes[self.conn.instance] = helga_jenkins.JobIndex(['ceph'])
+        self.requests = []
+        self.responses = []
+        self.original = helga_jenkins.jenkins_urlopen
+
+        def urlopen(conn, request):
+            self.requests.append(request.get_full_url())
+            return self.responses.pop(0)
+        helga_jenkins.jenkins_urlopen = urlopen
+
+    def teardown(self):
+        helga_jenkins.jenkins_urlopen = self.original
+        helga_jenkins.log_tails.entries.clear()
+        helga_jenkins.metadata_caches.clear()
+        helga_jenkins.job_indexes.clear()
+
+    def test_tail_and_error(self):
+        body = ''.join('line %d\n' % i for i in range(100)) + 'Traceback: boom\n'
+        self.responses.append(FakeResponse(body, {'X-Text-Size': str(len(body))}))
+        result = helga_jenkins.console_log(self.conn, 'log', 'ceph', '323')
+        assert result[0] == 'last 10 lines of ceph #323:'
+        assert result[-2] == 'Traceback: boom'
+        assert result[-1] == 'first error: Traceback: boom'
+        assert self.requests == ['http://ci.example.com/job/ceph/323/logText/progressiveText?start=0']
+
+    def test_running_build_is_read_incrementally(self):
+        self.responses.append(FakeResponse('one\n', {'X-Text-Size': '4', 'X-More-Data': 'true'}))
+        self.responses.append(FakeResponse('two\n', {'X-Text-Size': '8'}))
+        self.responses.append(FakeResponse('never read'))
+        helga_jenkins.console_log(self.conn, 'log', 'ceph', '323')
+        result = helga_jenkins.console_log(self.conn, 'log', 'ceph', '323')
+        helga_jenkins.console_log(self.conn, 'log', 'ceph', '323')
+        assert result[1:] == ['one', 'two']
+        assert self.requests[1].endswith('progressiveText?start=4')
+        assert len(self.requests) == 2
+
+    def test_not_a_build_number(self):
+        with pytest.raises(RuntimeError):
+            helga_jenkins.console_log(self.conn, 'log', 'ceph', 'last')
+
+    def test_watcher_and_command_share_the_tail(self):
+        self.responses.append(FakeResponse('done\n', {'X-Text-Size': '5'}))
+        helga_jenkins.console_log(self.conn, 'log', 'ceph', '323')
+        assert list(helga_jenkins.log_tail(self.conn, 'ceph', 323).lines) == ['done']
+        assert len(self.requests) == 1
+
+    def test_tails_are_per_user(self):
+        self.responses.append(FakeResponse('done\n', {'X-Text-Size': '5'}))
+        self.responses.append(FakeResponse('done\n', {'X-Text-Size': '5'}))
+        helga_jenkins.console_log(self.conn, 'log', 'ceph', '323')
+        other = FakeJenkins({})
+        other.username = 'ktdreyer'
+        helga_jenkins.job_indexes[other.instance] = helga_jenkins.JobIndex(['ceph'])
+        helga_jenkins.console_log(other, 'log', 'ceph', '323')
+        assert len(self.requests) == 2
+
+    def test_concurrent_reads_dont_duplicate_lines(self):
+        urlopen = helga_jenkins.jenkins_urlopen
+
+        def slow(conn, request):
+            time.sleep(0.05)
+            return urlopen(conn, request)
+        helga_jenkins.jenkins_urlopen = slow
+        self.responses.append(FakeResponse('one\ntwo\n', {'X-Text-Size': '8'}))
+        threads = [threading.Thread(target=helga_jenkins.log_tail, args=(self.conn, 'ceph', 323)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert list(helga_jenkins.log_tail(self.conn, 'ceph', 323).lines) == ['one', 'two']
+        assert len(self.requests) == 1
+
+
+def describe(status, *stages):
+    return {
+        'id': '42', 'status': status, 'durationMillis': 754000,
+        'stages': [
+            {'id': str(i + 6), 'name': name, 'status': stage_status, 'durationMillis': seconds * 1000}
+            for i, (name, stage_status, seconds) in enumerate(stages)
+        ],
+    }
+
+
+class TestStages(object):
+
+    def setup(self):
+        self.conn = FakeJenkins({})
+        helga_jenkins.job_indexes[self.conn.instance] = helga_jenkins.JobIndex(['ceph'])
+
+    def teardown(self):
+        helga_jenkins.stage_views.entries.clear()
+        helga_jenkins.job_indexes.clear()
+
+    def test_stages_with_timing(self):
+        self.conn.responses['job/ceph/42/wfapi/describe'] = describe(
+            'IN_PROGRESS', ('Checkout', 'SUCCESS', 10), ('Build', 'SUCCESS', 482), ('Test', 'IN_PROGRESS', 231))
+        result = helga_jenkins.stages(self.conn, 'stages', 'ceph', '42')
+        assert result == (
+            'ceph #42 IN_PROGRESS 12m34s: Checkout SUCCESS 10s, Build SUCCESS 8m02s, Test IN_PROGRESS 3m51s')
+
+    def test_failed_stage_steps_are_fetched_once(self):
+        self.conn.responses['job/ceph/42/wfapi/describe'] = describe(
+            'FAILED', ('Build', 'SUCCESS', 482), ('Test', 'FAILED', 70))
+        self.conn.responses['job/ceph/42/execution/node/7/wfapi/describe'] = {'stageFlowNodes': [
+            {'name': 'Shell Script', 'status': 'SUCCESS'},
+            {'name': 'Shell Script', 'parameterDescription': 'make check', 'status': 'FAILED',
+             'error': {'message': 'script returned exit code 2'}},
+        ]}
+        first = helga_jenkins.stages(self.conn, 'stages', 'ceph', '42')
+        assert helga_jenkins.stages(self.conn, 'stages', 'ceph', '42') == first
+        assert first.endswith('Test FAILED 1m10s (make check: script returned exit code 2)')
+        # the build is complete, the second time costs nothing
+        assert len(self.conn.requests) == 2
+
+    def test_only_changed_stages_are_reported(self):
+        path = 'job/ceph/42/wfapi/describe'
+        self.conn.responses[path] = describe('IN_PROGRESS', ('Build', 'IN_PROGRESS', 5))
+        view, changed = helga_jenkins.pipeline_stages(self.conn, 'ceph', 42)
+        assert [stage['name'] for stage in changed] == ['Build']
+        self.conn.responses[path] = describe('IN_PROGRESS', ('Build', 'IN_PROGRESS', 65))
+        assert helga_jenkins.pipeline_stages(self.conn, 'ceph', 42)[1] == []
+        self.conn.responses[path] = describe('IN_PROGRESS', ('Build', 'SUCCESS', 90), ('Test', 'IN_PROGRESS', 1))
+        view, changed = helga_jenkins.pipeline_stages(self.conn, 'ceph', 42)
+        assert [(stage['name'], stage['status']) for stage in changed] == [
+            ('Build', 'SUCCESS'), ('Test', 'IN_PROGRESS')]
+        assert [stage['name'] for stage in view.running()] == ['Test']
+
+    def test_many_stages_are_summarized(self, monkeypatch):
+        monkeypatch.setattr(helga_jenkins.settings, 'JENKINS_STAGES_SHOWN', 2, raising=False)
+        self.conn.responses['job/ceph/lastBuild/wfapi/describe'] = describe(
+            'IN_PROGRESS', ('One', 'SUCCESS', 60), ('Two', 'SUCCESS', 60), ('Three', 'IN_PROGRESS', 5))
+        result = helga_jenkins.stages(self.conn, 'stages', 'ceph')
+        assert result == 'ceph #42 IN_PROGRESS 12m34s: 2 stages SUCCESS in 2m00s, Three IN_PROGRESS 5s'
+
+    def test_views_are_per_user(self):
+        self.conn.responses['job/ceph/42/wfapi/describe'] = describe('SUCCESS', ('Build', 'SUCCESS', 10))
+        helga_jenkins.stages(self.conn, 'stages', 'ceph', '42')
+        other = FakeJenkins(self.conn.responses)
+        other.username = 'ktdreyer'
+        helga_jenkins.stages(other, 'stages', 'ceph', '42')
+        assert len(self.conn.requests) == len(other.requests) == 1
+
+    def test_not_a_pipeline(self):
+        with pytest.raises(RuntimeError) as error:
+            helga_jenkins.stages(self.conn, 'stages', 'ceph', '42')
+        assert 'is it a pipeline job?' in str(error.value)
+        with pytest.raises(RuntimeError):
+            helga_jenkins.stages(self.conn, 'stages', 'ceph', '42')
+        assert len(self.conn.requests) == 1
+
+    def test_watchers_hear_about_finished_stages(self, monkeypatch):
+        replies = []
+        monkeypatch.setattr(helga_jenkins, 'reply_from_thread', lambda *args: replies.append(args))
+        monkeypatch.setattr(helga_jenkins.reactor, 'callFromThread', lambda *args, **kw: None)
+        watcher = helga_jenkins.BuildWatcher(clock=FakeClock(), stage_progress=True)
+        watcher.watch(self.conn, 'ceph', 42, 'client', '#ci', 'alfredo', persist=False)
+        key = (self.conn.instance, 'ceph')
+        self.conn.responses['job/ceph/api/json'] = {'builds': [{'number': 42, 'building': True}]}
+        path = 'job/ceph/42/wfapi/describe'
+        self.conn.responses[path] = describe('IN_PROGRESS', ('Build', 'IN_PROGRESS', 5))
+        watcher.poll(key)
+        assert replies == []
+        self.conn.responses[path] = describe('IN_PROGRESS', ('Build', 'SUCCESS', 482), ('Test', 'IN_PROGRESS', 1))
+        watcher.poll(key)
+        assert replies == [('client', '#ci', 'alfredo: ceph #42: Build SUCCESS 8m02s, now at Test')]
+
+
+def history_build(number, result='SUCCESS', duration=60, building=False, queued=None):
+    info = {'number': number, 'result': result, 'duration': duration * 1000, 'building': building}
+    if queued is not None:
+        info['actions'] = [{}, {'queuingDurationMillis': queued * 1000}]
+    return info
+
+
+class TestBuildHistory(object):
+
+    def test_only_completed_builds_are_kept(self):
+        history = helga_jenkins.BuildHistory()
+        history.update([history_build(3, building=True), history_build(2), history_build(1)])
+        assert sorted(history.builds) == [1, 2]
+        assert history.running == set([3])
+
+    def test_fetch_depth_reaches_running_builds(self):
+        history = helga_jenkins.BuildHistory()
+        history.update([history_build(30), history_build(25, building=True), history_build(20)])
+        history.complete = True
+        assert history.fetch_depth(100) == 30 - 25 + 10
+        assert history.fetch_depth(5) == 5
+
+    def test_fetch_depth_goes_further_back_when_more_are_wanted(self):
+        history = helga_jenkins.BuildHistory()
+        history.update([history_build(n) for n in range(200, 100, -1)])
+        assert history.fetch_depth(100) == 10
+        assert history.fetch_depth(500) == 500
+        history.update([history_build(n) for n in range(100, 0, -1)])
+        # the history reaches the first build, there is nothing older
+        assert history.fetch_depth(500) == 10
+
+    def test_first_fetch_gets_everything_asked(self):
+        assert helga_jenkins.BuildHistory().fetch_depth(100) == 100
+
+    def test_gap_is_detected(self):
+        history = helga_jenkins.BuildHistory()
+        history.update([history_build(10)])
+        assert history.update([history_build(30), history_build(29)]) is False
+        assert history.update([history_build(12), history_build(11)]) is True
+
+    def test_size_is_bounded(self):
+        history = helga_jenkins.BuildHistory(size=2)
+        history.update([history_build(3), history_build(2), history_build(1)])
+        assert sorted(history.builds) == [2, 3]
+
+
+class TestBuildStats(object):
+
+    def test_stats(self):
+        builds = [
+            ('SUCCESS', 60, 1), ('FAILURE', 120, 2), ('SUCCESS', 90, 3),
+            ('ABORTED', 5, 4), ('SUCCESS', 600, 30),
+        ]
+        result = helga_jenkins.build_stats(builds)
+        assert result['p50'] == 90
+        assert result['p95'] == 600
+        assert result['failures'] == 1
+        assert result['failure_rate'] == 0.25
+        assert result['flips'] == 2
+        assert result['queue_p50'] == 3
+
+    def test_no_queue_times(self):
+        result = helga_jenkins.build_stats([('SUCCESS', 60, -1)])
+        assert result['queue_p50'] is None
+
+    def test_human_duration(self):
+        assert helga_jenkins.human_duration(42) == '42s'
+        assert helga_jenkins.human_duration(754) == '12m34s'
+        assert helga_jenkins.human_duration(7260) == '2h01m'
+
+
+class TestStats(object):
+
+    def teardown(self):
+        helga_jenkins.histories.clear()
+
+    def test_incremental(self):
+        conn = FakeJenkins({'job/ceph/api/json': {'builds': [
+            history_build(2, result='FAILURE', queued=5), history_build(1, queued=10)]}})
+        result = helga_jenkins.stats(conn, 'stats', 'ceph', '50')
+        assert result == (
+            'ceph, last 2 builds: duration p50 1m00s p95 1m00s, failure rate 50% (1), '
+            'flakiness 100% (1 flips), queued p50 5s p95 10s')
+        assert '{0,50}' in unquote(conn.requests[0])
+        helga_jenkins.stats(conn, 'stats', 'ceph', '50')
+        assert '{0,10}' in unquote(conn.requests[1])
+
+
+def overview_jenkins():
+    return FakeJenkins({
+        'api/json': {'jobs': [
+            {'name': 'ceph', 'color': 'red'},
+            {'name': 'rook', 'color': 'blue_anime'},
+            {'name': 'teuthology', 'jobs': [{'name': 'nightly', 'color': 'red_anime'}]},
+        ]},
+        'queue/api/json': {'items': [{'id': 1, 'inQueueSince': (time.time() - 60) * 1000}, {'id': 2}]},
+        'computer/api/json': {'busyExecutors': 3, 'totalExecutors': 8},
+    })
+
+
+class TestOverview(object):
+
+    def setup(self):
+        self.conn = overview_jenkins()
+        helga_jenkins.pool.add(('prod', 'http://ci.example.com/', 'admin'), self.conn)
+        helga_jenkins.settings = FakeSettings()
+        helga_jenkins.settings.MULTI_JENKINS = {
+            'prod': {'url': 'http://ci.example.com/', 'username': 'admin', 'password': 'secret'},
+            'test': {'url': 'http://test.example.com/'},
+        }
+        self.original = helga_jenkins.defer_to_jenkins
+        helga_jenkins.defer_to_jenkins = lambda instance, func, *a, **kw: defer.maybeDeferred(func, *a, **kw)
+
+    def teardown(self):
+        helga_jenkins.defer_to_jenkins = self.original
+        helga_jenkins.settings = FakeSettings()
+        helga_jenkins.pool.connections.clear()
+        helga_jenkins.overview_cache.entries.clear()
+
+    def overview(self):
+        results = []
+        helga_jenkins.overview(nick='alfredo').addCallback(results.append)
+        return results[0]
+
+    def test_failing_jobs_include_folders(self):
+        assert helga_jenkins.failing_jobs(self.conn) == ['ceph', 'teuthology/nightly']
+
+    def test_sample_load(self):
+        load = helga_jenkins.sample_load(self.conn)
+        assert load['queue'] == 2
+        assert 59 < load['longest_wait'] < 62
+        assert (load['busy'], load['total']) == (3, 8)
+
+    def test_every_instance(self):
+        result = self.overview()
+        assert result[0] == (
+            'prod: 2 failing (ceph, teuthology/nightly), queue: 2, executors: 3/8 busy')
+        assert result[1].startswith('test: Unable to connect to test, missing credential')
+
+    def test_snapshot_is_cached(self):
+        self.overview()
+        requests = len(self.conn.requests)
+        self.overview()
+        assert len(self.conn.requests) == requests
+
+    def test_snapshot_is_per_user(self):
+        self.overview()
+        helga_jenkins.overview_cache.set(('prod', 'admin'), 'prod: what admin sees')
+        helga_jenkins.settings.MULTI_JENKINS['prod'] = {
+            'url': 'http://ci.example.com/', 'username': 'guest', 'password': 'secret'}
+        helga_jenkins.pool.add(('prod', 'http://ci.example.com/', 'guest'), overview_jenkins())
+        helga_jenkins.compiled_settings.clear()
+        assert self.overview()[0] != 'prod: what admin sees'
+
+
+def load_sample(queue=0, wait=0, busy=1, total=8, when=None):
+    return {
+        'time': time.time() if when is None else when,
+        'queue': queue,
+        'longest_wait': wait,
+        'busy': busy,
+        'total': total,
+    }
+
+
+class TestMonitor(object):
+
+    def setup(self):
+        self.monitor = helga_jenkins.Monitor(size=3, queue_threshold=10, wait_threshold=600)
+
+    def test_ring_buffer(self):
+        for i in range(5):
+            self.monitor.add('prod', load_sample(queue=i))
+        assert [s['queue'] for s in self.monitor.samples['prod']] == [2, 3, 4]
+
+    def test_alerts_once_when_crossing(self):
+        assert self.monitor.add('prod', load_sample(queue=2)) is None
+        alert = self.monitor.add('prod', load_sample(queue=12, wait=90, busy=8))
+        assert alert == 'prod is backed up: 12 queued (longest wait 1m30s), executors: 8/8 busy'
+        assert self.monitor.add('prod', load_sample(queue=15)) is None
+
+    def test_wait_threshold(self):
+        assert 'backed up' in self.monitor.add('prod', load_sample(queue=1, wait=601))
+
+    def test_recovery(self):
+        self.monitor.add('prod', load_sample(queue=12))
+        assert self.monitor.add('prod', load_sample(queue=1)) == (
+            'prod has recovered: 1 queued, executors: 1/8 busy')
+
+
+class TestQueue(object):
+
+    def setup(self):
+        self.original = helga_jenkins.monitor
+        helga_jenkins.monitor = helga_jenkins.Monitor()
+        self.conn = overview_jenkins()
+
+    def teardown(self):
+        helga_jenkins.monitor = self.original
+
+    def test_from_monitor_samples(self):
+        now = time.time()
+        helga_jenkins.monitor.add(self.conn.instance, load_sample(queue=9, when=now - 50))
+        helga_jenkins.monitor.add(self.conn.instance, load_sample(queue=4, wait=30, when=now - 5))
+        result = helga_jenkins.queue(self.conn, 'queue')
+        assert result == (
+            'queue: 4 (longest wait 30s), executors: 1/8 busy, sampled 5s ago, '
+            'peak queue of 9 in the last 50s')
+        assert self.conn.requests == []
+
+    def test_live_sample_without_monitor(self):
+        result = helga_jenkins.queue(self.conn, 'queue')
+        assert result.startswith('queue: 2 (longest wait 1m00s), executors: 3/8 busy')
+
+
+class TestMetrics(object):
+
+    def setup(self):
+        self.clock = FakeClock()
+        self.metrics = helga_jenkins.Metrics(clock=self.clock)
+
+    def test_timed_records_latency_and_errors(self):
+        with self.metrics.timed('command', 'prod', 'status'):
+            self.clock.now += 0.2
+        with pytest.raises(RuntimeError):
+            with self.metrics.timed('command', 'prod', 'status'):
+                self.clock.now += 3
+                raise RuntimeError('boom')
+        [(key, timing)] = self.metrics.select('command')
+        assert key == ('command', 'prod', 'status')
+        assert timing['count'] == 2
+        assert timing['errors'] == 1
+        assert timing['sum'] == pytest.approx(3.2)
+        assert self.metrics.percentile(timing, 50) == 0.25
+        assert self.metrics.percentile(timing, 95) == 5
+
+    def test_get_name_is_timed(self, monkeypatch):
+        monkeypatch.setattr(helga_jenkins, 'metrics', self.metrics)
+        conn = FakeJenkins({})
+        helga_jenkins.job_indexes[conn.instance] = helga_jenkins.JobIndex(['ceph'])
+        try:
+            helga_jenkins.get_name(conn, 'ceph')
+        finally:
+            helga_jenkins.job_indexes.clear()
+        [(key, timing)] = self.metrics.select('plugin')
+        assert key == ('plugin', conn.instance, 'get_name')
+
+    def test_response_not_ready_is_not_an_error(self):
+        with pytest.raises(helga_jenkins.ResponseNotReady):
+            with self.metrics.timed('command', 'prod', 'build'):
+                raise helga_jenkins.ResponseNotReady
+        [(key, timing)] = self.metrics.select('command')
+        assert timing['count'] == 1
+        assert timing['errors'] == 0
+
+    def test_endpoint_name(self):
+        conn = FakeJenkins({})
+        url = 'http://ci.example.com/job/team/job/ceph/323/api/json?tree=result'
+        assert helga_jenkins.endpoint_name(conn, url) == 'job/*/job/*/N/api/json'
+        assert helga_jenkins.endpoint_name(conn, 'http://ci.example.com/') == '/'
+
+    def test_instrumented_connection(self, monkeypatch):
+        monkeypatch.setattr(helga_jenkins, 'metrics', self.metrics)
+        conn = helga_jenkins.instrument(FakeJenkins({'job/ceph/api/json': {}}))
+        helga_jenkins.jenkins_json(conn, helga_jenkins.job_url(conn, 'ceph'))
+        with pytest.raises(helga_jenkins.NotFoundException):
+            helga_jenkins.jenkins_json(conn, helga_jenkins.job_url(conn, 'missing'))
+        [(key, timing)] = self.metrics.select('jenkins')
+        assert key == ('jenkins', conn.instance, 'job/*/api/json')
+        assert (timing['count'], timing['errors']) == (2, 1)
+
+    def test_prometheus_text(self, monkeypatch):
+        monkeypatch.setattr(helga_jenkins, 'metrics', self.metrics)
+        self.metrics.observe('jenkins', 'prod', 'job/*/api/json', 0.03)
+        lines = helga_jenkins.prometheus_text().splitlines()
+        labels = 'kind="jenkins",instance="prod",name="job/*/api/json"'
+        assert 'helga_jenkins_seconds_bucket{%s,le="0.025"} 0' % labels in lines
+        assert 'helga_jenkins_seconds_bucket{%s,le="0.05"} 1' % labels in lines
+        assert 'helga_jenkins_seconds_bucket{%s,le="+Inf"} 1' % labels in lines
+        assert 'helga_jenkins_seconds_count{%s} 1' % labels in lines
+        assert 'helga_jenkins_errors_total{%s} 0' % labels in lines
+
+    def test_metrics_sub_command(self, monkeypatch):
+        monkeypatch.setattr(helga_jenkins, 'metrics', self.metrics)
+        self.metrics.observe('command', 'prod', 'status', 0.2)
+        self.metrics.observe('command', 'prod', 'status', 0.4, error=True)
+        self.metrics.observe('jenkins', 'prod', 'queue/api/json', 1.5)
+        result = helga_jenkins.metrics_report(FakeJenkins({}), 'metrics')
+        assert result[0] == 'commands: status 2 calls avg 300ms p95 500ms 1 errors'
+        assert result[1] == 'slowest endpoints: prod queue/api/json 1 calls avg 1.5s p95 2.5s'
+        assert result[2].startswith('cache hit rates: ')
+
+
+def parameters_jenkins():
+    return FakeJenkins({'job/ceph/api/json': {'actions': [{}, {'parameterDefinitions': [
+        {'name': 'BRANCH', 'type': 'StringParameterDefinition',
+         'defaultParameterValue': {'value': 'master'}},
+        {'name': 'FORCE', 'type': 'BooleanParameterDefinition',
+         'defaultParameterValue': {'value': False}},
+        {'name': 'DISTRO', 'type': 'ChoiceParameterDefinition', 'choices': ['centos7', 'xenial'],
+         'defaultParameterValue': {'value': 'centos7'}},
+    ]}]}})
+
+
+class TestBuildParameters(object):
+
+    def setup(self):
+        helga_jenkins.settings = FakeSettings()
+        helga_jenkins.settings.JENKINS_URL = 'http://ci.example.com/'
+        helga_jenkins.settings.JENKINS_PRESETS = {'release': {'BRANCH': 'stable', 'FORCE': True}}
+        self.conn = parameters_jenkins()
+
+    def teardown(self):
+        helga_jenkins.settings = FakeSettings()
+        helga_jenkins.parameter_caches.clear()
+
+    def build_parameters(self, *args):
+        return helga_jenkins.build_parameters(self.conn, 'ceph', list(args))
+
+    def test_coerced(self):
+        params = self.build_parameters('branch=wip', 'FORCE=yes', 'DISTRO=Xenial')
+        assert params == {'BRANCH': 'wip', 'FORCE': 'true', 'DISTRO': 'xenial', '__bogus_param__': '1'}
+
+    def test_bare_boolean_turns_it_on(self):
+        assert self.build_parameters('FORCE')['FORCE'] == 'true'
+
+    def test_typo_is_reported(self):
+        with pytest.raises(RuntimeError) as error:
+            self.build_parameters('BRANHC=wip')
+        assert str(error.value) == (
+            'BRANHC is not a parameter of ceph, did you mean BRANCH? (it takes: BRANCH, FORCE, DISTRO)')
+
+    def test_invalid_values(self):
+        with pytest.raises(RuntimeError) as error:
+            self.build_parameters('DISTRO=trusty')
+        assert str(error.value) == 'DISTRO must be one of: centos7, xenial'
+        with pytest.raises(RuntimeError) as error:
+            self.build_parameters('FORCE=maybe')
+        assert str(error.value) == 'FORCE must be true or false, not maybe'
+
+    def test_presets(self):
+        params = self.build_parameters('@release', 'BRANCH=hotfix')
+        assert (params['BRANCH'], params['FORCE']) == ('hotfix', 'true')
+        with pytest.raises(RuntimeError) as error:
+            self.build_parameters('@nightly')
+        assert str(error.value) == 'nightly is not a preset, valid ones are: release'
+
+    def test_per_instance_presets(self):
+        helga_jenkins.settings.MULTI_JENKINS = {'prod': {
+            'url': 'http://ci.example.com/', 'presets': {'nightly': {'BRANCH': 'next'}}}}
+        self.conn.instance = 'prod'
+        assert sorted(helga_jenkins.jenkins_settings().presets_for('prod')) == ['nightly', 'release']
+        assert self.build_parameters('@nightly')['BRANCH'] == 'next'
+
+    def test_definitions_are_cached_across_builds(self):
+        self.build_parameters('BRANCH=wip')
+        helga_jenkins.invalidate_job(self.conn, 'ceph')
+        self.build_parameters('BRANCH=next')
+        assert len(self.conn.requests) == 1
+
+    def test_fetched_again_before_rejecting(self):
+        self.build_parameters()
+        self.conn.responses['job/ceph/api/json']['actions'][1]['parameterDefinitions'].append(
+            {'name': 'RELEASE', 'type': 'StringParameterDefinition'})
+        assert self.build_parameters('RELEASE=luminous')['RELEASE'] == 'luminous'
+        assert len(self.conn.requests) == 2
+
+    def test_job_without_parameters(self):
+        self.conn.responses['job/ceph/api/json'] = {'actions': [{}]}
+        assert self.build_parameters() == {}
+        with pytest.raises(RuntimeError) as error:
+            self.build_parameters('BRANCH=wip')
+        assert str(error.value) == 'ceph does not take parameters'
+
+    def test_presets_are_not_job_names(self):
+        assert helga_jenkins.job_arguments(['ceph-*', '@release', 'BRANCH=wip']) == (
+            ['ceph-*'], ['@release', 'BRANCH=wip'])
+
+
+def completed(number, result):
+    return {'number': number, 'result': result, 'url': 'http://ci.example.com/job/ceph/%d/' % number}
+
+
+class TestSubscriptions(object):
+
+    def setup(self):
+        self.store = helga_jenkins.SubscriptionStore(FakeCollection())
+        self.subscriptions = helga_jenkins.Subscriptions(store=self.store)
+        self.subscriptions.client = self.client = FakeClient()
+        self.subscriptions.subscribe('prod', '#ci', 'ceph-*')
+        self.subscriptions.subscribe('prod', '#ceph', 'ceph-build')
+
+    def test_first_poll_only_takes_a_snapshot(self):
+        self.subscriptions.report('prod', {'ceph-build': completed(1, 'SUCCESS')})
+        assert self.client.messages == []
+
+    def test_state_changes_are_reported_to_matching_channels(self):
+        self.subscriptions.report('prod', {'ceph-build': completed(1, 'SUCCESS'), 'rook': completed(1, 'SUCCESS')})
+        self.subscriptions.report('prod', {'ceph-build': completed(2, 'FAILURE'), 'rook': completed(2, 'FAILURE')})
+        message = 'ceph-build is broken: build 2 FAILURE (was SUCCESS). Details at http://ci.example.com/job/ceph/2/console'
+        assert self.client.messages == [('#ceph', message), ('#ci', message)]
+
+    def test_same_result_is_not_reported(self):
+        self.subscriptions.report('prod', {'ceph-build': completed(1, 'FAILURE')})
+        self.subscriptions.report('prod', {'ceph-build': completed(2, 'FAILURE')})
+        self.subscriptions.report('prod', {'ceph-build': completed(3, 'ABORTED')})
+        assert self.client.messages == []
+        self.subscriptions.report('prod', {'ceph-build': completed(4, 'SUCCESS')})
+        assert self.client.messages[0][1].startswith('ceph-build is fixed: build 4 SUCCESS (was FAILURE)')
+
+    def test_one_request_per_instance(self, monkeypatch):
+        conn = FakeJenkins({'api/json': {'jobs': [
+            {'name': 'ceph-%d' % i, 'lastCompletedBuild': completed(i, 'SUCCESS')} for i in range(500)
+        ] + [{'name': 'team', 'jobs': [{'name': 'ceph', 'lastCompletedBuild': None}]}]}})
+        monkeypatch.setattr(helga_jenkins, 'connect', lambda credentials, instance: conn)
+        monkeypatch.setattr(helga_jenkins, 'parse_credentials', lambda *args: {})
+        builds = self.subscriptions.poll('prod')
+        assert len(builds) == 501
+        assert builds['team/ceph'] is None
+        assert len(conn.requests) == 1
+
+    def test_unsubscribe(self):
+        assert self.subscriptions.unsubscribe('prod', '#ceph', 'ceph-build')
+        assert not self.subscriptions.unsubscribe('prod', '#ceph', 'ceph-build')
+        assert self.subscriptions.channels_for('prod', 'ceph-build') == ['#ci']
+        assert [d['pattern'] for d in self.store.all()] == ['ceph-*']
+
+
+class TestSubscribe(object):
+
+    def setup(self):
+        self.conn = FakeJenkins({'api/json': {'jobs': [{'name': 'ceph-build'}, {'name': 'rook'}]}})
+        self.original = helga_jenkins.subscriptions
+        helga_jenkins.subscriptions = helga_jenkins.Subscriptions()
+        helga_jenkins.reactor.callFromThread = lambda func, *args: None
+
+    def teardown(self):
+        helga_jenkins.subscriptions = self.original
+        del helga_jenkins.reactor.callFromThread
+        helga_jenkins.job_indexes.clear()
+
+    def command(self, *args):
+        return helga_jenkins.sub_commands[args[0]](self.conn, *args, client=FakeClient(), channel='#ci', nick='alfredo')
+
+    def test_subscribe_and_list(self):
+        assert self.command('subscribe', 'ceph-build', 'r*') == '#ci will be told when ceph-build, r* break or get fixed'
+        assert self.command('subscriptions') == '#ci is subscribed to: ceph-build, r*'
+
+    def test_unknown_job(self):
+        with pytest.raises(RuntimeError):
+            self.command('subscribe', 'ceph-*-release')
+        assert self.command('subscriptions') == '#ci is not subscribed to any jobs'
+
+    def test_unsubscribe_unknown(self):
+        assert self.command('unsubscribe', 'rook') == '#ci is not subscribed to: rook'
+
+
+class FakeScheduler(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, delay, func, *args):
+        self.calls.append((delay, func, args))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for delay, func, args in calls:
+            func(*args)
+
+
+class TestOutbox(object):
+
+    def setup(self):
+        self.clock = FakeClock()
+        self.scheduler = FakeScheduler()
+        self.client = FakeClient()
+        self.outbox = helga_jenkins.Outbox(
+            rate=1, burst=2, window=5, digest=3, clock=self.clock, call_later=self.scheduler)
+
+    def notify(self, number, result, nick='alfredo'):
+        line = '%s %s for ceph/%d' % (nick, result, number)
+        self.outbox.notify(self.client, '#ci', [line], 'ceph/%d' % number, result, nick)
+
+    def test_sends_are_paced(self):
+        self.outbox.send(self.client, '#ci', ['one', 'two', 'three'])
+        assert [m for _, m in self.client.messages] == ['one', 'two']
+        [(delay, _, _)] = self.scheduler.calls
+        assert delay == 1
+        self.clock.now += 1
+        self.scheduler.run()
+        assert [m for _, m in self.client.messages] == ['one', 'two', 'three']
+
+    def test_channels_take_turns(self):
+        self.outbox.tokens = 0
+        self.outbox.send(self.client, '#ci', ['a1', 'a2', 'a3'])
+        self.outbox.send(self.client, '#ceph', ['b1'])
+        self.clock.now += 10
+        self.scheduler.run()
+        assert self.client.messages == [('#ci', 'a1'), ('#ceph', 'b1')]
+        self.clock.now += 10
+        self.scheduler.run()
+        assert self.client.messages[2:] == [('#ci', 'a2'), ('#ci', 'a3')]
+
+    def test_notifications_are_digested(self):
+        self.notify(321, 'SUCCESS')
+        self.notify(322, 'SUCCESS', nick='ktdreyer')
+        self.notify(323, 'FAILURE')
+        self.outbox.follow_up(self.client, '#ci', 'ceph/323', ['ERROR: no space left on device'])
+        assert self.client.messages == []
+        self.scheduler.run()
+        assert self.client.messages == [
+            ('#ci', 'alfredo, ktdreyer: 3 builds finished: 2 SUCCESS, 1 FAILURE (ceph/323)')]
+
+    def test_few_notifications_are_sent_as_they_are(self):
+        self.notify(323, 'FAILURE')
+        self.outbox.follow_up(self.client, '#ci', 'ceph/323', ['ERROR: no space left on device'])
+        self.scheduler.run()
+        assert [m for _, m in self.client.messages] == [
+            'alfredo FAILURE for ceph/323', 'ERROR: no space left on device']
+
+
+def jenkins_error(code):
+    return helga_jenkins.JenkinsException(
+        'Error in request. Possibly authentication failed [%d]: Forbidden' % code)
+
+
+class TestCircuit(object):
+
+    def setup(self):
+        self.clock = FakeClock()
+        self.circuit = helga_jenkins.Circuit('prod', failures=2, backoff=30, max_backoff=100, clock=self.clock)
+
+    def fail(self):
+        with pytest.raises(helga_jenkins.URLError):
+            with self.circuit.guard():
+                raise helga_jenkins.URLError('Connection refused')
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail()
+        assert self.circuit.allow()
+        self.fail()
+        assert not self.circuit.allow()
+        assert self.circuit.paused()
+        assert self.circuit.message() == (
+            'prod is unreachable (<urlopen error Connection refused>), not trying again for 30s')
+
+    def test_requests_in_flight_dont_trip_again(self):
+        for _ in range(6):
+            self.fail()
+        assert self.circuit.trips == 1
+        assert self.circuit.retry_at == self.clock.now + 30
+
+    def test_request_errors_are_not_outages(self):
+        for error in (helga_jenkins.NotFoundException('Requested item could not be found'),
+                      jenkins_error(403)):
+            with pytest.raises(helga_jenkins.JenkinsException):
+                with self.circuit.guard():
+                    raise error
+        assert self.circuit.consecutive == 0
+        assert helga_jenkins.is_outage(jenkins_error(500))
+        assert helga_jenkins.is_outage(helga_jenkins.TimeoutException('Error in request: timed out'))
+
+    def test_half_open_probe(self):
+        self.fail()
+        self.fail()
+        self.clock.now += 30
+        assert not self.circuit.paused()
+        assert self.circuit.allow()
+        # only one probe at a time
+        assert not self.circuit.allow()
+        with self.circuit.guard():
+            pass
+        assert self.circuit.state == 'closed'
+        assert self.circuit.allow()
+
+    def test_backoff_doubles_up_to_the_limit(self):
+        self.fail()
+        self.fail()
+        for wait in (60, 100, 100):
+            self.clock.now += 100
+            assert self.circuit.allow()
+            self.fail()
+            assert self.circuit.retry_at - self.clock.now == wait
+
+
+class TestFailFast(object):
+
+    def setup(self):
+        breaker = helga_jenkins.circuit('prod')
+        breaker.state, breaker.retry_at, breaker.error = 'open', time.time() + 60, 'timed out'
+
+    def teardown(self):
+        helga_jenkins.circuits.clear()
+
+    def test_calls_fail_right_away(self):
+        d = helga_jenkins.defer_to_jenkins('prod', lambda: 'never called')
+        failures = []
+        d.addErrback(failures.append)
+        assert failures[0].check(helga_jenkins.CircuitOpen)
+        assert helga_jenkins.circuit_open(failures[0]).startswith('prod is unreachable (timed out)')
+
+    def test_calls_that_dont_reach_jenkins_dont_keep_the_probe(self, monkeypatch):
+        monkeypatch.setattr(helga_jenkins.threads, 'deferToThread', defer.maybeDeferred)
+        breaker = helga_jenkins.circuit('prod')
+        breaker.retry_at = 0
+        results = []
+        for _ in range(2):
+            helga_jenkins.defer_to_jenkins('prod', lambda: 'from the cache').addBoth(results.append)
+        assert results == ['from the cache'] * 2
+        assert breaker.state == 'half-open'
+
+    def test_watched_builds_are_paused(self):
+        watcher = helga_jenkins.BuildWatcher()
+        conn = FakeJenkins({})
+        conn.instance = 'prod'
+        watcher.watch(conn, 'ceph', 323, FakeClient(), '#ci', 'alfredo', persist=False)
+        watcher.jobs[('prod', 'ceph')]['next_poll'] = 0
+        assert watcher.due() == []
+        helga_jenkins.circuit('prod').retry_at = 0
+        assert watcher.due() == [('prod', 'ceph')]
+
+
+def record(number, result='SUCCESS', building=False):
+    return {
+        'number': number, 'building': building, 'result': None if building else result,
+        'duration': 60000, 'url': 'http://ci.example.com/job/ceph/%d/' % number, 'builtOn': 'slave-01',
+        'actions': [{}, {'parameters': [{'name': 'BRANCH', 'value': 'master'}]}, {}],
+    }
+
+
+class TestBuildCache(object):
+
+    def test_completed_builds_are_kept(self, build_cache):
+        assert build_cache.put('prod', 'ceph', record(323))
+        assert not build_cache.put('prod', 'ceph', record(324, building=True))
+        cached = build_cache.get('prod', 'ceph', 323)
+        assert cached['actions'] == [{'parameters': [{'name': 'BRANCH', 'value': 'master'}]}]
+        assert build_cache.get('prod', 'ceph', 324) is None
+        assert build_cache.get('test', 'ceph', 323) is None
+
+    def test_survives_a_restart(self, build_cache):
+        build_cache.put('prod', 'ceph', record(1))
+        build_cache.put('prod', 'ceph', record(2))
+        build_cache.put('prod', 'rook', record(3))
+        restarted = helga_jenkins.BuildCache(build_cache.path)
+        assert [b['number'] for b in restarted.recent('prod', 'ceph', 10)] == [2, 1]
+
+    def test_indexed_without_reading_entries(self, build_cache):
+        build_cache.put('prod', 'ceph', record(1))
+        stray = build_cache.address('prod', 'ceph', 1)[1].replace('1.json', '1.json.tmp')
+        open(stray, 'w').close()
+        _, broken = build_cache.address('prod', 'ceph', 2)
+        open(broken, 'w').close()
+        restarted = helga_jenkins.BuildCache(build_cache.path)
+        load = helga_jenkins.json.load
+        helga_jenkins.json.load = lambda f: pytest.fail('read %s' % f.name)
+        try:
+            restarted.load()
+        finally:
+            helga_jenkins.json.load = load
+        assert len(restarted.index) == 2
+        assert not helga_jenkins.os.path.exists(stray)
+        # unreadable entries are only found out, and dropped, when used
+        assert restarted.get('prod', 'ceph', 2) is None
+        assert len(restarted.index) == 1
 
-    def test_no_actions(self):
-        job_config = {}
-        assert helga_jenkins.job_is_parametrized(job_config) is False
+    def test_least_recently_used_are_evicted(self, build_cache):
+        build_cache.size = 2
+        build_cache.put('prod', 'ceph', record(1))
+        build_cache.put('prod', 'ceph', record(2))
+        build_cache.get('prod', 'ceph', 1)
+        build_cache.put('prod', 'ceph', record(3))
+        assert build_cache.get('prod', 'ceph', 2) is None
+        assert build_cache.get('prod', 'ceph', 1) is not None
+        assert len(build_cache.index) == 2
 
-    def test_has_parameter_definitions(self):
-        job_config = {'actions': [{}, {u'parameterDefinitions': [{u'defaultParameterValue': {u'value': u''},
-               u'description': u'The git branch (or tag) to build',
-                  u'name': u'BRANCH',
-                     u'type': u'StringParameterDefinition'}]}, {}]}
+    def test_status_of_a_completed_build_costs_nothing(self, build_cache):
+        conn = FakeJenkins({'job/ceph/323/api/json': record(323, result='FAILURE')})
+        first = helga_jenkins.status(conn, 'status', 'ceph', '323')
+        assert helga_jenkins.status(conn, 'status', 'ceph', '323') == first
+        assert first.startswith('FAILURE for ceph on server: slave-01')
+        assert len(conn.requests) == 1
 
-        assert helga_jenkins.job_is_parametrized(job_config) is True
+    def test_stats_start_from_the_cache(self, build_cache):
+        for number in range(1, 51):
+            build_cache.put('http://ci.example.com/', 'ceph', history_build(number))
+        conn = FakeJenkins({'job/ceph/api/json': {'builds': [history_build(51)]}})
+        try:
+            result = helga_jenkins.stats(conn, 'stats', 'ceph', '100')
+        finally:
+            helga_jenkins.histories.clear()
+        assert result.startswith('ceph, last 51 builds')
+        assert '{0,10}' in unquote(conn.requests[0])